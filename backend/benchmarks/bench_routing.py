@@ -0,0 +1,115 @@
+""" Routing microbenchmark: linear route scan vs the combined regex Router on the urls.py table.
+
+    python benchmarks/bench_routing.py [--number 100000]
+"""
+import argparse
+import ast
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mindrecord.utils.errors import HTTPError
+from mindrecord.utils.routing import Router
+
+
+URLS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mindrecord', 'urls.py')
+
+PATHS = [
+    '/api/',
+    '/api/auth',
+    '/api/tests',
+    '/api/tests/memory-span',
+    '/api/tests/memory-span/web/js/app.js',
+    '/api/tests/memory-span/results',
+    '/api/results/5b1f0c7e2f8a4e3a9c000001',
+    '/api/results/5b1f0c7e2f8a4e3a9c000001/log',
+    '/api/results/5b1f0c7e2f8a4e3a9c000001/wait',
+    '/api/processing/stats',
+    # Unmatched paths scan every route
+    '/favicon.ico',
+    '/wp-login.php',
+    '/api/unknown/path',
+]
+
+
+class LinearRouter(object):
+    """ Previous implementation: every pattern is tried in order """
+    def __init__(self):
+        self.routes = []
+
+    def add_route(self, route_pattern: str, handler: callable):
+        self.routes.append((route_pattern, re.compile(route_pattern), handler))
+
+    def dispatch(self, request):
+        for pattern, compiled_pattern, handler in self.routes:
+            match = compiled_pattern.match(request.path)
+            if match:
+                return handler(request, **match.groupdict())
+        raise HTTPError(404)
+
+
+class FakeRequest(object):
+    def __init__(self, path: str, method: str='GET'):
+        self.path = path
+        self.method = method
+
+
+def load_patterns(path: str=URLS_PATH) -> list:
+    """ Route patterns from urls.py (including debug routes), without importing the application """
+    with open(path, 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    patterns = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and getattr(node.func, 'attr', None) == 'add_route':
+            patterns.append(ast.literal_eval(node.args[0]))
+    return patterns
+
+
+def handler(request, **kwargs):
+    return kwargs
+
+
+def bench(router, requests: list, number: int) -> float:
+    def run():
+        for request in requests:
+            try:
+                router.dispatch(request)
+            except HTTPError:
+                pass
+    return timeit.timeit(run, number=number) / (number * len(requests))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Routing microbenchmark')
+    parser.add_argument('--number', type=int, default=20000, help='Iterations over all paths')
+    args = parser.parse_args()
+
+    patterns = load_patterns()
+    routers = [('linear', LinearRouter()), ('combined', Router())]
+    for _, router in routers:
+        for pattern in patterns:
+            router.add_route(pattern, handler)
+
+    # Both routers must agree before comparing them
+    for path in PATHS:
+        results = []
+        for _, router in routers:
+            try:
+                results.append(router.dispatch(FakeRequest(path)))
+            except HTTPError as err:
+                results.append(err.status_code)
+        assert results[0] == results[1], '{0}: {1}'.format(path, results)
+
+    print('{0} routes, {1} paths, {2} iterations'.format(len(patterns), len(PATHS), args.number))
+    for title, paths in [('all', PATHS), ('matched', PATHS[:-3]), ('unmatched', PATHS[-3:])]:
+        requests = [FakeRequest(path) for path in paths]
+        timings = [(name, bench(router, requests, args.number)) for name, router in routers]
+        print('{0:>10}: {1}'.format(title, ', '.join(
+            '{0} {1:.2f} us'.format(name, seconds * 1e6) for name, seconds in timings)))
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,10 @@ _logger = logging.getLogger(__name__)
 class Config(BaseConfig):
     DEBUG = True
 
+    # API server (python -m mindrecord.manage), every request holds a server thread until it is answered
+    SERVER_THREADS = 16
+    SERVER_LONG_REQUESTS = 0  # Long-polls and streams at once, answered right away above that (0: SERVER_THREADS / 2)
+
     # Tests config (business logic)
     TESTS_CONFIG_PATTERN = 'D:\\Tests\\*\\*.mindrecord.json'
     TESTS_RESULTS_DIR = 'D:\\TestsResults\\'
@@ -21,10 +25,81 @@ class Config(BaseConfig):
     TESTS_RESULTS_FILE = 'results.json'
     TESTS_PROCESSING_LOG = 'output.log'
     TESTS_PROCESSING_ERROR_LOG = 'error.log'
+    PROCESSING_LOG_MAX_BYTES = 10 * 1024 * 1024  # Processing logs are truncated above that size
+    PROCESSING_LOG_FOLLOW_SECONDS = 5 * 60  # Max duration of a followed (?follow=1) log response
+    TESTS_WEB_MAX_FILES = 20000  # Web files of a test are listed at load time, files above that are not served
+    TESTS_WEB_REFRESH_SECONDS = 10  # How often the list of web files is checked for changes
+    TESTS_WATCH = True  # Reload changed test configs in the background (instant with the watchdog package)
+    TESTS_RELOAD_POLL_SECONDS = 5  # How often test configs are checked for changes
+    TESTS_SHARED_REGISTRY = True  # Loaded tests are published to the database for all processes
+    TESTS_REGISTRY_CHECK_SECONDS = 1  # How often the tests watcher checks for a newer published version
+
+    # Processing scheduler
+    PROCESSING_IN_API = True  # Process results in the API process, otherwise run: python -m mindrecord.worker
+    PROCESSING_BACKLOG_LIMIT = 1000  # Max raw results waiting in the database, submissions are rejected with 503 above that
+    PROCESSING_WORKERS = 4  # Max concurrent processing jobs
+    PROCESSING_QUEUE_SIZE = 100  # Max pending jobs, submissions are rejected with 503 above that
+    PROCESSING_PER_TEST_LIMIT = 2  # Max concurrent jobs of one test (overridden by processing.max_concurrency)
+    PROCESSING_RETRY_AFTER_SECONDS = 10
+    PROCESSING_LEASE_SECONDS = 5 * 60  # Claimed results are returned to the queue if not renewed in time
+    PROCESSING_MAX_ATTEMPTS = 3
+    PROCESSING_RETRY_BACKOFF_SECONDS = 30  # Doubled with every failed attempt
+    PROCESSING_POLL_SECONDS = 5  # How often the queue is checked for due results and leases are renewed
+    PROCESSING_PERSISTENT_RUNNERS = 2  # Runners per test with processing.mode "persistent" (processing.runners)
+    PROCESSING_PERSISTENT_MAX_JOBS = 100  # Runner is restarted after that many jobs (processing.max_jobs)
+    PROCESSING_TIMEOUT_SECONDS = 10 * 60  # Wall-clock limit of one processing run (processing.timeout)
+    PROCESSING_LIMIT_CPU_SECONDS = None  # rlimits of processing processes (processing.limits.cpu/memory/files)
+    PROCESSING_LIMIT_MEMORY_MB = None
+    PROCESSING_LIMIT_OPEN_FILES = None
+    PROCESSING_CACHE_MAX_ENTRIES = 10000  # Cached outputs of tests with processing.cache, LRU-evicted above that
+    PROCESSING_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60  # Default lifetime of a cached output (processing.cache.ttl)
+
+    # Request bodies, a violation is rejected with 413
+    REQUEST_MAX_BODY_BYTES = 64 * 1024 * 1024
+    REQUEST_MAX_FIELDS = 1000
+    REQUEST_MAX_FILE_BYTES = 32 * 1024 * 1024
+    REQUEST_MAX_FIELD_BYTES = 1024 * 1024  # Non-file fields are kept in memory
+    REQUEST_UPLOAD_DIR = None  # Uploaded files are spooled here (system temp dir by default)
+
+    # Resumable uploads (/api/tests/<uri>/uploads)
+    UPLOAD_MAX_BYTES = 4 * 1024 * 1024 * 1024  # Max size of an uploaded file unless inputs.<name>.max_size is set
+    UPLOAD_CHUNK_MAX_BYTES = 64 * 1024 * 1024
+    UPLOAD_SESSION_TTL_SECONDS = 24 * 60 * 60  # Sessions not updated for that long are removed with their files
+    UPLOAD_GC_INTERVAL_SECONDS = 10 * 60
+
+    # Small test web assets and covers kept in memory
+    STATIC_CACHE_MAX_BYTES = 32 * 1024 * 1024
+    STATIC_CACHE_MAX_FILE_BYTES = 256 * 1024  # Larger files are sent from disk
+    STATIC_CACHE_REVALIDATE_SECONDS = 2  # Cached files are served without checking the disk for that long
+
+    # Response compression (Accept-Encoding), brotli is used when the brotli package is installed
+    COMPRESSION_MIN_BYTES = 1024  # Smaller responses are sent as is
+    COMPRESSION_MAX_BYTES = 8 * 1024 * 1024  # Larger files are compressed only if a .br/.gz file is next to them
+    COMPRESSION_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Compressed responses kept in memory, LRU-evicted above that
+
+    # Listing results (/api/results)
+    RESULTS_PAGE_SIZE = 50
+    RESULTS_MAX_PAGE_SIZE = 200
+
+    # Waiting for results (/api/results/<id>/wait)
+    RESULTS_WAIT_TIMEOUT_SECONDS = 30  # Max duration of a long-poll request
+    RESULTS_WAIT_STREAM_SECONDS = 5 * 60  # Max duration of an event stream (Accept: text/event-stream)
+    RESULTS_WAIT_POLL_SECONDS = 1  # Interval of the shared state check when change streams are not available
+    RESULTS_WAIT_CHANGE_STREAMS = True
 
     # Auth and security settings
     AUTH_ALLOW_ANONYMOUS = True
-    AUTH_BCRYPT_ROUNDS = 10
+    AUTH_BCRYPT_ROUNDS = 10  # Changing it rehashes passwords on login
+    AUTH_HASH_WORKERS = 2  # Threads hashing passwords, 0 to hash in the request thread
+    # Logins waiting for a hashing thread, rejected with 429 above that. Every login holds a server thread
+    # until it is hashed, so workers + queue are capped at a quarter of SERVER_THREADS
+    AUTH_HASH_QUEUE_SIZE = 2
+    AUTH_HASH_TIMEOUT_SECONDS = 10
+    AUTH_TOKEN_CACHE_SIZE = 10000  # Verified tokens kept in memory, LRU-evicted above that
+    AUTH_TOKEN_CACHE_SECONDS = 60  # Claims of a verified token are reused for that long
+    AUTH_REVOKED_FILTER_CAPACITY = 100000  # Revoked tokens expected at once, the filter grows if there are more
+    AUTH_REVOKED_FILTER_ERROR_RATE = 0.001  # Share of valid tokens that are still looked up in the database
+    AUTH_REVOKED_SYNC_SECONDS = 10  # A token revoked by another process may still be accepted for that long
 
     JWT_SECRET = 'CHANGE_ME'
     JWT_ALGORITHM = 'HS256'
@@ -39,6 +114,7 @@ class Config(BaseConfig):
     # Database settings
     MONGO_DB_PATH = 'mongodb://localhost:27017/'
     MONGO_DB_NAME = 'mindrecord'
+    MONGO_ENSURE_INDEXES = True  # Create missing indexes on startup (see mindrecord.indexes)
 
     SMTP_HOST = None
     SMTP_PORT = None
@@ -1,18 +1,44 @@
+import collections
 import datetime
+import logging
+import threading
+import time
+import uuid
 from typing import List, Optional
 import bson
 import jwt
-import bcrypt
+from jwt.algorithms import get_default_algorithms
+from pymongo.errors import DuplicateKeyError
 
-from mindrecord.utils import Request, JsonResponse, Status, HTTPError, allow_methods, allow_cors
+from mindrecord.utils import Request, JsonResponse, Status, HTTPError, Timings, allow_methods, allow_cors
 from mindrecord.app import config, db
+from mindrecord.passwords import PasswordHasher
+from mindrecord.revocation import RevokedTokens
 
 
-__all__ = ['User', 'Roles', 'AuthError', 'get_auth_token', 'get_auth_token_payload',
-           'create_access_token', 'get_user_from_request', 'requires_auth', 'auth_view', 'verify_email_view']
+__all__ = ['User', 'Roles', 'AuthError', 'TokenCache', 'token_cache', 'get_auth_token', 'get_auth_token_payload',
+           'create_access_token', 'get_user_from_request', 'requires_auth', 'auth_view', 'verify_email_view',
+           'password_hasher', 'login_timings', 'revoked_tokens', 'revoke_token']
+
+logger = logging.getLogger(__name__)
 
 db_users = db['users']
-db_revoked_tokens = db['revoked_tokens']
+
+# Logins being hashed or waiting for it leave most server threads to other requests
+_max_logins = max(1, int(config.SERVER_THREADS) // 4)
+_hash_workers = min(int(config.AUTH_HASH_WORKERS), _max_logins)
+password_hasher = PasswordHasher(rounds=int(config.AUTH_BCRYPT_ROUNDS),
+                                 workers=_hash_workers,
+                                 queue_size=max(0, min(int(config.AUTH_HASH_QUEUE_SIZE), _max_logins - _hash_workers)),
+                                 timeout=float(config.AUTH_HASH_TIMEOUT_SECONDS))
+
+# Durations of email logins and registrations (including password hashing)
+login_timings = Timings()
+
+revoked_tokens = RevokedTokens(db['revoked_tokens'],
+                               capacity=int(config.AUTH_REVOKED_FILTER_CAPACITY),
+                               error_rate=float(config.AUTH_REVOKED_FILTER_ERROR_RATE),
+                               sync_seconds=float(config.AUTH_REVOKED_SYNC_SECONDS))
 
 
 class Roles(object):
@@ -77,11 +103,89 @@ def get_auth_token(request: Request, raise_if_none=True):
     return parts[1]
 
 
+class TokenCache(object):
+    """ Claims of verified tokens (LRU), so a token is verified once and not on every request.
+        An entry is used until the token expires but at most for ttl_seconds.
+        Revocation is not cached, it is checked on every use (see RevokedTokens).
+    """
+    def __init__(self, max_entries: int=10000, ttl_seconds: float=60):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+
+        self._lock = threading.Lock()
+        # token -> (payload, expires timestamp)
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(token, None)
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    del self._entries[token]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token: str, payload: dict):
+        if self.max_entries <= 0:
+            return
+        expires = time.time() + self.ttl_seconds
+        exp = payload.get('exp', None)
+        if isinstance(exp, (int, float)):
+            expires = min(expires, exp)
+        with self._lock:
+            self._entries[token] = (payload, expires)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token: str=None):
+        """ Removes a token (all of them if token is None) """
+        with self._lock:
+            if token is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(token, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+token_cache = TokenCache(max_entries=int(config.AUTH_TOKEN_CACHE_SIZE),
+                         ttl_seconds=float(config.AUTH_TOKEN_CACHE_SECONDS))
+
+# (algorithm, secret) -> key prepared by the algorithm
+_prepared_keys = {}
+
+
+def _get_key():
+    """ Signing and verification key, prepared once instead of on every encode/decode
+        (which means parsing PEM for asymmetric algorithms)
+    """
+    cache_key = (config.JWT_ALGORITHM, config.JWT_SECRET)
+    key = _prepared_keys.get(cache_key, None)
+    if key is None:
+        key = get_default_algorithms()[config.JWT_ALGORITHM].prepare_key(config.JWT_SECRET)
+        _prepared_keys[cache_key] = key
+    return key
+
+
 def get_payload(token: str):
+    """ Claims of a valid token, verified tokens are cached (see TokenCache) """
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
     try:
-        return jwt.decode(token, config.JWT_SECRET, issuer=config.JWT_ISSUER, algorithms=[config.JWT_ALGORITHM])
+        payload = jwt.decode(token, _get_key(), issuer=config.JWT_ISSUER, algorithms=[config.JWT_ALGORITHM])
     except jwt.InvalidTokenError as err:
         raise AuthError('Invalid token: {0}'.format(err.args[0]))
+    token_cache.put(token, payload)
+    return payload
 
 
 def get_auth_token_payload(request: Request, raise_if_none=True):
@@ -113,15 +217,20 @@ def create_user_token(user: User, kind: str, encoding='utf-8', expire_seconds=60
         'iat': iat,
         'exp': exp,
         'iss': config.JWT_ISSUER,
+        'jti': uuid.uuid4().hex,  # Token id, revoked tokens are stored by it
         config.JWT_USER_ID_CLAIM: user.id,
         config.JWT_ROLE_CLAIM: user.role,
         config.JWT_KIND_CLAIM: kind
     }
-    return jwt.encode(payload, config.JWT_SECRET, algorithm=config.JWT_ALGORITHM).decode(encoding)
+    return jwt.encode(payload, _get_key(), algorithm=config.JWT_ALGORITHM).decode(encoding)
 
 
 def get_user_from_request(request: Request, raise_if_no_token=False):
-    return get_user_from_token(get_auth_token(request, raise_if_none=raise_if_no_token))
+    """ User of the request token, memoized as request.user """
+    token = get_auth_token(request, raise_if_none=raise_if_no_token)
+    if request.user is None:
+        request.user = get_user_from_token(token)
+    return request.user
 
 
 def get_user_from_token(token: str=None, kind='access'):
@@ -136,9 +245,18 @@ def get_user_from_token(token: str=None, kind='access'):
         raise AuthError('Invalid token')
     if kind != token_kind:
         raise AuthError('Invalid token')
+    if revoked_tokens.is_revoked(token, token_payload):
+        raise AuthError('Token has been revoked')
     return User(identifier=user_id, role=role)
 
 
+def revoke_token(token: str) -> bool:
+    """ Revokes a valid token until it expires, False if it was revoked already """
+    revoked = revoked_tokens.revoke(token, get_payload(token))
+    token_cache.invalidate(token)
+    return revoked
+
+
 def requires_auth(permit_roles: List[str]=(Roles.UNAUTHORIZED, ), allowed_roles: List[str]=None):
     def decorator(fn):
         def wrapper(request: Request, *args, **kwargs):
@@ -175,12 +293,13 @@ def auth_view(request: Request):
             raise HTTPError(Status.BAD_REQUEST, message='Already logged in')
 
         refresh_token = request.data.get('refresh_token', None)
+        if isinstance(refresh_token, list):
+            refresh_token = refresh_token[0]
         if refresh_token is not None:
-            revoked_token = db_revoked_tokens.find_one({'token': refresh_token[0]})
-            if revoked_token is not None:
-                raise HTTPError(Status.BAD_REQUEST)
-            user = get_user_from_token(refresh_token)
-            db_revoked_tokens.insert_one({'token': refresh_token})
+            user = get_user_from_token(refresh_token, kind='refresh')
+            # Refresh tokens are single-use, only one of concurrent refreshes gets new tokens
+            if not revoke_token(refresh_token):
+                raise HTTPError(Status.BAD_REQUEST, message='Token was already used')
             return tokens_response(user)
 
         email = request.data.get('email', None)  # type: str
@@ -209,11 +328,41 @@ def auth_view(request: Request):
             return tokens_response(user, status_code=Status.CREATED)
 
         """ Email-based auth """
-        existing_user = db_users.find_one({'email': email})
-        if existing_user is None:
-            """ New user registration """
-            hashed_pwd = bcrypt.hashpw(password=password.encode('utf-8'),
-                                       salt=bcrypt.gensalt(config.AUTH_BCRYPT_ROUNDS))
+        started = time.monotonic()
+        try:
+            return __email_auth(email, password)
+        finally:
+            login_timings.add(time.monotonic() - started)
+    if request.method == 'DELETE':
+        """ Logout: revokes the access token and the refresh_token if it is passed """
+        access_token = get_auth_token(request)
+        user = get_user_from_token(access_token)
+        if not user.is_authorized:
+            raise HTTPError(Status.UNAUTHORIZED)
+
+        refresh_token = request.data.get('refresh_token', None)
+        if isinstance(refresh_token, list):
+            refresh_token = refresh_token[0]
+        if refresh_token:
+            refresh_user = get_user_from_token(refresh_token, kind='refresh')
+            if refresh_user.id != user.id:
+                raise HTTPError(Status.BAD_REQUEST, message='Tokens belong to different users')
+            revoke_token(refresh_token)
+
+        revoke_token(access_token)
+        request.user = User.create_guest()
+        return JsonResponse({'message': 'Logged out'})
+
+
+def __email_auth(email: str, password: str):
+    if not email or not password:
+        raise HTTPError(Status.BAD_REQUEST, 'email and password should be set')
+
+    existing_user = db_users.find_one({'email': email})
+    if existing_user is None:
+        """ New user registration """
+        hashed_pwd = password_hasher.hash(password)
+        try:
             user_id = db_users.insert_one({
                 'email': email,
                 'password': hashed_pwd,
@@ -221,24 +370,32 @@ def auth_view(request: Request):
                 'created': datetime.datetime.utcnow(),
                 'verified': False
             }).inserted_id
+        except DuplicateKeyError:
+            # Registered concurrently (users.email is unique)
+            raise HTTPError(Status.BAD_REQUEST)
 
-            user = User(str(user_id), Roles.USER)
-
-            email_verification_token = create_email_token(user)
-            # Todo: send email verification token
-            print('/verify-email?token={}'.format(email_verification_token))
+        user = User(str(user_id), Roles.USER)
 
-            return tokens_response(user, status_code=Status.CREATED)
+        email_verification_token = create_email_token(user)
+        # Todo: send email verification token
+        print('/verify-email?token={}'.format(email_verification_token))
 
-        """ Existing user auth """
-        if bcrypt.checkpw(password.encode('utf-8'), existing_user['password']):
-            user = User(str(existing_user['_id']), existing_user['role'])
-            return tokens_response(user, status_code=Status.OK)
+        return tokens_response(user, status_code=Status.CREATED)
 
+    """ Existing user auth """
+    if not password or not password_hasher.verify(password, existing_user['password']):
         raise HTTPError(Status.BAD_REQUEST)
-    if request.method == 'DELETE':
-        # TODO: Implement logout and token revoke
-        raise HTTPError(Status.NOT_IMPLEMENTED)
+
+    if password_hasher.needs_rehash(existing_user['password']):
+        # AUTH_BCRYPT_ROUNDS has changed, the password is at hand only now
+        try:
+            db_users.update_one({'_id': existing_user['_id'], 'password': existing_user['password']},
+                                {'$set': {'password': password_hasher.hash(password)}})
+        except HTTPError as err:
+            logger.warning('Password was not rehashed: {0}'.format(err))
+
+    user = User(str(existing_user['_id']), existing_user['role'])
+    return tokens_response(user, status_code=Status.OK)
 
 
 @allow_methods('GET')
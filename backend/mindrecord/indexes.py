@@ -0,0 +1,192 @@
+""" Indexes of every collection used by the backend.
+
+    Indexes are declared here and created on startup (MONGO_ENSURE_INDEXES) or with:
+
+        python -m mindrecord.indexes            # create missing indexes
+        python -m mindrecord.indexes --check    # also explain the queries below, report COLLSCANs and slow plans
+
+    Creating an index that already exists is a no-op, so this is safe to run any time.
+"""
+import argparse
+import datetime
+import logging
+import sys
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.database import Database
+from pymongo.errors import OperationFailure, PyMongoError
+
+from mindrecord.app import config, db
+from mindrecord.models import States
+
+
+__all__ = ['INDEXES', 'queries', 'ensure_indexes', 'ensure_indexes_on_startup', 'check_queries', 'main']
+
+logger = logging.getLogger(__name__)
+
+
+INDEXES = {
+    'users': [
+        # Anonymous users have no email
+        IndexModel([('email', ASCENDING)], name='email', unique=True,
+                   partialFilterExpression={'email': {'$exists': True}}),
+    ],
+    'revoked_tokens': [
+        IndexModel([('expires', ASCENDING)], name='expires_ttl', expireAfterSeconds=0),
+        IndexModel([('revoked', ASCENDING)], name='revoked'),
+    ],
+    'results': [
+        # Queue: due raw results in order, of all tests or of one
+        IndexModel([('state', ASCENDING), ('available', ASCENDING), ('created', ASCENDING)],
+                   name='state_available_created'),
+        IndexModel([('test', ASCENDING), ('state', ASCENDING), ('available', ASCENDING), ('created', ASCENDING)],
+                   name='test_state_available_created'),
+        # Expired leases
+        IndexModel([('state', ASCENDING), ('lease_expires', ASCENDING)], name='state_lease_expires'),
+        IndexModel([('batch', ASCENDING)], name='batch', sparse=True),
+        # Results of a user (of a test, in a state), newest first (/api/results pages)
+        IndexModel([('user', ASCENDING), ('created', DESCENDING), ('_id', DESCENDING)],
+                   name='user_created'),
+        IndexModel([('user', ASCENDING), ('test', ASCENDING), ('created', DESCENDING), ('_id', DESCENDING)],
+                   name='user_test_created'),
+        IndexModel([('user', ASCENDING), ('state', ASCENDING), ('created', DESCENDING), ('_id', DESCENDING)],
+                   name='user_state_created'),
+    ],
+    'processing_cache': [
+        IndexModel([('expires', ASCENDING)], name='expires_ttl', expireAfterSeconds=0),
+        IndexModel([('last_used', ASCENDING)], name='last_used'),
+        IndexModel([('test', ASCENDING)], name='test'),
+    ],
+    'upload_sessions': [
+        # Not a TTL index: expired sessions are removed together with their files
+        IndexModel([('expires', ASCENDING)], name='expires'),
+    ],
+}
+
+
+def queries() -> list:
+    """ Representative queries of the backend: (collection, filter, sort) """
+    now = datetime.datetime.utcnow()
+    due = {'state': States.RAW, '$or': [{'available': {'$lte': now}}, {'available': None}]}
+    return [
+        ('users', {'email': 'user@example.com'}, None),
+        ('revoked_tokens', {'revoked': {'$gte': now}}, None),
+        ('revoked_tokens', {'expires': {'$gt': now}}, None),
+        ('results', due, [('available', 1), ('created', 1)]),
+        ('results', dict(due, test='test'), [('available', 1), ('created', 1)]),
+        ('results', {'state': States.RAW}, None),
+        ('results', {'state': States.PROCESSING, 'lease_expires': {'$lt': now}}, None),
+        ('results', {'user': ObjectId()}, [('created', -1), ('_id', -1)]),
+        ('results', {'user': ObjectId(), 'test': 'test'}, [('created', -1), ('_id', -1)]),
+        ('results', {'user': ObjectId(), 'state': States.PROCESSED}, [('created', -1), ('_id', -1)]),
+        ('results', {'user': ObjectId(), 'created': {'$lte': now},
+                     '$or': [{'created': {'$lt': now}}, {'_id': {'$lt': ObjectId()}}]},
+         [('created', -1), ('_id', -1)]),
+        ('processing_cache', {'expires': {'$gt': now}}, None),
+        ('processing_cache', {}, [('last_used', 1)]),
+        ('processing_cache', {'test': 'test'}, None),
+        ('upload_sessions', {'expires': {'$lt': now}}, None),
+    ]
+
+
+def ensure_indexes(database: Database=db, collections: list=None) -> dict:
+    """ Creates the declared indexes (of the given collections), returns {collection: [index names]}.
+        An index that conflicts with an existing one (same name, other options) is logged and skipped.
+    """
+    created = {}
+    for name, models in INDEXES.items():
+        if collections is not None and name not in collections:
+            continue
+        collection = database[name]
+        created[name] = []
+        for model in models:
+            try:
+                created[name].append(collection.create_indexes([model])[0])
+            except OperationFailure as err:
+                logger.error('Unable to create index {0}.{1}: {2}'.format(name, model.document['name'], err))
+    logger.debug('Indexes are in place: {0}'.format(created))
+    return created
+
+
+def ensure_indexes_on_startup():
+    """ ensure_indexes() if MONGO_ENSURE_INDEXES is set, the server still starts if the database is down """
+    if not config.MONGO_ENSURE_INDEXES:
+        return
+    try:
+        ensure_indexes()
+    except PyMongoError as err:
+        logger.error('Unable to create indexes: {0}'.format(err))
+
+
+def _stages(plan: dict):
+    """ Stage names of a query plan tree """
+    yield plan.get('stage', None)
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            yield from _stages(plan[key])
+    for child in plan.get('inputStages', ()):
+        yield from _stages(child)
+
+
+def check_queries(database: Database=db, slow_ms: int=100) -> list:
+    """ Explains queries(), logs the ones scanning the whole collection or running longer than slow_ms.
+        Returns the problems: [{collection, filter, sort, problem, ...}]
+    """
+    problems = []
+    for name, query, sort in queries():
+        command = {'find': name, 'filter': query}
+        if sort:
+            command['sort'] = dict(sort)
+        try:
+            explained = database.command({'explain': command, 'verbosity': 'executionStats'})
+        except OperationFailure as err:
+            logger.error('Unable to explain {0} {1}: {2}'.format(name, query, err))
+            continue
+
+        stages = set(_stages(explained['queryPlanner']['winningPlan']))
+        stats = explained.get('executionStats', {})
+        problem = None
+        if 'COLLSCAN' in stages:
+            problem = 'COLLSCAN'
+        elif 'SORT' in stages:
+            problem = 'in-memory SORT'
+        elif stats.get('executionTimeMillis', 0) >= slow_ms:
+            problem = 'slow'
+
+        if problem is None:
+            logger.debug('{0} {1}: {2}'.format(name, query, sorted(s for s in stages if s)))
+            continue
+        logger.warning('{0} {1} sort={2}: {3} ({4} ms, {5} documents examined, {6} returned)'.format(
+            name, query, sort, problem, stats.get('executionTimeMillis'),
+            stats.get('totalDocsExamined'), stats.get('nReturned')))
+        problems.append({
+            'collection': name,
+            'filter': query,
+            'sort': sort,
+            'problem': problem,
+            'milliseconds': stats.get('executionTimeMillis'),
+            'examined': stats.get('totalDocsExamined'),
+            'returned': stats.get('nReturned'),
+        })
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create MindRecord database indexes')
+    parser.add_argument('--check', action='store_true', help='Explain the backend queries and report bad plans')
+    parser.add_argument('--slow-ms', type=int, default=100, help='Queries running longer are reported by --check')
+    parser.add_argument('--collections', type=str, default=None, help='Comma-separated collections (default: all)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    collections = [c.strip() for c in args.collections.split(',') if c.strip()] if args.collections else None
+    ensure_indexes(collections=collections)
+    if args.check:
+        problems = check_queries(slow_ms=args.slow_ms)
+        logger.info('{0} queries with problems'.format(len(problems)))
+        sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
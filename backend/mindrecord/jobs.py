@@ -0,0 +1,563 @@
+import datetime
+import functools
+import logging
+import os
+import socket
+import threading
+import uuid
+from typing import Optional
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.collection import Collection
+
+from mindrecord.models import States
+from mindrecord.scheduler import Scheduler, QueueFullError
+
+
+__all__ = ['JobQueue', 'Dispatcher', 'make_owner_id']
+
+logger = logging.getLogger(__name__)
+
+
+def make_owner_id() -> str:
+    """ Unique id of a queue consumer: host, process and instance """
+    return '{0}:{1}:{2}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+class _BatchCancel(object):
+    """ Cancel event of a batch: set once every result of the batch was cancelled """
+    def __init__(self, result_ids: list):
+        self.event = threading.Event()
+        self._lock = threading.Lock()
+        self._pending = set(result_ids)
+
+    def cancel(self, result_id: ObjectId):
+        with self._lock:
+            self._pending.discard(result_id)
+            if self._pending:
+                return
+        self.event.set()
+
+
+class JobQueue(object):
+    """ Durable processing queue backed by the results collection.
+
+        Results move raw -> processing -> processed/fail. A result is claimed atomically
+        (find_one_and_update) together with a lease, so any number of consumers on any
+        number of hosts can drain the queue without processing a result twice.
+        Leases that were not renewed in time (consumer crashed) are returned to raw
+        by `recover_expired`. Failed attempts are retried with exponential backoff.
+        Listeners are called with ids of results whose state was changed by this queue.
+    """
+    def __init__(self, collection: Collection,
+                 owner: str=None,
+                 lease_seconds: int=300,
+                 max_attempts: int=3,
+                 backoff_seconds: int=30,
+                 backoff_max_seconds: int=60 * 60):
+        self.collection = collection
+        self.owner = owner or make_owner_id()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self._listeners = []
+
+    def add_listener(self, listener: callable):
+        self._listeners.append(listener)
+
+    def _changed(self, result_ids: list):
+        if not result_ids:
+            return
+        for listener in self._listeners:
+            try:
+                listener(result_ids)
+            except Exception as err:
+                logger.exception(err)
+
+    def _lease_expires(self) -> datetime.datetime:
+        return datetime.datetime.utcnow() + datetime.timedelta(seconds=self.lease_seconds)
+
+    @staticmethod
+    def _due_filter(now: datetime.datetime) -> dict:
+        # Results stored before the queue existed have no 'available' field
+        return {'state': States.RAW, '$or': [{'available': {'$lte': now}}, {'available': None}]}
+
+    def claim(self, result_id: ObjectId=None, tests: list=None) -> Optional[dict]:
+        """ Atomically takes a due raw result (specific one if result_id is set) """
+        now = datetime.datetime.utcnow()
+        query = self._due_filter(now)
+        if result_id is not None:
+            query['_id'] = result_id
+        if tests is not None:
+            query['test'] = {'$in': list(tests)}
+        result = self.collection.find_one_and_update(
+            query,
+            {
+                '$set': {
+                    'state': States.PROCESSING,
+                    'lease_owner': self.owner,
+                    'lease_expires': self._lease_expires(),
+                    'started': now,
+                },
+                '$inc': {'attempts': 1},
+            },
+            sort=[('available', 1), ('created', 1)],
+            return_document=ReturnDocument.AFTER)
+        if result is not None:
+            self._changed([result['_id']])
+        return result
+
+    def claim_many(self, test_id: str, limit: int) -> list:
+        """ Claims up to limit due raw results of a test as one batch.
+            Every result is still claimed atomically, results taken by other consumers in between are skipped.
+        """
+        now = datetime.datetime.utcnow()
+        query = self._due_filter(now)
+        query['test'] = test_id
+        candidates = [doc['_id'] for doc in self.collection.find(query, projection={'_id': True})
+                      .sort([('available', 1), ('created', 1)])
+                      .limit(limit)]
+        if not candidates:
+            return []
+
+        batch_id = ObjectId()
+        query['_id'] = {'$in': candidates}
+        self.collection.update_many(query, {
+            '$set': {
+                'state': States.PROCESSING,
+                'lease_owner': self.owner,
+                'lease_expires': self._lease_expires(),
+                'started': now,
+                'batch': batch_id,
+            },
+            '$inc': {'attempts': 1},
+        })
+        results = list(self.collection.find({'batch': batch_id, 'state': States.PROCESSING, 'lease_owner': self.owner}))
+        self._changed([result['_id'] for result in results])
+        return results
+
+    def due(self, limit: int, exclude: list=(), tests: list=None, exclude_tests: list=()) -> list:
+        """ Raw results that can be claimed now: [(result_id, test_id), ...] """
+        query = self._due_filter(datetime.datetime.utcnow())
+        if exclude:
+            query['_id'] = {'$nin': list(exclude)}
+        if tests is not None:
+            query['test'] = {'$in': [t for t in tests if t not in exclude_tests]}
+        elif exclude_tests:
+            query['test'] = {'$nin': list(exclude_tests)}
+        cursor = self.collection.find(query, projection={'test': True}) \
+            .sort([('available', 1), ('created', 1)]) \
+            .limit(limit)
+        return [(doc['_id'], doc.get('test')) for doc in cursor]
+
+    def due_by_test(self, tests: list=None) -> dict:
+        """ Due raw results grouped by test: {test_id: (count, oldest queued time)} """
+        query = self._due_filter(datetime.datetime.utcnow())
+        if tests is not None:
+            query['test'] = {'$in': list(tests)}
+        groups = self.collection.aggregate([
+            {'$match': query},
+            {'$group': {
+                '_id': '$test',
+                'count': {'$sum': 1},
+                'oldest': {'$min': {'$ifNull': ['$available', '$created']}}
+            }}
+        ])
+        return {group['_id']: (group['count'], group['oldest']) for group in groups}
+
+    def backlog(self, limit: int=None) -> int:
+        """ Number of raw results (counting stops at limit) """
+        kwargs = {'limit': limit} if limit else {}
+        return self.collection.count_documents({'state': States.RAW}, **kwargs)
+
+    def renew(self, result_ids: list) -> int:
+        """ Extends leases held by this owner, returns number of leases still held """
+        if not result_ids:
+            return 0
+        res = self.collection.update_many(
+            {'_id': {'$in': list(result_ids)}, 'state': States.PROCESSING, 'lease_owner': self.owner},
+            {'$set': {'lease_expires': self._lease_expires()}})
+        return res.matched_count
+
+    def complete(self, result_id: ObjectId, data: dict) -> bool:
+        res = self.collection.update_one(
+            {'_id': result_id, 'state': States.PROCESSING, 'lease_owner': self.owner},
+            {
+                '$set': {
+                    'state': States.PROCESSED,
+                    'processed': datetime.datetime.utcnow(),
+                    'data': data,
+                },
+                '$unset': {'lease_owner': '', 'lease_expires': '', 'error': ''},
+            })
+        if not res.modified_count:
+            logger.warning('Lease on {0} was lost, results discarded'.format(result_id))
+            return False
+        self._changed([result_id])
+        return True
+
+    def complete_many(self, outputs: dict) -> int:
+        """ Stores outputs of several results ({result_id: data}) with a single bulk write """
+        if not outputs:
+            return 0
+        now = datetime.datetime.utcnow()
+        res = self.collection.bulk_write([
+            UpdateOne({'_id': result_id, 'state': States.PROCESSING, 'lease_owner': self.owner}, {
+                '$set': {
+                    'state': States.PROCESSED,
+                    'processed': now,
+                    'data': data,
+                },
+                '$unset': {'lease_owner': '', 'lease_expires': '', 'error': ''},
+            }) for result_id, data in outputs.items()
+        ], ordered=False)
+        if res.modified_count != len(outputs):
+            logger.warning('Leases on {0} results of a batch were lost, results discarded'.format(
+                len(outputs) - res.modified_count))
+        self._changed(list(outputs))
+        return res.modified_count
+
+    def fail(self, result_id: ObjectId, reason: str=None, retry=True, state: str=States.FAIL) -> Optional[str]:
+        """ Returns the result to the queue with a backoff or moves it to the final state.
+            Returns the new state or None if the lease was lost.
+        """
+        result = self.collection.find_one({'_id': result_id, 'lease_owner': self.owner},
+                                          projection={'attempts': True})
+        if result is None:
+            return None
+
+        attempts = result.get('attempts', 1)
+        now = datetime.datetime.utcnow()
+        if retry and attempts < self.max_attempts:
+            delay = min(self.backoff_seconds * 2 ** (attempts - 1), self.backoff_max_seconds)
+            update = {'state': States.RAW, 'available': now + datetime.timedelta(seconds=delay)}
+        else:
+            update = {'state': state, 'processed': now}
+        update['error'] = reason
+
+        res = self.collection.update_one(
+            {'_id': result_id, 'state': States.PROCESSING, 'lease_owner': self.owner},
+            {'$set': update, '$unset': {'lease_owner': '', 'lease_expires': ''}})
+        if not res.modified_count:
+            return None
+        logger.error('Failed processing: {0} {1} (attempt {2}, now {3})'.format(
+            result_id, reason, attempts, update['state']))
+        self._changed([result_id])
+        return update['state']
+
+    def cancel(self, result_id: ObjectId) -> Optional[str]:
+        """ Cancels processing of a result.
+            Raw result is killed right away, a result being processed is flagged and killed by its
+            consumer on the next lease renewal. Returns the state or None if processing is over.
+        """
+        res = self.collection.update_one({'_id': result_id, 'state': States.RAW}, {
+            '$set': {'state': States.KILLED, 'processed': datetime.datetime.utcnow(), 'error': 'Cancelled'}
+        })
+        if res.modified_count:
+            self._changed([result_id])
+            return States.KILLED
+        res = self.collection.update_one({'_id': result_id, 'state': States.PROCESSING}, {'$set': {'cancel': True}})
+        if res.matched_count:
+            return States.PROCESSING
+        return None
+
+    def cancel_requested(self, result_ids: list) -> list:
+        """ Results of the list which are flagged for cancellation """
+        if not result_ids:
+            return []
+        cursor = self.collection.find({'_id': {'$in': list(result_ids)}, 'cancel': True}, projection={'_id': True})
+        return [doc['_id'] for doc in cursor]
+
+    def recover_expired(self) -> int:
+        """ Returns results with expired leases to the queue (or fails them if out of attempts) """
+        now = datetime.datetime.utcnow()
+        expired = {'state': States.PROCESSING, 'lease_expires': {'$lt': now}}
+        unset = {'lease_owner': '', 'lease_expires': ''}
+
+        cancelled = dict(expired, cancel=True)
+        failed = self.collection.update_many(cancelled, {
+            '$set': {'state': States.KILLED, 'processed': now, 'error': 'Cancelled'},
+            '$unset': unset
+        }).modified_count
+
+        exhausted = dict(expired, attempts={'$gte': self.max_attempts})
+        failed += self.collection.update_many(exhausted, {
+            '$set': {'state': States.FAIL, 'processed': now, 'error': 'Lease expired'},
+            '$unset': unset
+        }).modified_count
+
+        recovered = self.collection.update_many(expired, {
+            '$set': {'state': States.RAW, 'available': now},
+            '$unset': unset
+        }).modified_count
+
+        if failed or recovered:
+            logger.warning('Expired leases: {0} returned to queue, {1} failed'.format(recovered, failed))
+        return recovered + failed
+
+
+class Dispatcher(object):
+    """ Feeds the scheduler with results from the durable queue.
+
+        Results are claimed by the scheduler worker right before they are processed, so a
+        result that waits in memory is still raw in the database and is not lost if this
+        process dies. A background loop renews leases of running jobs, recovers expired
+        leases and tops the scheduler up with due results (retries, results submitted to
+        other processes, results left from previous runs).
+
+        Results of tests with processing.batch_size are processed in batches by batch_handler:
+        a batch is started when batch_size results are due or the oldest of them has waited
+        processing.max_wait_ms. A running batch is killed once all of its results are cancelled,
+        or when the dispatcher stops (its results are returned to the queue then).
+    """
+    def __init__(self, queue: JobQueue, scheduler: Scheduler,
+                 get_test: callable, handler: callable, batch_handler: callable=None,
+                 poll_seconds: float=5, tests: list=None):
+        self.queue = queue
+        self.scheduler = scheduler
+        self.get_test = get_test
+        self.handler = handler
+        self.batch_handler = batch_handler
+        self.poll_seconds = poll_seconds
+        # Process only results of these tests (all if None)
+        self.tests = tests
+
+        self._lock = threading.Lock()
+        self._queued = set()
+        self._batches = set()
+        self._running = set()
+        # Result id -> callable cancelling its processing
+        self._cancel_events = {}
+        self._batch_cancels = set()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._stopping = False
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self.scheduler.start()
+        self._thread = threading.Thread(target=self._loop, name='dispatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self, wait=True):
+        self._stopping = True
+        self._wakeup.set()
+        # Running batches are killed, their results are returned to the queue
+        with self._lock:
+            batch_cancels = list(self._batch_cancels)
+        for batch_cancel in batch_cancels:
+            batch_cancel.event.set()
+        if self._thread is not None and wait:
+            self._thread.join()
+        self._thread = None
+        self.scheduler.stop(wait=wait)
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None
+
+    def _limit(self, test_id: str) -> Optional[int]:
+        test = self.get_test(test_id) or {}
+        return (test.get('processing') or {}).get('max_concurrency', None)
+
+    def _batch_options(self, test_id: str) -> Optional[tuple]:
+        """ (batch size, max wait in seconds) if results of the test are processed in batches """
+        if self.batch_handler is None:
+            return None
+        test = self.get_test(test_id) or {}
+        processing_desc = test.get('processing') or {}
+        batch_size = processing_desc.get('batch_size', None)
+        if not batch_size:
+            return None
+        return int(batch_size), float(processing_desc.get('max_wait_ms', 0)) / 1000.0
+
+    def notify(self, result_id: ObjectId, test_id: str) -> bool:
+        """ Schedules a result right away. Returns False if it was left for the poll loop """
+        if self.tests is not None and test_id not in self.tests:
+            return False
+        if self._batch_options(test_id) is not None:
+            # Batches are collected by the poll loop
+            self._wakeup.set()
+            return True
+        with self._lock:
+            if result_id in self._queued:
+                return True
+            try:
+                self.scheduler.submit(test_id, self._execute, result_id, limit=self._limit(test_id))
+            except QueueFullError:
+                return False
+            self._queued.add(result_id)
+        return True
+
+    def _execute(self, result_id: ObjectId):
+        try:
+            result = self.queue.claim(result_id=result_id)
+            if result is None:
+                # Taken by another consumer or not due yet
+                return
+
+            cancel = threading.Event()
+            with self._lock:
+                self._running.add(result_id)
+                self._cancel_events[result_id] = cancel.set
+
+            test = self.get_test(result.get('test'))
+            if not test:
+                self.queue.fail(result_id, 'Unknown test {0}'.format(result.get('test')), retry=False)
+                return
+
+            try:
+                data = self.handler(result, test, cancel=cancel)
+            except Exception as err:
+                logger.exception(err)
+                self.queue.fail(result_id, str(err),
+                                retry=getattr(err, 'retry', True),
+                                state=getattr(err, 'state', States.FAIL))
+                return
+            self.queue.complete(result_id, data)
+        finally:
+            with self._lock:
+                self._queued.discard(result_id)
+                self._running.discard(result_id)
+                self._cancel_events.pop(result_id, None)
+            # A slot is free, look for more work without waiting for the poll interval
+            self._wakeup.set()
+
+    def _execute_batch(self, test_id: str, batch_size: int):
+        result_ids = []
+        try:
+            results = self.queue.claim_many(test_id, batch_size)
+            if not results:
+                return
+            result_ids = [result['_id'] for result in results]
+
+            # The batch is killed only once all of its results were cancelled
+            batch_cancel = _BatchCancel(result_ids)
+            with self._lock:
+                self._running.update(result_ids)
+                self._batch_cancels.add(batch_cancel)
+                for result_id in result_ids:
+                    self._cancel_events[result_id] = functools.partial(batch_cancel.cancel, result_id)
+            for result_id in self.queue.cancel_requested(result_ids):
+                batch_cancel.cancel(result_id)
+
+            test = self.get_test(test_id)
+            if not test:
+                for result_id in result_ids:
+                    self.queue.fail(result_id, 'Unknown test {0}'.format(test_id), retry=False)
+                return
+
+            try:
+                outputs = self.batch_handler(results, test, cancel=batch_cancel.event)
+            except Exception as err:
+                logger.exception(err)
+                for result_id in result_ids:
+                    self.queue.fail(result_id, str(err),
+                                    retry=self._stopping or getattr(err, 'retry', True),
+                                    state=getattr(err, 'state', States.FAIL))
+                return
+
+            # A batch is not killed for one of its results, cancelled results are just not stored
+            cancelled = set(self.queue.cancel_requested(result_ids))
+            for result_id in cancelled:
+                self.queue.fail(result_id, 'Cancelled', retry=False, state=States.KILLED)
+            completed = {k: v for k, v in outputs.items() if v is not None and k not in cancelled}
+            self.queue.complete_many(completed)
+            for result_id in result_ids:
+                if result_id not in completed and result_id not in cancelled:
+                    self.queue.fail(result_id, 'No results in batch output')
+        finally:
+            with self._lock:
+                self._batches.discard(test_id)
+                self._running.difference_update(result_ids)
+                for result_id in result_ids:
+                    self._cancel_events.pop(result_id, None)
+                if result_ids:
+                    self._batch_cancels.discard(batch_cancel)
+            self._wakeup.set()
+
+    def _poll_batches(self, room: int) -> tuple:
+        """ Starts batches that are ready.
+            Returns batch tests and seconds until the next batch is due (None if no batch is waiting)
+        """
+        batch_tests = []
+        next_due = None
+        now = datetime.datetime.utcnow()
+        for test_id, (count, oldest) in self.queue.due_by_test(tests=self.tests).items():
+            options = self._batch_options(test_id)
+            if options is None:
+                continue
+            batch_tests.append(test_id)
+            batch_size, max_wait = options
+            waited = (now - oldest).total_seconds() if oldest else max_wait
+            if count < batch_size and waited < max_wait:
+                left = max_wait - waited
+                next_due = left if next_due is None else min(next_due, left)
+                continue
+
+            with self._lock:
+                if room <= 0 or test_id in self._batches:
+                    continue
+                try:
+                    self.scheduler.submit(test_id, self._execute_batch, test_id, batch_size,
+                                          limit=self._limit(test_id))
+                except QueueFullError:
+                    continue
+                self._batches.add(test_id)
+                room -= 1
+        return batch_tests, next_due
+
+    def cancel(self, result_id: ObjectId) -> Optional[str]:
+        """ Cancels processing of a result (see JobQueue.cancel), kills it right away if it runs here """
+        state = self.queue.cancel(result_id)
+        with self._lock:
+            cancel = self._cancel_events.get(result_id, None)
+        if cancel is not None:
+            cancel()
+        return state
+
+    def poll(self) -> Optional[float]:
+        """ Single iteration of the background loop, returns seconds until the next batch is due """
+        with self._lock:
+            running = list(self._running)
+        self.queue.renew(running)
+        for result_id in self.queue.cancel_requested(running):
+            with self._lock:
+                cancel = self._cancel_events.get(result_id, None)
+            if cancel is not None:
+                cancel()
+        self.queue.recover_expired()
+
+        room = self.scheduler.queue_size - self.scheduler.depth if self.scheduler.queue_size else 100
+        if room <= 0:
+            return None
+
+        batch_tests, next_due = [], None
+        if self.batch_handler is not None:
+            batch_tests, next_due = self._poll_batches(room)
+            room = self.scheduler.queue_size - self.scheduler.depth if self.scheduler.queue_size else 100
+            if room <= 0:
+                return next_due
+
+        with self._lock:
+            queued = list(self._queued)
+        for result_id, test_id in self.queue.due(limit=room, exclude=queued, tests=self.tests,
+                                                 exclude_tests=batch_tests):
+            if not self.notify(result_id, test_id):
+                break
+        return next_due
+
+    def _loop(self):
+        # The first poll recovers leases expired while this process (or others) was down
+        while not self._stopping:
+            next_due = None
+            try:
+                next_due = self.poll()
+            except Exception as err:
+                logger.exception(err)
+            timeout = self.poll_seconds if next_due is None else min(self.poll_seconds, next_due)
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
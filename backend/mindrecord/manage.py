@@ -1,24 +1,45 @@
 import logging
 
 from mindrecord.app import config
-from mindrecord.utils import Request, Response, JsonResponse, HTTPError, Status
+from mindrecord.utils import Request, Response, JsonResponse, HTTPError, Status, BodyLimits
+from mindrecord.indexes import ensure_indexes_on_startup
 from mindrecord.urls import router
+import mindrecord.test_views as test_views
 
 _logger = logging.getLogger(__name__)
+_body_limits = BodyLimits(max_body_size=int(config.REQUEST_MAX_BODY_BYTES),
+                          max_fields=int(config.REQUEST_MAX_FIELDS),
+                          max_file_size=int(config.REQUEST_MAX_FILE_BYTES),
+                          max_field_size=int(config.REQUEST_MAX_FIELD_BYTES),
+                          spool_dir=config.REQUEST_UPLOAD_DIR)
+
+
+def startup():
+    """ Creates the indexes, then starts the background work querying them. Call before serving application """
+    ensure_indexes_on_startup()
+    test_views.start_background()
 
 
 def application(env, start_response):
+    request = None
+    body = None
     try:
-        request = Request(env)
+        request = Request(env, limits=_body_limits)
         response = router.dispatch(request)
         if not response or not isinstance(response, Response):
             raise HTTPError(Status.INTERNAL_SERVER_ERROR, message='Unable to respond')
-        else:
-            _logger.info('{} {} {}'.format(request.method, request.path, response.status_string))
+        # Files are sent by the server itself (wsgi.file_wrapper) when it is able to,
+        # they are opened here: a file removed since the view answered is not found
+        try:
+            body = response.as_wsgi(env)
+        except OSError:
+            raise HTTPError(Status.NOT_FOUND)
+        _logger.info('{} {} {}'.format(request.method, request.path, response.status_string))
     except HTTPError as http_error:
         response = JsonResponse({'message': http_error.message},
                                 status_code=http_error.status_code,
-                                status_message=http_error.status_message)
+                                status_message=http_error.status_message,
+                                headers=dict(http_error.headers))
         _logger.error('{} {} {}: message={}'.format(
             env.get('REQUEST_METHOD', ''),
             env.get('PATH_INFO', ''),
@@ -28,10 +49,15 @@ def application(env, start_response):
         response = JsonResponse({'message': 'Internal server error, please contact server administrator'}, status_code=500)
         _logger.error('{0} {1}'.format(env.get('PATH_INFO', ''), response.status_string))
         _logger.exception(error, exc_info=True)
-    if response is not None:
-        start_response(response.status_string, response.headers_as_tuples())
-        for chunk in response:
-            yield chunk
+    finally:
+        # Uploads not saved by the view are not needed to send the response
+        if request is not None:
+            request.close()
+
+    if body is None:
+        body = response.as_wsgi(env)
+    start_response(response.status_string, response.headers_as_tuples())
+    return body
 
 
 if __name__ == '__main__':
@@ -49,6 +75,9 @@ if __name__ == '__main__':
     access_host = 'localhost' if args.host.endswith('.0') else args.host
     logging.info('Starting WSGI server on: http://{0}:{1}'.format(access_host, args.port))
 
+    startup()
+
     # Running
-    server = wsgiserver.WSGIServer(application, host=args.host, port=args.port, server_name=args.name)
+    server = wsgiserver.WSGIServer(application, host=args.host, port=args.port, server_name=args.name,
+                                   numthreads=int(config.SERVER_THREADS))
     server.start()
@@ -0,0 +1,144 @@
+import datetime
+import hashlib
+import json
+import logging
+import threading
+from typing import Optional
+from pymongo.collection import Collection
+
+from mindrecord.app import config, db
+from mindrecord import registry
+
+
+__all__ = ['ResultCache', 'result_cache', 'processing_version']
+
+logger = logging.getLogger(__name__)
+
+
+def processing_version(test: dict) -> str:
+    """ Hash of everything in the test configuration that affects processing outputs.
+        Bump processing.version in the test configuration when the processing script changes.
+    """
+    desc = {'processing': test.get('processing', None), 'outputs': test.get('outputs', None)}
+    return hashlib.sha256(json.dumps(desc, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class ResultCache(object):
+    """ Content-addressed cache of processing outputs, shared by all processes through the database.
+
+        Key is a hash of the test id, its processing version and the submitted inputs
+        (without '_'-prefixed metadata), so identical submissions skip processing.
+        Entries expire after a TTL, the least recently used ones are evicted above max_entries.
+    """
+    def __init__(self, collection: Collection, max_entries: int=10000, ttl_seconds: int=7 * 24 * 60 * 60,
+                 max_entry_bytes: int=1024 * 1024, evict_every: int=100):
+        self.collection = collection
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_entry_bytes = max_entry_bytes
+        self.evict_every = evict_every
+
+        self._lock = threading.Lock()
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(test: dict, inputs: dict, files: dict=None) -> str:
+        normalized = {k: v for k, v in inputs.items() if not k.startswith('_')}
+        desc = {
+            'test': test.get('id'),
+            'version': processing_version(test),
+            'inputs': normalized,
+            # Uploaded files are identified by contents, not by names
+            'files': {k: v.get('sha256') for k, v in (files or {}).items()},
+        }
+        return hashlib.sha256(json.dumps(desc, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def key_for(self, test: dict, input_path: str, files: dict=None) -> Optional[str]:
+        try:
+            with open(input_path, 'r', encoding='utf-8') as f:
+                inputs = json.load(f)
+        except (OSError, ValueError) as err:
+            logger.warning('Unable to read inputs for caching: {0}'.format(err))
+            return None
+        return self.make_key(test, inputs, files=files)
+
+    def get(self, key: str) -> Optional[dict]:
+        now = datetime.datetime.utcnow()
+        entry = self.collection.find_one_and_update(
+            {'_id': key, 'expires': {'$gt': now}},
+            {'$set': {'last_used': now}, '$inc': {'hits': 1}},
+            projection={'data': True})
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry.get('data') if entry is not None else None
+
+    def put(self, key: str, test: dict, data: dict, ttl_seconds: int=None):
+        if len(json.dumps(data, default=str)) > self.max_entry_bytes:
+            return
+        now = datetime.datetime.utcnow()
+        self.collection.update_one({'_id': key}, {'$set': {
+            'test': test.get('id'),
+            'version': processing_version(test),
+            'data': data,
+            'created': now,
+            'last_used': now,
+            'expires': now + datetime.timedelta(seconds=ttl_seconds or self.ttl_seconds),
+        }, '$setOnInsert': {'hits': 0}}, upsert=True)
+
+        with self._lock:
+            self._puts += 1
+            evict = self._puts % self.evict_every == 0
+        if evict:
+            self.evict()
+
+    def evict(self) -> int:
+        """ Removes least recently used entries above max_entries """
+        excess = self.collection.estimated_document_count() - self.max_entries
+        if excess <= 0:
+            return 0
+        cursor = self.collection.find({}, projection={'_id': True}).sort('last_used', 1).limit(excess)
+        removed = self.collection.delete_many({'_id': {'$in': [doc['_id'] for doc in cursor]}}).deleted_count
+        logger.debug('Evicted {0} cached processing results'.format(removed))
+        return removed
+
+    def invalidate(self, test_id: str, keep_version: str=None) -> int:
+        """ Removes entries of a test (except for the given processing version) """
+        query = {'test': test_id}
+        if keep_version is not None:
+            query['version'] = {'$ne': keep_version}
+        removed = self.collection.delete_many(query).deleted_count
+        if removed:
+            logger.info('Invalidated {0} cached processing results of {1}'.format(removed, test_id))
+        return removed
+
+    def stats(self) -> dict:
+        entries = self.collection.estimated_document_count()
+        with self._lock:
+            return {
+                'entries': entries,
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+result_cache = ResultCache(db['processing_cache'],
+                           max_entries=int(config.PROCESSING_CACHE_MAX_ENTRIES),
+                           ttl_seconds=int(config.PROCESSING_CACHE_TTL_SECONDS))
+
+
+def _on_test_changed(test_id: str, old_test: Optional[dict], new_test: Optional[dict]):
+    if old_test is None:
+        return
+    if new_test is None:
+        result_cache.invalidate(test_id)
+    elif processing_version(old_test) != processing_version(new_test):
+        result_cache.invalidate(test_id, keep_version=processing_version(new_test))
+
+
+registry.add_change_listener(_on_test_changed)
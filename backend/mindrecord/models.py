@@ -5,7 +5,27 @@ from mindrecord.utils import HTTPError, Status
 from mindrecord.app import db
 
 
-__all__ = ['TestResult', 'FieldError']
+__all__ = ['TestResult', 'FieldError', 'States']
+
+
+class States(object):
+    # Submitted, waiting for processing
+    RAW = 'raw'
+
+    # Claimed by a processing worker (leased)
+    PROCESSING = 'processing'
+
+    # Outputs are stored in data
+    PROCESSED = 'processed'
+
+    # Processing failed and won't be retried
+    FAIL = 'fail'
+
+    # Processing exceeded its wall-clock timeout
+    TIMEOUT = 'timeout'
+
+    # Processing was cancelled or killed (signal, resource limits)
+    KILLED = 'killed'
 
 
 class FieldError(RuntimeError):
@@ -148,12 +168,17 @@ class TestResult(MongoModel):
     collection = db['results']
 
     id = Field(dtype=ObjectId, allow_none=False, db_field='_id', default_value=lambda: ObjectId())
-    state = Field(dtype=str, allow_none=False, default_value='raw')
+    state = Field(dtype=str, allow_none=False, default_value=States.RAW)
     created = Field(dtype=datetime.datetime, allow_none=False, default_value=datetime.datetime.utcnow)
+    available = Field(dtype=datetime.datetime, allow_none=True, default_value=datetime.datetime.utcnow)
+    attempts = Field(dtype=int, allow_none=False, default_value=0)
+    error = Field(dtype=str, allow_none=True)
     processed = Field(dtype=datetime.datetime, allow_none=True)
     user = Field(dtype=ObjectId, allow_none=False)
     test = Field(dtype=str, allow_none=True)
     data = Field(dtype=dict, allow_none=True)
+    # Uploaded file inputs: {input: {filename, original_filename, content_type, size, sha256}}
+    files = Field(dtype=dict, allow_none=True)
     directory = Field(dtype=str, allow_none=False)
     raw_file = Field(dtype=str, allow_none=False)
     output_file = Field(dtype=str, allow_none=False)
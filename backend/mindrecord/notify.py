@@ -0,0 +1,164 @@
+import logging
+import threading
+import time
+from typing import Optional
+from bson import ObjectId
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+
+
+__all__ = ['ResultWatcher']
+
+logger = logging.getLogger(__name__)
+
+
+class _Waiter(object):
+    def __init__(self, state: str):
+        self.state = state
+        self.event = threading.Event()
+        self.result = None
+
+
+class ResultWatcher(object):
+    """ Wakes up requests waiting for a result to leave a known state.
+
+        All waiters of the process are served by a single thread: changes come from a change
+        stream on the collection where the deployment supports it (replica sets), otherwise
+        the states of all awaited results are checked with one $in query per poll interval.
+        Results changed by this process are published to the watcher and checked right away.
+    """
+    def __init__(self, collection: Collection,
+                 projection: list=None,
+                 poll_seconds: float=1.0,
+                 max_waiters: int=1000,
+                 change_streams=True):
+        self.collection = collection
+        self.projection = projection
+        self.poll_seconds = poll_seconds
+        self.max_waiters = max_waiters
+        self.change_streams = change_streams
+
+        self._lock = threading.Lock()
+        self._waiters = {}
+        self._count = 0
+        # Results to check on the next iteration: new waiters and published changes
+        self._dirty = set()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._stopping = False
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._loop, name='result-watcher', daemon=True)
+            self._thread.start()
+
+    def stop(self, wait=True):
+        self._stopping = True
+        self._wakeup.set()
+        thread, self._thread = self._thread, None
+        if thread is not None and wait:
+            thread.join()
+
+    @property
+    def waiting(self) -> int:
+        return self._count
+
+    @property
+    def is_full(self) -> bool:
+        return bool(self.max_waiters) and self._count >= self.max_waiters
+
+    def publish(self, result_ids: list):
+        """ Notifies about results changed in this process """
+        with self._lock:
+            awaited = [result_id for result_id in result_ids if result_id in self._waiters]
+            self._dirty.update(awaited)
+        if awaited:
+            self._wakeup.set()
+
+    def wait(self, result_id: ObjectId, state: str, timeout: float) -> Optional[dict]:
+        """ Blocks until the result leaves the state, returns the result or None on timeout """
+        self.start()
+        waiter = _Waiter(state)
+        with self._lock:
+            self._waiters.setdefault(result_id, []).append(waiter)
+            self._count += 1
+            # The state may have changed right before the waiter was registered
+            self._dirty.add(result_id)
+        try:
+            waiter.event.wait(timeout)
+            return waiter.result
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(result_id, [])
+                waiters.remove(waiter)
+                if not waiters:
+                    self._waiters.pop(result_id, None)
+                self._count -= 1
+
+    def _deliver(self, result: dict):
+        with self._lock:
+            waiters = list(self._waiters.get(result['_id'], []))
+        for waiter in waiters:
+            if result.get('state') != waiter.state:
+                waiter.result = result
+                waiter.event.set()
+
+    def _check(self, result_ids: list):
+        projection = None
+        if self.projection is not None:
+            projection = dict.fromkeys(self.projection, True)
+            projection['state'] = True
+        for result in self.collection.find({'_id': {'$in': result_ids}}, projection=projection):
+            self._deliver(result)
+
+    def _open_stream(self):
+        if not self.change_streams:
+            return None
+        pipeline = [{'$match': {'$or': [
+            {'operationType': 'replace'},
+            {'updateDescription.updatedFields.state': {'$exists': True}},
+        ]}}]
+        try:
+            return self.collection.watch(pipeline, full_document='updateLookup',
+                                         max_await_time_ms=int(self.poll_seconds * 1000))
+        except Exception as err:
+            logger.info('Change streams are not available, polling for result changes: {0}'.format(err))
+            self.change_streams = False
+            return None
+
+    def _loop(self):
+        stream = self._open_stream()
+        last_poll = 0.0
+        while not self._stopping:
+            try:
+                if stream is not None:
+                    try:
+                        # Blocks for up to poll_seconds if there are no changes
+                        change = stream.try_next()
+                        result = change.get('fullDocument', None) if change else None
+                        if result is not None:
+                            self._deliver(result)
+                    except PyMongoError as err:
+                        logger.warning('Change stream failed, polling for result changes: {0}'.format(err))
+                        stream.close()
+                        stream = None
+                else:
+                    self._wakeup.wait(self.poll_seconds)
+                self._wakeup.clear()
+
+                with self._lock:
+                    result_ids = self._dirty & set(self._waiters)
+                    self._dirty = set()
+                    if stream is None and time.monotonic() - last_poll >= self.poll_seconds:
+                        result_ids.update(self._waiters)
+                        last_poll = time.monotonic()
+                if result_ids:
+                    self._check(list(result_ids))
+            except Exception as err:
+                logger.exception(err)
+                time.sleep(self.poll_seconds)
+        if stream is not None:
+            stream.close()
@@ -0,0 +1,122 @@
+import concurrent.futures
+import threading
+import time
+
+import bcrypt
+
+from mindrecord.utils import HTTPError, Status, Timings
+
+
+__all__ = ['PasswordHasher']
+
+
+def _hash_password(password: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check_password(password: bytes, hashed: bytes) -> bool:
+    return bcrypt.checkpw(password, hashed)
+
+
+class PasswordHasher(object):
+    """ bcrypt in a dedicated pool of worker threads (bcrypt releases the GIL while hashing,
+        so other requests keep running).
+
+        At most `workers` hashes run at once and `queue_size` more wait, further requests are
+        rejected with 429 so a burst of logins does not hold every server thread.
+        With workers=0 hashing runs in the calling thread.
+    """
+    def __init__(self, rounds: int=10, workers: int=2, queue_size: int=32, timeout: float=10,
+                 retry_after: int=1):
+        self.rounds = rounds
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.retry_after = retry_after
+
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = 0
+
+        self.wait_timings = Timings()
+        self.run_timings = Timings()
+        self.completed = 0
+        self.rejected = 0
+
+    def _get_executor(self) -> concurrent.futures.Executor:
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                                   thread_name_prefix='passwords')
+        return self._executor
+
+    def _run(self, fn: callable, *args):
+        started = time.monotonic()
+        if self.workers <= 0:
+            result = fn(*args)
+            self.run_timings.add(time.monotonic() - started)
+            with self._lock:
+                self.completed += 1
+            return result
+
+        with self._lock:
+            if self._pending >= self.workers + self.queue_size:
+                self.rejected += 1
+                raise HTTPError(Status.TOO_MANY_REQUESTS, message='Too many logins, try again later',
+                                headers={'Retry-After': str(self.retry_after)})
+            future = self._get_executor().submit(_timed, fn, *args)
+            self._pending += 1
+        # Released when the job is done, not when the request stops waiting for it
+        future.add_done_callback(self._done)
+
+        try:
+            result, run_seconds = future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            raise HTTPError(Status.SERVICE_UNAVAILABLE, message='Password check timed out',
+                            headers={'Retry-After': str(self.retry_after)})
+        self.run_timings.add(run_seconds)
+        self.wait_timings.add(max(0.0, time.monotonic() - started - run_seconds))
+        return result
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+            if not future.cancelled() and future.exception() is None:
+                self.completed += 1
+
+    def hash(self, password: str) -> bytes:
+        return self._run(_hash_password, password.encode('utf-8'), self.rounds)
+
+    def verify(self, password: str, hashed: bytes) -> bool:
+        return self._run(_check_password, password.encode('utf-8'), hashed)
+
+    def needs_rehash(self, hashed: bytes) -> bool:
+        """ Whether the hash was made with other rounds than configured ($2b$<rounds>$...) """
+        try:
+            return int(hashed.split(b'$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return False
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = self._pending
+        return {
+            'rounds': self.rounds,
+            'workers': self.workers,
+            'pending': pending,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'wait': self.wait_timings.as_dict(),
+            'run': self.run_timings.as_dict(),
+        }
+
+
+def _timed(fn: callable, *args) -> tuple:
+    # Result with the time spent in fn (without waiting in the queue)
+    started = time.monotonic()
+    return fn(*args), time.monotonic() - started
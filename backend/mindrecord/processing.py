@@ -1,17 +1,230 @@
 import subprocess
 import os
+import signal
+import sys
 import logging
 import json
+import shutil
+import threading
+import time
+from bson import ObjectId
 
 from mindrecord.app import config
+from mindrecord.models import States
+from mindrecord.memo import result_cache
 
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, resource limits are not applied there
+    resource = None
 
-__all__ = ['run']
+
+# Sets rlimits in a fresh interpreter and execs the command: applied before the command runs,
+# without preexec_fn (which may deadlock the child of a multi-threaded process)
+_RLIMITS_EXEC = (
+    'import os, resource, sys\n'
+    'args = sys.argv[1:]\n'
+    'split = args.index("--")\n'
+    'for limit in args[:split]:\n'
+    '    name, value = limit.split("=")\n'
+    '    resource.setrlimit(getattr(resource, "RLIMIT_" + name), (int(value), int(value)))\n'
+    'os.execvp(args[split + 1], args[split + 1:])\n'
+)
+
+
+__all__ = ['run', 'process_result', 'process_batch', 'Limits',
+           'ProcessingError', 'ProcessingTimeout', 'ProcessingKilled',
+           'Runner', 'RunnerPool', 'get_runner_pool']
 
 logger = logging.getLogger(__name__)
 
 
-def run(cmd: list, input_path: str, output_path: str, work_dir: str=None):
+class ProcessingError(RuntimeError):
+    # State of the result if processing is not retried
+    state = States.FAIL
+
+    def __init__(self, message: str, retry=True):
+        super().__init__(message)
+        self.message = message
+        self.retry = retry
+
+
+class ProcessingTimeout(ProcessingError):
+    state = States.TIMEOUT
+
+    def __init__(self, message: str='Processing timed out'):
+        super().__init__(message, retry=False)
+
+
+class ProcessingKilled(ProcessingError):
+    state = States.KILLED
+
+    def __init__(self, message: str='Processing was killed'):
+        super().__init__(message, retry=False)
+
+
+class Limits(object):
+    """ Wall-clock timeout and resource limits of processing processes.
+        Configured per test in processing section:
+            "timeout": <seconds>, "limits": {"cpu": <seconds>, "memory": <MB>, "files": <count>}
+        falling back to PROCESSING_TIMEOUT_SECONDS and PROCESSING_LIMIT_* settings.
+    """
+    def __init__(self, timeout: float=None, cpu: int=None, memory: int=None, files: int=None):
+        self.timeout = timeout
+        self.cpu = cpu
+        self.memory = memory
+        self.files = files
+
+    @classmethod
+    def from_test(cls, test: dict) -> 'Limits':
+        processing_desc = test.get('processing', None) or {}
+        limits_desc = processing_desc.get('limits', None) or {}
+
+        def _value(value, dtype=int):
+            return dtype(value) if value else None
+
+        return cls(timeout=_value(processing_desc.get('timeout', config.PROCESSING_TIMEOUT_SECONDS), float),
+                   cpu=_value(limits_desc.get('cpu', config.PROCESSING_LIMIT_CPU_SECONDS)),
+                   memory=_value(limits_desc.get('memory', config.PROCESSING_LIMIT_MEMORY_MB)),
+                   files=_value(limits_desc.get('files', config.PROCESSING_LIMIT_OPEN_FILES)))
+
+    def _as_tuple(self) -> tuple:
+        return self.timeout, self.cpu, self.memory, self.files
+
+    def __eq__(self, other):
+        return isinstance(other, Limits) and self._as_tuple() == other._as_tuple()
+
+    def command(self, cmd: list, cpu=True) -> list:
+        """ Command which runs cmd with the rlimits (through _RLIMITS_EXEC).
+            CPU limit is per process lifetime, so it is not applied to long-lived processes (cpu=False).
+        """
+        if resource is None:
+            return cmd
+        limits = []
+        if cpu and self.cpu:
+            limits.append('CPU={0}'.format(self.cpu))
+        if self.memory:
+            limits.append('AS={0}'.format(self.memory * 1024 * 1024))
+        if self.files:
+            limits.append('NOFILE={0}'.format(self.files))
+        if not limits:
+            return cmd
+        return [sys.executable, '-I', '-S', '-c', _RLIMITS_EXEC] + limits + ['--'] + list(cmd)
+
+    @staticmethod
+    def popen_kwargs() -> dict:
+        """ Starts the process in its own process group (so it can be killed with its children) """
+        if os.name != 'posix':
+            return {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+        return {'start_new_session': True}
+
+
+def _kill(process: subprocess.Popen):
+    """ Kills the process together with its process group (children may outlive the process itself) """
+    try:
+        if os.name == 'posix':
+            os.killpg(process.pid, signal.SIGKILL)
+        elif process.poll() is None:
+            subprocess.call(['taskkill', '/F', '/T', '/PID', str(process.pid)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError:
+        pass
+    if process.poll() is None:
+        try:
+            process.kill()
+        except OSError:
+            pass
+
+
+class _Watchdog(object):
+    """ Kills a process when the timeout expires or cancel is set """
+    def __init__(self, process: subprocess.Popen, timeout: float=None, cancel: threading.Event=None,
+                 interval: float=0.5):
+        self.process = process
+        self.timeout = timeout
+        self.cancel = cancel
+        self.interval = interval
+        self.fired = None
+        self._done = threading.Event()
+        self._thread = None
+        if timeout or cancel is not None:
+            self._thread = threading.Thread(target=self._watch, name='watchdog', daemon=True)
+            self._thread.start()
+
+    def _watch(self):
+        deadline = time.monotonic() + self.timeout if self.timeout else None
+        while not self._done.wait(self.interval):
+            if self.cancel is not None and self.cancel.is_set():
+                self.fired = ProcessingKilled('Processing was cancelled')
+            elif deadline is not None and time.monotonic() >= deadline:
+                self.fired = ProcessingTimeout('Processing timed out after {0} seconds'.format(self.timeout))
+            else:
+                continue
+            logger.warning('Killing process {0}: {1}'.format(self.process.pid, self.fired))
+            _kill(self.process)
+            return
+
+    def stop(self):
+        """ Stops watching, raises if the process was killed """
+        self._done.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.fired is not None:
+            raise self.fired
+
+
+class _LogWriter(object):
+    """ Copies a process output stream to a log file chunk by chunk.
+        Output beyond max_bytes is drained and dropped, a truncation marker is written instead.
+        The file is created with the first chunk unless create is set.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, stream, path: str, max_bytes: int=None, create=True):
+        self.stream = stream
+        self.path = path
+        self.max_bytes = max_bytes
+        self.written = 0
+        self.truncated = False
+        self._file = open(path, 'wb') if create else None
+        self._thread = threading.Thread(target=self._copy, name='log-writer', daemon=True)
+        self._thread.start()
+
+    def _write(self, data: bytes):
+        if self._file is None:
+            self._file = open(self.path, 'wb')
+        self._file.write(data)
+        # Flushed right away so the log can be followed while processing runs
+        self._file.flush()
+        self.written += len(data)
+
+    def _copy(self):
+        try:
+            for data in iter(lambda: self.stream.read1(self.CHUNK_SIZE), b''):
+                if self.truncated:
+                    continue
+                if self.max_bytes and self.written + len(data) > self.max_bytes:
+                    self._write(data[:self.max_bytes - self.written])
+                    self._write('\n[... truncated: log exceeds {0} bytes ...]\n'.format(self.max_bytes).encode('utf-8'))
+                    self.truncated = True
+                    continue
+                self._write(data)
+        finally:
+            self.stream.close()
+            if self._file is not None:
+                self._file.close()
+
+    def join(self):
+        self._thread.join()
+
+
+def run(cmd: list, input_path: str, output_path: str, work_dir: str=None,
+        limits: Limits=None, cancel: threading.Event=None):
+    """ Runs processing: cmd <input_path> <output_path>, returns parsed output or None on failure.
+        Raises ProcessingTimeout/ProcessingKilled if the process was killed.
+    """
+    limits = limits or Limits()
     abs_input_path = os.path.abspath(input_path)
     abs_output_path = os.path.abspath(output_path)
     input_dir = os.path.dirname(abs_input_path)
@@ -23,34 +236,359 @@ def run(cmd: list, input_path: str, output_path: str, work_dir: str=None):
     stdout_path = os.path.join(input_dir, config.TESTS_PROCESSING_LOG)
     stderr_path = os.path.join(input_dir, config.TESTS_PROCESSING_ERROR_LOG)
 
-    process = subprocess.Popen(cmd + [abs_input_path, abs_output_path],
+    process = subprocess.Popen(limits.command(cmd + [abs_input_path, abs_output_path]),
                                stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE,
-                               cwd=work_dir)
-    stdout, stderr = process.communicate()
-    logger.debug('Processing {0} finished with code: {1}'.format(cmd, process.returncode))
+                               cwd=work_dir,
+                               **limits.popen_kwargs())
+    watchdog = _Watchdog(process, timeout=limits.timeout, cancel=cancel)
 
-    # Log process outputs
-    with open(stdout_path, 'wb') as f:
-        f.write(stdout)
+    # Stream process outputs to the logs (error log only if there is something to write)
+    max_log_bytes = int(config.PROCESSING_LOG_MAX_BYTES or 0)
+    stdout_writer = _LogWriter(process.stdout, stdout_path, max_bytes=max_log_bytes)
+    stderr_writer = _LogWriter(process.stderr, stderr_path, max_bytes=max_log_bytes, create=False)
+    try:
+        process.wait()
+    finally:
+        # Children left in the process group would keep the log pipes open
+        _kill(process)
+        stdout_writer.join()
+        stderr_writer.join()
+    logger.debug('Processing {0} finished with code: {1}'.format(cmd, process.returncode))
 
-    if stderr:
-        with open(stderr_path, 'wb') as f:
-            f.write(stderr)
+    watchdog.stop()
+    if process.returncode < 0:
+        # Terminated by a signal: rlimit exceeded, OOM killer or killed externally
+        raise ProcessingKilled('Processing was killed by signal {0}'.format(-process.returncode))
 
     # Check if program is completed with code 0
     if process.returncode != 0:
         logger.debug('Processing {0} failed'.format(cmd))
         return None
 
-    if not os.path.exists(abs_output_path):
+    return _read_output(abs_output_path)
+
+
+def _read_output(output_path: str):
+    if not os.path.exists(output_path):
         logger.debug('No output provided')
         return None
 
     # Try read results from JSON
     try:
-        with open(abs_output_path, encoding='utf-8') as f:
+        with open(output_path, encoding='utf-8') as f:
             return json.load(f)
     except json.JSONDecodeError as err:
         logger.exception(err)
         return None
+
+
+class RunnerError(RuntimeError):
+    pass
+
+
+class Runner(object):
+    """ Long-lived processing process.
+
+        Jobs are sent as JSON lines to the runner's stdin:
+            {"input": "<abs path>", "output": "<abs path>", "stdout": "<abs path>", "stderr": "<abs path>",
+             "max_log_bytes": <size limit of each log, 0 - unlimited>}
+        and the runner answers with a JSON line on its stdout once the output file is written:
+            {"code": 0}
+        Non-zero code means failed processing. stdout of the runner is reserved for the protocol,
+        the job's logs should be written to the given stdout/stderr paths (see mindrecord.runner).
+        The runner should exit when its stdin is closed.
+    """
+    def __init__(self, cmd: list, work_dir: str=None, limits: Limits=None):
+        self.cmd = cmd
+        self.jobs = 0
+        limits = limits or Limits()
+        self.process = subprocess.Popen(limits.command(cmd, cpu=False),
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        cwd=work_dir,
+                                        **limits.popen_kwargs())
+        logger.debug('Runner {0} started: {1}'.format(self.process.pid, cmd))
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def call(self, input_path: str, output_path: str, stdout_path: str, stderr_path: str) -> int:
+        request = {
+            'input': input_path,
+            'output': output_path,
+            'stdout': stdout_path,
+            'stderr': stderr_path,
+            'max_log_bytes': int(config.PROCESSING_LOG_MAX_BYTES or 0),
+        }
+        self.jobs += 1
+        try:
+            self.process.stdin.write(json.dumps(request).encode('utf-8') + b'\n')
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        except (OSError, ValueError) as err:
+            raise RunnerError('Runner {0} is broken: {1}'.format(self.process.pid, err))
+        if not line:
+            raise RunnerError('Runner {0} exited with code {1}'.format(self.process.pid, self.process.poll()))
+        try:
+            return int(json.loads(line.decode('utf-8')).get('code', 1))
+        except (ValueError, AttributeError):
+            raise RunnerError('Runner {0} broke the protocol: {1!r}'.format(self.process.pid, line[:200]))
+
+    def close(self, timeout: float=5):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            _kill(self.process)
+            self.process.wait()
+        logger.debug('Runner {0} stopped after {1} jobs'.format(self.process.pid, self.jobs))
+
+
+class RunnerPool(object):
+    """ Pool of persistent runners of one test.
+        Runners are started on demand (up to size) and recycled after max_jobs jobs, when they crash
+        or when a job is killed (timeout, cancellation).
+    """
+    def __init__(self, cmd: list, work_dir: str=None, size: int=2, max_jobs: int=100, limits: Limits=None):
+        self.cmd = cmd
+        self.work_dir = work_dir
+        self.size = size
+        self.max_jobs = max_jobs
+        self.limits = limits or Limits()
+
+        self._cond = threading.Condition()
+        self._idle = []
+        self._total = 0
+        self._closed = False
+
+    def _acquire(self) -> Runner:
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RunnerError('Runner pool is closed')
+                while self._idle:
+                    runner = self._idle.pop()
+                    if runner.alive:
+                        return runner
+                    self._total -= 1
+                if self._total < self.size:
+                    self._total += 1
+                    break
+                self._cond.wait()
+        try:
+            return Runner(self.cmd, self.work_dir, limits=self.limits)
+        except OSError:
+            self._discard(None)
+            raise
+
+    def _release(self, runner: Runner):
+        if runner.jobs >= self.max_jobs:
+            runner.close()
+            self._discard(None)
+            return
+        with self._cond:
+            if self._closed:
+                runner.close()
+                self._total -= 1
+            else:
+                self._idle.append(runner)
+            self._cond.notify()
+
+    def _discard(self, runner: Runner=None):
+        if runner is not None:
+            _kill(runner.process)
+            runner.process.wait()
+        with self._cond:
+            self._total -= 1
+            self._cond.notify()
+
+    def run(self, input_path: str, output_path: str, cancel: threading.Event=None):
+        """ Same contract as run(): returns parsed output or None """
+        abs_input_path = os.path.abspath(input_path)
+        abs_output_path = os.path.abspath(output_path)
+        input_dir = os.path.dirname(abs_input_path)
+
+        if not os.path.exists(abs_input_path):
+            logger.debug('Input file for processing does not exist')
+            return None
+
+        runner = self._acquire()
+        watchdog = _Watchdog(runner.process, timeout=self.limits.timeout, cancel=cancel)
+        try:
+            code = runner.call(abs_input_path, abs_output_path,
+                               stdout_path=os.path.join(input_dir, config.TESTS_PROCESSING_LOG),
+                               stderr_path=os.path.join(input_dir, config.TESTS_PROCESSING_ERROR_LOG))
+        except RunnerError as err:
+            logger.error(err)
+            self._discard(runner)
+            watchdog.stop()
+            return None
+        except BaseException:
+            self._discard(runner)
+            watchdog.stop()
+            raise
+        try:
+            watchdog.stop()
+        except ProcessingError:
+            # Killed right after the job was done
+            self._discard(runner)
+            raise
+        self._release(runner)
+
+        logger.debug('Processing {0} finished with code: {1}'.format(self.cmd, code))
+        if code != 0:
+            logger.debug('Processing {0} failed'.format(self.cmd))
+            return None
+        return _read_output(abs_output_path)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._total -= len(idle)
+            self._cond.notify_all()
+        for runner in idle:
+            runner.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_runner_pool(test: dict, cmd: list, work_dir: str) -> RunnerPool:
+    """ Runner pool of the test, recreated if the test processing configuration has changed """
+    processing_desc = test.get('processing', {})
+    size = int(processing_desc.get('runners', config.PROCESSING_PERSISTENT_RUNNERS))
+    max_jobs = int(processing_desc.get('max_jobs', config.PROCESSING_PERSISTENT_MAX_JOBS))
+    limits = Limits.from_test(test)
+    test_id = test.get('id')
+
+    with _pools_lock:
+        pool = _pools.get(test_id, None)
+        if pool is not None and (pool.cmd, pool.work_dir, pool.size, pool.max_jobs, pool.limits) == \
+                (cmd, work_dir, size, max_jobs, limits):
+            return pool
+        if pool is not None:
+            pool.close()
+        pool = RunnerPool(cmd, work_dir, size=size, max_jobs=max_jobs, limits=limits)
+        _pools[test_id] = pool
+        return pool
+
+
+def _processing_call(test: dict, default_dir: str=None) -> tuple:
+    """ Processing command and working directory of a test """
+    processing_desc = test.get('processing', None)
+    if not processing_desc:
+        raise ProcessingError('Processing is not configured', retry=False)
+
+    cmd = processing_desc.get('call', None)
+    if isinstance(cmd, str):
+        cmd = [cmd]
+    if not cmd:
+        raise ProcessingError('Processing call is not configured', retry=False)
+
+    cwd = test.get('processing_workdir', test.get('dir', default_dir))
+    if not cwd:
+        raise ProcessingError('Processing workdir is not configured', retry=False)
+    return cmd, cwd
+
+
+def _filter_outputs(data: dict, test: dict) -> dict:
+    # Filter outputs according to test configuration
+    # TODO: verify type
+    return {k: data.get(k, None) for k in test.get('outputs', {})}
+
+
+def process_result(result: dict, test: dict, cancel: threading.Event=None) -> dict:
+    """ Runs test processing for a stored result, returns outputs filtered by test configuration.
+        With processing.cache (true or {"ttl": <seconds>}) outputs for identical inputs are reused.
+    """
+    processing_desc = test.get('processing', None) or {}
+    result_dir = result.get('directory')
+    cmd, cwd = _processing_call(test, result_dir)
+
+    input_path = os.path.join(result_dir, result.get('raw_file', config.TESTS_RESULTS_RAW_FILE))
+    output_path = os.path.join(result_dir, result.get('output_file', config.TESTS_RESULTS_FILE))
+
+    cache_desc = processing_desc.get('cache', False)
+    cache_key = None
+    if cache_desc:
+        cache_key = result_cache.key_for(test, input_path, files=result.get('files', None))
+        data = result_cache.get(cache_key) if cache_key else None
+        if data is not None:
+            logger.debug('Processing of {0} skipped: cached outputs found'.format(result.get('_id')))
+            return data
+
+    if processing_desc.get('mode', None) == 'persistent':
+        data = get_runner_pool(test, cmd, cwd).run(input_path, output_path, cancel=cancel)
+    else:
+        data = run(cmd, input_path, output_path, cwd, limits=Limits.from_test(test), cancel=cancel)
+    if not data:
+        raise ProcessingError('Processing produced no results')
+
+    outputs = _filter_outputs(data, test)
+    if cache_key:
+        ttl = cache_desc.get('ttl', None) if isinstance(cache_desc, dict) else None
+        result_cache.put(cache_key, test, outputs, ttl_seconds=ttl)
+    return outputs
+
+
+def process_batch(results: list, test: dict, cancel: threading.Event=None) -> dict:
+    """ Runs test processing once for several stored results.
+
+        The processing call gets a manifest and a batch output path:
+            call <manifest.json> <results.json>
+        manifest.json: {"test": "<test id>", "results": [{"id": "<result id>", "input": "<raw file>", "output": "<output file>"}]}
+        results.json (written by processing): {"<result id>": {<outputs>}, ...}
+        Returns {result_id: outputs}, outputs are None for results missing in the batch output.
+        Processing logs of the batch are copied to the directory of every result.
+    """
+    batch_id = results[0].get('batch', None) or ObjectId()
+    batch_dir = os.path.join(config.TESTS_RESULTS_DIR, test.get('id'), '_batches', str(batch_id))
+    os.makedirs(batch_dir, exist_ok=True)
+    try:
+        cmd, cwd = _processing_call(test, batch_dir)
+
+        manifest = {
+            'test': test.get('id'),
+            'results': [{
+                'id': str(result['_id']),
+                'input': os.path.abspath(os.path.join(result.get('directory'),
+                                                      result.get('raw_file', config.TESTS_RESULTS_RAW_FILE))),
+                'output': os.path.abspath(os.path.join(result.get('directory'),
+                                                       result.get('output_file', config.TESTS_RESULTS_FILE))),
+            } for result in results]
+        }
+        manifest_path = os.path.join(batch_dir, 'manifest.json')
+        with open(manifest_path, 'w', encoding='utf-8') as fp:
+            json.dump(manifest, fp)
+
+        data = run(cmd, manifest_path, os.path.join(batch_dir, config.TESTS_RESULTS_FILE), cwd,
+                   limits=Limits.from_test(test), cancel=cancel)
+        if not isinstance(data, dict):
+            raise ProcessingError('Batch processing produced no results')
+
+        outputs = {}
+        for result in results:
+            result_data = data.get(str(result['_id']), None)
+            outputs[result['_id']] = _filter_outputs(result_data, test) if isinstance(result_data, dict) else None
+        return outputs
+    finally:
+        _copy_logs(batch_dir, results)
+        # Outputs are in the result directories or returned, the manifest and batch output are not needed
+        shutil.rmtree(batch_dir, ignore_errors=True)
+
+
+def _copy_logs(batch_dir: str, results: list):
+    """ Processing logs of a batch go to every result of it (the logs of a result are read from its directory) """
+    for name in (config.TESTS_PROCESSING_LOG, config.TESTS_PROCESSING_ERROR_LOG):
+        log_path = os.path.join(batch_dir, name)
+        if not os.path.isfile(log_path):
+            continue
+        for result in results:
+            try:
+                shutil.copyfile(log_path, os.path.join(result.get('directory'), name))
+            except OSError as err:
+                logger.warning('Unable to copy {0} of batch to result {1}: {2}'.format(name, result['_id'], err))
@@ -0,0 +1,487 @@
+import datetime
+import logging
+import os
+import json
+import glob
+import threading
+import time
+from collections.abc import Mapping
+from types import MappingProxyType
+
+from pymongo import ReturnDocument
+from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from mindrecord.app import config, db
+from mindrecord.utils import AssetManifest
+from mindrecord.jobs import make_owner_id
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    # Optional, configs are polled
+    Observer = None
+
+
+__all__ = ['tests', 'load_test_from_config', 'load_tests', 'get_test', 'get_web_manifest', 'add_change_listener',
+           'TestsWatcher', 'tests_watcher', 'SharedRegistry', 'shared_registry', 'sync_tests', 'init_tests', 'publish_tests',
+           'refresh_web_manifests']
+
+logger = logging.getLogger(__name__)
+_change_listeners = []
+
+
+class _Snapshot(object):
+    """ Loaded state of the registry, replaced as a whole and never modified """
+    def __init__(self, tests: dict=None, manifests: dict=None, files: dict=None, version: int=0,
+                 published: bool=True):
+        self.tests = MappingProxyType(tests or {})
+        # Test id -> AssetManifest of its web_workdir
+        self.manifests = MappingProxyType(manifests or {})
+        # Config path -> ((mtime_ns, size), test or None if the config is invalid)
+        self.files = MappingProxyType(files or {})
+        # Version in the shared registry
+        self.version = version
+        # False if the tests still have to be published (see TestsWatcher)
+        self.published = published
+
+
+_snapshot = _Snapshot()
+_load_lock = threading.Lock()
+
+
+class SharedRegistry(object):
+    """ Tests published to the database, so all processes serve the same tests.
+
+        A process which loads the configs publishes them with an incremented version, the other
+        processes replace their snapshot when they see a newer version. The version is checked
+        by the tests watcher (never by requests) at most every check_seconds with a single query
+        which returns the tests only if they are newer.
+        The loader lease lets a single process watch the configs.
+        Paths in test configs are published as is, so all processes should see the same filesystem.
+    """
+    DOCUMENT_ID = 'tests'
+
+    def __init__(self, collection: Collection, check_seconds: float=1.0, owner: str=None):
+        self.collection = collection
+        self.check_seconds = check_seconds
+        self.owner = owner or make_owner_id()
+
+        self._lock = threading.Lock()
+        self._checked = 0.0
+
+    def publish(self, tests: dict) -> int:
+        """ Publishes tests, returns their version """
+        document = self.collection.find_one_and_update(
+            {'_id': self.DOCUMENT_ID},
+            {
+                '$inc': {'version': 1},
+                # Stored as a string: test configs may have keys with dots
+                '$set': {'tests': json.dumps(tests), 'updated': datetime.datetime.utcnow(), 'publisher': self.owner},
+            },
+            projection={'version': True},
+            upsert=True,
+            return_document=ReturnDocument.AFTER)
+        return document['version']
+
+    def fetch(self, version: int, force: bool=False):
+        """ (version, tests) if a version newer than version is published, otherwise None.
+            Without force the database is queried at most every check_seconds
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._checked < self.check_seconds:
+                return None
+            self._checked = now
+        document = self.collection.find_one({'_id': self.DOCUMENT_ID, 'version': {'$gt': version}})
+        if document is None or not document.get('tests', None):
+            return None
+        return document['version'], json.loads(document['tests'])
+
+    def acquire_loader(self, lease_seconds: float) -> bool:
+        """ Takes or renews the loader lease, False if another process holds it """
+        now = datetime.datetime.utcnow()
+        try:
+            document = self.collection.find_one_and_update(
+                {'_id': self.DOCUMENT_ID,
+                 '$or': [{'loader': self.owner}, {'loader_expires': {'$lt': now}}, {'loader_expires': None}]},
+                {'$set': {'loader': self.owner, 'loader_expires': now + datetime.timedelta(seconds=lease_seconds)}},
+                projection={'_id': True},
+                upsert=True)
+        except DuplicateKeyError:
+            # Held by another process
+            return False
+        return True
+
+    def release_loader(self):
+        self.collection.update_one({'_id': self.DOCUMENT_ID, 'loader': self.owner},
+                                   {'$unset': {'loader': '', 'loader_expires': ''}})
+
+
+shared_registry = SharedRegistry(db['test_registry'],
+                                 check_seconds=float(config.TESTS_REGISTRY_CHECK_SECONDS)) \
+    if config.TESTS_SHARED_REGISTRY else None
+
+
+def _current() -> _Snapshot:
+    # Reads never touch the database, newer published tests are synced by the tests watcher
+    return _snapshot
+
+
+class _Tests(Mapping):
+    """ Tests by id in the current snapshot. Every call reads a single snapshot,
+        so readers never see a partially loaded registry
+    """
+    def __getitem__(self, test_id: str) -> dict:
+        return _current().tests[test_id]
+
+    def __iter__(self):
+        return iter(_current().tests)
+
+    def __len__(self):
+        return len(_current().tests)
+
+    def __contains__(self, test_id):
+        return test_id in _current().tests
+
+    def get(self, test_id: str, default=None):
+        return _current().tests.get(test_id, default)
+
+    def keys(self):
+        return _current().tests.keys()
+
+    def values(self):
+        return _current().tests.values()
+
+    def items(self):
+        return _current().tests.items()
+
+
+tests = _Tests()
+
+
+def add_change_listener(listener: callable):
+    """ listener(test_id, old_test, new_test) is called for every added, changed or removed test on reload """
+    _change_listeners.append(listener)
+
+
+def _notify_changes(old_tests: dict, new_tests: dict):
+    for test_id in set(old_tests) | set(new_tests):
+        old_test = old_tests.get(test_id, None)
+        new_test = new_tests.get(test_id, None)
+        if old_test == new_test:
+            continue
+        for listener in _change_listeners:
+            try:
+                listener(test_id, old_test, new_test)
+            except Exception as err:
+                logger.exception(err)
+
+
+def load_test_from_config(config_path):
+    if not os.path.exists(config_path):
+        logger.debug('Config path does not exits: {0}'.format(config_path))
+        return None
+
+    try:
+        with open(config_path, 'r', encoding='utf-8') as f:
+            test_config = json.load(f)  # type: dict
+    except json.JSONDecodeError as err:
+        logger.exception(err)
+        logger.debug('Invalid JSON configuration: {0}'.format(config_path))
+        return None
+
+    required_fields = ['id', 'name', 'inputs', 'outputs', 'processing']
+    for field in required_fields:
+        if field not in test_config:
+            logger.warning('Field {0} required'.format(field))
+            return None
+    test_dir = os.path.dirname(config_path)
+    test = test_config.copy()
+    test.update({
+        'dir': test_dir,
+        'config_path': config_path,
+    })
+
+    if 'readme' in test_config:
+        readme_path = os.path.join(test_dir, test_config.get('readme'))
+        if os.path.exists(readme_path):
+            test['readme_path'] = readme_path
+
+    if 'web' in test_config:
+        web_cfg = test_config.get('web')
+        work_dir = web_cfg.get('workdir', './')
+        entry = web_cfg.get('entry', 'index.html')
+        test['web_workdir'] = os.path.join(test_dir, work_dir)
+        test['web_entry'] = os.path.join(test_dir, work_dir, entry)
+
+    if 'processing' in test_config:
+        processing_cfg = test_config.get('processing')
+        work_dir = processing_cfg.get('workdir', './')
+        test['processing_workdir'] = os.path.join(test_dir, work_dir)
+
+    if 'cover' in test_config:
+        cover_path = test_config.get('cover')
+        if cover_path is not None:
+            cover_path = os.path.join(test_dir, cover_path)
+        test['cover_path'] = cover_path
+    return test
+
+
+def _load_web_manifest(test: dict, previous: AssetManifest=None):
+    web_workdir = test.get('web_workdir', None)
+    if not web_workdir:
+        return None
+    if previous is not None and previous.root == os.path.abspath(web_workdir):
+        previous.refresh()
+        return previous
+    return AssetManifest(web_workdir, max_files=int(config.TESTS_WEB_MAX_FILES))
+
+
+def load_tests(force: bool=False, publish: bool=True) -> bool:
+    """ Reads the added and changed (by modification time and size) configs, all of them with force.
+        The new registry replaces the current one at once. Returns False if nothing has changed.
+        Without publish (or if publishing fails) the tests are published later by the tests watcher.
+    """
+    global _snapshot
+    with _load_lock:
+        old_snapshot = _snapshot
+        files = {}
+        for config_path in sorted(glob.glob(config.TESTS_CONFIG_PATTERN)):
+            try:
+                stat = os.stat(config_path)
+            except OSError:
+                continue
+            signature = (stat.st_mtime_ns, stat.st_size)
+            loaded = old_snapshot.files.get(config_path, None)
+            if force or loaded is None or loaded[0] != signature:
+                logger.debug('Reading config: {0}'.format(config_path))
+                loaded = (signature, load_test_from_config(config_path))
+            files[config_path] = loaded
+
+        if not force and files.keys() == old_snapshot.files.keys() and \
+                all(files[path] is old_snapshot.files[path] for path in files):
+            return False
+
+        new_tests = {}
+        for config_path, (_, test) in files.items():
+            if test:
+                logger.debug('Test {0}'.format(test.get('id')))
+                new_tests[test.get('id')] = test
+
+        version = old_snapshot.version
+        published = old_snapshot.published
+        if shared_registry is not None and new_tests != dict(old_snapshot.tests):
+            published = False
+            if publish:
+                version, published = _publish(new_tests, version)
+        _snapshot = _Snapshot(new_tests, _load_web_manifests(new_tests, old_snapshot), files, version, published)
+    _notify_changes(old_snapshot.tests, new_tests)
+    return True
+
+
+def _publish(new_tests: dict, version: int) -> tuple:
+    """ (version, published) """
+    try:
+        return shared_registry.publish(new_tests), True
+    except PyMongoError as err:
+        # Served by this process anyway, the tests watcher publishes them once the database is back
+        logger.warning('Unable to publish tests: {0}'.format(err))
+        return version, False
+
+
+def publish_tests() -> bool:
+    """ Publishes tests of this process if they were not published yet """
+    global _snapshot
+    with _load_lock:
+        old_snapshot = _snapshot
+        if shared_registry is None or old_snapshot.published:
+            return False
+        version, published = _publish(dict(old_snapshot.tests), old_snapshot.version)
+        if not published:
+            return False
+        _snapshot = _Snapshot(old_snapshot.tests, old_snapshot.manifests, old_snapshot.files, version)
+    return True
+
+
+def _load_web_manifests(new_tests: dict, old_snapshot: _Snapshot) -> dict:
+    manifests = {}
+    for test_id, test in new_tests.items():
+        manifest = _load_web_manifest(test, old_snapshot.manifests.get(test_id, None))
+        if manifest is not None:
+            manifests[test_id] = manifest
+    return manifests
+
+
+def sync_tests(force: bool=False) -> bool:
+    """ Replaces the snapshot with tests published by another process if they are newer.
+        Configs are not read, only web manifests of the tests are listed.
+    """
+    global _snapshot
+    if shared_registry is None:
+        return False
+    try:
+        published = shared_registry.fetch(_snapshot.version, force=force)
+    except PyMongoError as err:
+        # The current snapshot is served until the database is back
+        logger.warning('Unable to check the shared registry: {0}'.format(err))
+        return False
+    if published is None:
+        return False
+    version, new_tests = published
+    with _load_lock:
+        old_snapshot = _snapshot
+        if version <= old_snapshot.version:
+            return False
+        # Unchanged tests keep their dicts
+        new_tests = {k: old_snapshot.tests[k] if old_snapshot.tests.get(k, None) == v else v
+                     for k, v in new_tests.items()}
+        # Config stats are unknown, the next load_tests of this process reads every config
+        _snapshot = _Snapshot(new_tests, _load_web_manifests(new_tests, old_snapshot), {}, version)
+    logger.debug('Tests version {0} loaded from the shared registry'.format(version))
+    _notify_changes(old_snapshot.tests, new_tests)
+    return True
+
+
+def init_tests():
+    """ Startup: tests are read from the configs without touching the database,
+        the tests watcher publishes them or replaces them with newer published ones
+    """
+    load_tests(publish=False)
+
+
+def get_test(test_id: str, reload_missing=False):
+    """ Test configuration by id. With reload_missing the configs are re-read if the test is unknown """
+    test = _current().tests.get(test_id, None)
+    if test is None and reload_missing:
+        if shared_registry is None or not sync_tests(force=True) or test_id not in _snapshot.tests:
+            load_tests()
+        test = _snapshot.tests.get(test_id, None)
+    return test
+
+
+def refresh_web_manifests():
+    """ Lists the changed web files of every test again (see AssetManifest.refresh) """
+    for manifest in _snapshot.manifests.values():
+        manifest.refresh()
+
+
+def get_web_manifest(test_id: str):
+    """ AssetManifest of the web files of a test, None if the test has no web part """
+    return _current().manifests.get(test_id, None)
+
+
+def _pattern_root(pattern: str) -> str:
+    """ Deepest directory of a glob pattern without wildcards: 'D:\\Tests\\*\\*.json' -> 'D:\\Tests' """
+    root = os.path.dirname(pattern)
+    while glob.has_magic(root):
+        root = os.path.dirname(root)
+    return root or '.'
+
+
+class TestsWatcher(object):
+    """ Reloads changed test configurations in the background (see load_tests).
+
+        Filesystem events (inotify and others, with the optional watchdog package) trigger
+        a reload right away, configs are also checked every poll_seconds, which is cheap:
+        a glob and a stat per config. With the shared registry only the process holding
+        the loader lease reads the configs, every process loads tests published by others
+        (checked every check_seconds of the shared registry).
+        Web files of the tests are listed again every web_refresh_seconds.
+    """
+    def __init__(self, poll_seconds: float=5.0, use_events: bool=True, debounce_seconds: float=0.5,
+                 web_refresh_seconds: float=10.0):
+        self.poll_seconds = poll_seconds
+        self.web_refresh_seconds = web_refresh_seconds
+        self.use_events = use_events
+        self.debounce_seconds = debounce_seconds
+
+        self._changed = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._observer = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.is_running:
+            return
+        self._stop.clear()
+        if self.use_events and Observer is not None:
+            self._observer = self._start_observer()
+        self._thread = threading.Thread(target=self._loop, name='tests-watcher', daemon=True)
+        self._thread.start()
+
+    def _start_observer(self):
+        root = _pattern_root(config.TESTS_CONFIG_PATTERN)
+        if not os.path.isdir(root):
+            return None
+        handler = FileSystemEventHandler()
+        handler.on_any_event = lambda event: self._changed.set()
+        observer = Observer()
+        try:
+            observer.schedule(handler, root, recursive=True)
+            observer.daemon = True
+            observer.start()
+        except Exception as err:
+            # e.g. inotify watch limit reached
+            logger.warning('Unable to watch {0}, polling test configs: {1}'.format(root, err))
+            return None
+        logger.debug('Watching test configs in {0}'.format(root))
+        return observer
+
+    def stop(self):
+        self._stop.set()
+        self._changed.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _loop(self):
+        interval = min(self.poll_seconds, self.web_refresh_seconds)
+        if shared_registry is not None:
+            interval = min(interval, shared_registry.check_seconds)
+        # Tests loaded on startup are published on the first check
+        checked = 0.0
+        web_refreshed = time.monotonic()
+        while not self._stop.is_set():
+            changed = self._changed.wait(interval)
+            if changed:
+                # Editors write files in several steps
+                self._stop.wait(self.debounce_seconds)
+                self._changed.clear()
+            if self._stop.is_set():
+                break
+            try:
+                if shared_registry is not None:
+                    sync_tests()
+                if time.monotonic() - web_refreshed >= self.web_refresh_seconds:
+                    refresh_web_manifests()
+                    web_refreshed = time.monotonic()
+                if not changed and time.monotonic() - checked < self.poll_seconds:
+                    continue
+                checked = time.monotonic()
+                lease_seconds = 3 * self.poll_seconds + self.debounce_seconds
+                if shared_registry is not None:
+                    if not shared_registry.acquire_loader(lease_seconds):
+                        continue
+                    publish_tests()
+                if load_tests():
+                    logger.info('Test configurations reloaded')
+            except Exception as err:
+                logger.exception(err)
+        if shared_registry is not None:
+            try:
+                shared_registry.release_loader()
+            except Exception as err:
+                logger.exception(err)
+
+
+tests_watcher = TestsWatcher(poll_seconds=float(config.TESTS_RELOAD_POLL_SECONDS),
+                             web_refresh_seconds=float(config.TESTS_WEB_REFRESH_SECONDS))
@@ -0,0 +1,169 @@
+import datetime
+import hashlib
+import logging
+import threading
+import time
+from typing import Optional
+import jwt
+from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from mindrecord.utils import BloomFilter
+
+
+__all__ = ['RevokedTokens']
+
+logger = logging.getLogger(__name__)
+
+# Re-read revocations that far back on every sync, clocks of the processes may differ
+_SYNC_OVERLAP = datetime.timedelta(seconds=60)
+
+
+class RevokedTokens(object):
+    """ Revoked tokens by id (jti claim, sha256 of the token for tokens without it),
+        removed by a TTL index once the token expires (see mindrecord.indexes).
+
+        Lookups go through an in-memory Bloom filter of the revoked ids first,
+        so a token that was not revoked costs no database query. The filter is updated
+        with revocations of other processes every sync_seconds and rebuilt every rebuild_seconds
+        (or when it gets full) to drop expired tokens.
+    """
+    def __init__(self, collection: Collection, capacity: int=100000, error_rate: float=0.001,
+                 sync_seconds: float=10, rebuild_seconds: float=60 * 60):
+        self.collection = collection
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.sync_seconds = sync_seconds
+        self.rebuild_seconds = rebuild_seconds
+
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._migrated = False
+        self._bloom = None  # type: Optional[BloomFilter]
+        self._synced = 0.0
+        self._rebuilt = 0.0
+        # Revocation time of the newest synced entry
+        self._synced_to = None
+
+        self.lookups = 0
+        self.filtered = 0
+        self.false_positives = 0
+
+    @staticmethod
+    def key_for(token: str, payload: dict) -> str:
+        jti = payload.get('jti', None)
+        if jti:
+            return str(jti)
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def _migrate_legacy(self):
+        # Earlier versions stored whole tokens ({'token': ...}) and never removed them
+        if self._migrated:
+            return
+        for document in self.collection.find({'token': {'$exists': True}}):
+            try:
+                payload = jwt.decode(document['token'], options={'verify_signature': False, 'verify_exp': False})
+            except jwt.InvalidTokenError:
+                payload = None
+            if payload is not None and isinstance(payload.get('exp', None), (int, float)):
+                self._insert(self.key_for(document['token'], payload), payload)
+            self.collection.delete_one({'_id': document['_id']})
+        self._migrated = True
+
+    def _insert(self, key: str, payload: dict) -> bool:
+        now = datetime.datetime.utcnow()
+        exp = payload.get('exp', None)
+        if isinstance(exp, (int, float)):
+            expires = datetime.datetime.utcfromtimestamp(exp)
+        else:
+            expires = now + datetime.timedelta(days=30)
+        try:
+            self.collection.insert_one({
+                '_id': key,
+                'revoked': now,
+                'expires': expires,
+                'kind': payload.get('kind', None),
+            })
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def revoke(self, token: str, payload: dict) -> bool:
+        """ Revokes a verified token, False if it was revoked already """
+        self._migrate_legacy()
+        key = self.key_for(token, payload)
+        revoked = self._insert(key, payload)
+        bloom = self._bloom
+        if bloom is not None:
+            bloom.add(key)
+        return revoked
+
+    def is_revoked(self, token: str, payload: dict) -> bool:
+        key = self.key_for(token, payload)
+        self._maybe_sync()
+        bloom = self._bloom
+        with self._lock:
+            self.lookups += 1
+            if bloom is not None and key not in bloom:
+                self.filtered += 1
+                return False
+        revoked = self.collection.find_one({'_id': key}, projection={'_id': True}) is not None
+        if not revoked and bloom is not None:
+            with self._lock:
+                self.false_positives += 1
+        return revoked
+
+    def _maybe_sync(self):
+        now = time.monotonic()
+        if now - self._synced < self.sync_seconds:
+            return
+        # Only one request syncs, the others use the current filter
+        if not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            rebuild = self._bloom is None or self._bloom.is_full or now - self._rebuilt >= self.rebuild_seconds
+            self.sync(rebuild=rebuild)
+        except PyMongoError as err:
+            # Lookups keep using the current filter (or the database until there is one)
+            logger.warning('Unable to sync revoked tokens: {0}'.format(err))
+        finally:
+            self._synced = now
+            self._sync_lock.release()
+
+    def sync(self, rebuild: bool=False):
+        """ Adds revocations made since the last sync to the filter, rebuild starts a new filter
+            with the tokens that have not expired yet
+        """
+        self._migrate_legacy()
+        if rebuild or self._synced_to is None:
+            query = {'expires': {'$gt': datetime.datetime.utcnow()}}
+            count = self.collection.count_documents(query)
+            bloom = BloomFilter(capacity=max(self.capacity, count * 2), error_rate=self.error_rate)
+        else:
+            query = {'revoked': {'$gte': self._synced_to - _SYNC_OVERLAP}}
+            bloom = self._bloom
+
+        synced_to = self._synced_to
+        for document in self.collection.find(query, projection={'_id': True, 'revoked': True}):
+            if document['_id'] not in bloom:
+                bloom.add(document['_id'])
+            if synced_to is None or document['revoked'] > synced_to:
+                synced_to = document['revoked']
+        if synced_to is None:
+            synced_to = datetime.datetime.utcnow()
+
+        if bloom is not self._bloom:
+            self._bloom = bloom
+            self._rebuilt = time.monotonic()
+            logger.debug('Rebuilt the revoked tokens filter with {0} tokens'.format(len(bloom)))
+        self._synced_to = synced_to
+
+    def stats(self) -> dict:
+        bloom = self._bloom
+        return {
+            'filter_keys': len(bloom) if bloom is not None else None,
+            'filter_capacity': bloom.capacity if bloom is not None else None,
+            'lookups': self.lookups,
+            'filtered': self.filtered,
+            'false_positives': self.false_positives,
+        }
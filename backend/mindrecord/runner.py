@@ -0,0 +1,101 @@
+""" Persistent runner adapter for Python processing scripts (processing.mode "persistent").
+
+    Serves a function fn(input_path, output_path) over the protocol of mindrecord.processing.Runner,
+    so heavy imports are done once per runner instead of once per result. Either configure
+
+        "processing": {"mode": "persistent", "call": ["python", "-m", "mindrecord.runner", "score:process"]}
+
+    or call serve() from the script itself:
+
+        if __name__ == '__main__':
+            from mindrecord.runner import serve
+            serve(process)
+
+    The module depends on the standard library only and can be copied next to the scripts.
+"""
+import contextlib
+import importlib
+import json
+import os
+import sys
+import traceback
+
+
+__all__ = ['serve']
+
+
+class _CappedLog(object):
+    """ Text log which stops growing at max_bytes and leaves a truncation marker """
+    def __init__(self, path: str, max_bytes: int=0):
+        self._file = open(path, 'w', encoding='utf-8')
+        self.max_bytes = max_bytes
+        self.written = 0
+        self.truncated = False
+
+    def write(self, text: str) -> int:
+        if self.truncated:
+            return len(text)
+        data = text.encode('utf-8', errors='replace')
+        if self.max_bytes and self.written + len(data) > self.max_bytes:
+            data = data[:self.max_bytes - self.written]
+            self._file.write(data.decode('utf-8', errors='ignore'))
+            self._file.write('\n[... truncated: log exceeds {0} bytes ...]\n'.format(self.max_bytes))
+            self.truncated = True
+        else:
+            self._file.write(text)
+        self.written += len(data)
+        return len(text)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def _handle(fn, request: dict) -> int:
+    stdout_path = request.get('stdout')
+    stderr_path = request.get('stderr')
+    max_bytes = request.get('max_log_bytes', 0)
+    out, err = _CappedLog(stdout_path, max_bytes), _CappedLog(stderr_path, max_bytes)
+    with contextlib.closing(out), contextlib.closing(err):
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            try:
+                code = fn(request['input'], request['output'])
+            except SystemExit as exit_error:
+                code = exit_error.code
+            except Exception:
+                traceback.print_exc()
+                code = 1
+    # Same as for one-off processes: error log exists only if something was written to it
+    if os.path.getsize(stderr_path) == 0:
+        os.remove(stderr_path)
+    if code is None:
+        return 0
+    return code if isinstance(code, int) else 1
+
+
+def serve(fn):
+    """ Handles jobs from stdin until it is closed """
+    # Keep the original stdout for the protocol only.
+    # Anything else writing to fd 1 (print, native libraries) ends up in stderr
+    channel = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    for line in sys.stdin.buffer:
+        line = line.strip()
+        if not line:
+            continue
+        code = _handle(fn, json.loads(line.decode('utf-8')))
+        channel.write(json.dumps({'code': code}).encode('utf-8') + b'\n')
+        channel.flush()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or ':' not in sys.argv[1]:
+        sys.stderr.write('Usage: python -m mindrecord.runner module:function\n')
+        sys.exit(2)
+    module_name, function_name = sys.argv[1].split(':', 1)
+    # Scripts are imported from the processing workdir
+    sys.path.insert(0, os.getcwd())
+    serve(getattr(importlib.import_module(module_name), function_name))
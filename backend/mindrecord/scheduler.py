@@ -0,0 +1,160 @@
+import collections
+import logging
+import threading
+import time
+
+from mindrecord.utils import HTTPError, Status, Timings
+
+
+__all__ = ['Scheduler', 'QueueFullError']
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(HTTPError):
+    def __init__(self, message='Processing queue is full, try again later', retry_after: int=None):
+        headers = {}
+        if retry_after is not None:
+            headers['Retry-After'] = str(retry_after)
+        super().__init__(status_code=Status.SERVICE_UNAVAILABLE, message=message, headers=headers)
+
+
+class Job(object):
+    def __init__(self, key: str, fn: callable, args: tuple, kwargs: dict, limit: int=None):
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.limit = limit
+        self.enqueued = time.monotonic()
+
+
+class Scheduler(object):
+    """ Fixed-size pool of worker threads fed from a bounded queue.
+
+        Jobs are grouped by key (test id). No more than `limit` jobs of the same key
+        run at once, jobs of other keys are picked up meanwhile.
+        When the queue is full `submit` raises QueueFullError instead of blocking.
+    """
+    def __init__(self, workers: int=4, queue_size: int=100, per_key_limit: int=None,
+                 retry_after: int=None, name: str='scheduler'):
+        assert workers > 0, 'At least one worker required'
+        self.workers = workers
+        self.queue_size = queue_size
+        self.per_key_limit = per_key_limit
+        self.retry_after = retry_after
+        self.name = name
+
+        self._cond = threading.Condition()
+        self._pending = collections.deque()
+        self._running = collections.Counter()
+        self._threads = []
+        self._stopping = False
+
+        self.wait_timings = Timings()
+        self.run_timings = Timings()
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            self._stopping = False
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work,
+                                          name='{0}-{1}'.format(self.name, i),
+                                          daemon=True)
+                self._threads.append(thread)
+                thread.start()
+        logger.debug('Scheduler {0} started with {1} workers'.format(self.name, self.workers))
+
+    def stop(self, wait=True):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            threads, self._threads = self._threads, []
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    @property
+    def depth(self) -> int:
+        return len(self._pending)
+
+    @property
+    def is_full(self) -> bool:
+        return self.queue_size is not None and len(self._pending) >= self.queue_size
+
+    def submit(self, key: str, fn: callable, *args, limit: int=None, **kwargs):
+        with self._cond:
+            if self.is_full:
+                self.rejected += 1
+                raise QueueFullError(retry_after=self.retry_after)
+            self._pending.append(Job(key, fn, args, kwargs, limit=limit or self.per_key_limit))
+            self.submitted += 1
+            self._cond.notify()
+
+    def _pop_runnable(self):
+        """ First pending job whose key is below its concurrency limit (caller holds the lock) """
+        for job in self._pending:
+            if not job.limit or self._running[job.key] < job.limit:
+                self._pending.remove(job)
+                self._running[job.key] += 1
+                return job
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = None
+                while not self._stopping:
+                    job = self._pop_runnable()
+                    if job is not None:
+                        break
+                    self._cond.wait()
+                if job is None:
+                    return
+
+            started = time.monotonic()
+            self.wait_timings.add(started - job.enqueued)
+            try:
+                job.fn(*job.args, **job.kwargs)
+                succeeded = True
+            except Exception as err:
+                logger.exception(err)
+                succeeded = False
+            self.run_timings.add(time.monotonic() - started)
+
+            with self._cond:
+                self._running[job.key] -= 1
+                if not self._running[job.key]:
+                    del self._running[job.key]
+                if succeeded:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                # Jobs of this key may have become runnable
+                self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            pending = collections.Counter(job.key for job in self._pending)
+            running = dict(self._running)
+        return {
+            'workers': self.workers,
+            'queue_size': self.queue_size,
+            'per_key_limit': self.per_key_limit,
+            'depth': sum(pending.values()),
+            'running': sum(running.values()),
+            'submitted': self.submitted,
+            'rejected': self.rejected,
+            'completed': self.completed,
+            'failed': self.failed,
+            'wait_time': self.wait_timings.as_dict(),
+            'run_time': self.run_timings.as_dict(),
+            'keys': {key: {'pending': pending.get(key, 0), 'running': running.get(key, 0)}
+                     for key in set(pending) | set(running)},
+        }
@@ -1,93 +1,66 @@
+import base64
+import binascii
 import logging
 import os
 import json
-import glob
-import re
+import shutil
 import datetime
-import threading
+import time
 from urllib.parse import unquote
 from bson import ObjectId
+from bson.errors import InvalidId
 
 from mindrecord.utils import Request, JsonResponse, \
-    Status, HTTPError, Response, allow_methods, FileResponse, allow_cors, cache_control, BaseConfig
+    Status, HTTPError, Response, allow_methods, FileResponse, IterableResponse, allow_cors, cache_control, BaseConfig, \
+    UploadedFile, accept_ranges, conditional, not_modified, compress, CompressionCache, FileCache, Slots
 from mindrecord.app import config, db
 from mindrecord.auth import *
-from mindrecord.processing import run
-from mindrecord.models import TestResult
+from mindrecord.models import TestResult, States
+from mindrecord.registry import tests, load_tests, init_tests, get_test, get_web_manifest, tests_watcher
+from mindrecord.scheduler import QueueFullError
+from mindrecord.worker import create_dispatcher
+from mindrecord.memo import result_cache
+from mindrecord.notify import ResultWatcher
+from mindrecord.uploads import upload_sessions, UPLOAD_REFERENCE_PREFIX
 
 logger = logging.getLogger(__name__)
-tests = {}
 results_db = db['results']
 
+# Processing runs in this process only if configured so, otherwise results are just
+# queued in the database for standalone workers (python -m mindrecord.worker)
+dispatcher = create_dispatcher()
 
-def load_test_from_config(config_path):
-    if not os.path.exists(config_path):
-        logger.debug('Config path does not exits: {0}'.format(config_path))
-        return None
+_result_view_fields = ['state', 'created', 'processed', 'user', 'test', 'data']
 
-    try:
-        with open(config_path, 'r', encoding='utf-8') as f:
-            test_config = json.load(f)  # type: dict
-    except json.JSONDecodeError as err:
-        logger.exception(err)
-        logger.debug('Invalid JSON configuration: {0}'.format(config_path))
-        return None
-
-    required_fields = ['id', 'name', 'inputs', 'outputs', 'processing']
-    for field in required_fields:
-        if field not in test_config:
-            logger.warning('Field {0} required'.format(field))
-            return None
-    test_dir = os.path.dirname(config_path)
-    test = test_config.copy()
-    test.update({
-        'dir': test_dir,
-        'config_path': config_path,
-    })
+# Requests holding a server thread while waiting, kept below the number of server threads
+long_requests = Slots(int(config.SERVER_LONG_REQUESTS) or max(1, int(config.SERVER_THREADS) // 2))
 
-    if 'readme' in test_config:
-        readme_path = os.path.join(test_dir, test_config.get('readme'))
-        if os.path.exists(readme_path):
-            test['readme_path'] = readme_path
-
-    if 'web' in test_config:
-        web_cfg = test_config.get('web')
-        work_dir = web_cfg.get('workdir', './')
-        entry = web_cfg.get('entry', 'index.html')
-        test['web_workdir'] = os.path.join(test_dir, work_dir)
-        test['web_entry'] = os.path.join(test_dir, work_dir, entry)
-
-    if 'processing' in test_config:
-        processing_cfg = test_config.get('processing')
-        work_dir = processing_cfg.get('workdir', './')
-        test['processing_workdir'] = os.path.join(test_dir, work_dir)
-
-    if 'cover' in test_config:
-        cover_path = test_config.get('cover')
-        if cover_path is not None:
-            cover_path = os.path.join(test_dir, cover_path)
-        test['cover_path'] = cover_path
-    return test
-
-
-def load_tests():
-    tests.clear()
-    config_paths = glob.glob(config.TESTS_CONFIG_PATTERN)
-    for config_path in config_paths:
-        logger.debug('Reading config: {0}'.format(config_path))
-        test = load_test_from_config(config_path)
-        if not test:
-            continue
-        logger.debug('Test {0}'.format(test.get('id')))
-        tests[test.get('id')] = test
+# Shared by all requests waiting for results of this process
+result_watcher = ResultWatcher(results_db,
+                               projection=_result_view_fields,
+                               poll_seconds=float(config.RESULTS_WAIT_POLL_SECONDS),
+                               max_waiters=long_requests.limit,
+                               change_streams=config.RESULTS_WAIT_CHANGE_STREAMS)
+dispatcher.queue.add_listener(result_watcher.publish)
+
+# Compressed web assets and JSON bodies
+compression_cache = CompressionCache(max_bytes=int(config.COMPRESSION_CACHE_MAX_BYTES),
+                                     min_size=int(config.COMPRESSION_MIN_BYTES),
+                                     max_size=int(config.COMPRESSION_MAX_BYTES))
+
+# Small web assets and covers served from memory
+static_files = FileCache(max_bytes=int(config.STATIC_CACHE_MAX_BYTES),
+                         max_file_size=int(config.STATIC_CACHE_MAX_FILE_BYTES),
+                         revalidate_seconds=float(config.STATIC_CACHE_REVALIDATE_SECONDS))
 
 
 @requires_auth(allowed_roles=[Roles.ADMIN])
 @allow_methods('GET')
+@compress(compression_cache)
 def load_tests_view(request: Request):
     """ Utility view for loading the tests (ADMIN only) """
-    load_tests()
-    return JsonResponse(tests)
+    load_tests(force=True)
+    return JsonResponse(dict(tests))
 
 
 def _test_to_view(test: dict) -> dict:
@@ -98,14 +71,18 @@ def _test_to_view(test: dict) -> dict:
 
 @allow_cors(methods='GET')
 @allow_methods('GET')
+@compress(compression_cache)
+@conditional()
 def tests_list_view(request: Request):
     return JsonResponse([_test_to_view(v) for v in tests.values()])
 
 
 @allow_cors(methods='GET')
 @allow_methods('GET')
+@compress(compression_cache)
+@conditional()
 def test_details_view(request: Request, uri: str):
-    test = tests.get(uri, None)
+    test = get_test(uri)
     if not test:
         raise HTTPError(Status.NOT_FOUND)
 
@@ -120,100 +97,322 @@ def __static_404():
 @cache_control()
 @allow_cors(methods='GET')
 @allow_methods('GET')
+@compress(compression_cache)
+@accept_ranges()
+@conditional()
 def web_resource_view(request: Request, uri: str, path: str):
-    test = tests.get(uri, None)
+    test = get_test(uri)
     if not test:
         return __static_404()
 
-    web_workdir = test.get('web_workdir', None)
-    if not web_workdir:
+    # Only files listed in the manifest are served, unknown paths are answered without the disk
+    manifest = get_web_manifest(uri)
+    if manifest is None:
         return __static_404()
 
     if not path:
-        web_entry = test.get('web_entry', None)
-        if not web_entry or not os.path.exists(web_entry):
-            return __static_404()
-        return FileResponse(web_entry)
-
-    path = unquote(path)
-    # Todo: IMPROVE SECURITY!
-    match = re.match('^[\\\/.]*(.*)$', path)
-    if match:
-        path = match.group(1)
+        path = os.path.relpath(test.get('web_entry'), test.get('web_workdir'))
 
-    resource_path = os.path.join(web_workdir, path)
-
-    if os.path.exists(resource_path):
-        return FileResponse(resource_path)
-    return __static_404()
+    asset = manifest.get(unquote(path))
+    if asset is None:
+        return __static_404()
+    # Validators are known from the manifest, a 304 doesn't read the file (not even from the cache)
+    if request.method == 'GET':
+        response = not_modified(request, asset.headers)
+        if response is not None:
+            return response
+    response = static_files.response(asset.path, stat=asset.stat, stat_headers=asset.headers)
+    return response or __static_404()
 
 
 @cache_control()
 @allow_cors(methods='GET')
 @allow_methods('GET')
+@compress(compression_cache)
+@accept_ranges()
+@conditional()
 def cover_view(request: Request, uri: str):
-    test = tests.get(uri, None)
+    test = get_test(uri)
     if not test:
         return __static_404()
 
     cover_path = test.get('cover_path', None)
-    if not cover_path or not os.path.exists(cover_path):
-        return __static_404()
+    response = static_files.response(cover_path) if cover_path else None
+    return response or __static_404()
+
+
+def _result_to_view(result: dict) -> dict:
+    data = {k: v for k, v in result.items() if k in _result_view_fields}
+    data['id'] = str(result['_id'])
+    if 'user' in data:
+        data['user'] = str(data['user'])
+
+    created = data.get('created', None)
+    if created and isinstance(created, datetime.datetime):
+        data['created'] = created.isoformat()
 
-    return FileResponse(cover_path)
+    processed = data.get('processed', None)
+    if created and isinstance(processed, datetime.datetime):
+        data['processed'] = processed.isoformat()
+    return data
 
 
 @allow_cors()
 @allow_methods('GET')
 def test_results(request: Request, id: str):
     result_id = ObjectId(id)
-    result = results_db.find_one({'_id': result_id})
+    result = results_db.find_one({'_id': result_id}, projection=_result_view_fields)
     if not result:
         raise HTTPError(Status.NOT_FOUND)
-    fields = ['state', 'created', 'processed', 'user', 'test', 'data']
-    data = {k: v for k, v in result.items() if k in fields}
-    data['id'] = str(result_id)
-    data['user'] = str(data['user'])
+    return JsonResponse(_result_to_view(result))
 
-    created = data.get('created', None)
-    if created and isinstance(created, datetime.datetime):
-        data['created'] = created.isoformat()
 
-    processed = data.get('processed', None)
-    if created and isinstance(processed, datetime.datetime):
-        data['processed'] = processed.isoformat()
+def __encode_cursor(result: dict) -> str:
+    """ Position after the result in (created, _id) descending order """
+    position = json.dumps([result['created'].isoformat(), str(result['_id'])])
+    return base64.urlsafe_b64encode(position.encode('utf-8')).decode('ascii')
+
 
-    return JsonResponse(data)
+def __decode_cursor(cursor: str) -> dict:
+    """ Filter of the results after the cursor """
+    try:
+        created, result_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        created = datetime.datetime.fromisoformat(created)
+        result_id = ObjectId(result_id)
+    except (ValueError, TypeError, InvalidId, binascii.Error):
+        raise HTTPError(Status.BAD_REQUEST, message='Invalid cursor')
+    # The bound on created alone keeps the index scan starting at the cursor
+    return {'created': {'$lte': created}, '$or': [{'created': {'$lt': created}}, {'_id': {'$lt': result_id}}]}
 
 
 @allow_cors()
 @allow_methods('GET')
-@requires_auth(allowed_roles=[Roles.ADMIN])
-def test_results_log(request: Request, id: str):
+@requires_auth()
+def results_list_view(request: Request):
+    """ Results of a user, newest first: ?user=<id>&test=<id>&state=<state>
+        (users see their own results only, admins can pass any user).
+
+        ?fields=state,data,... selects the fields (all but data by default), id and created are always returned.
+        Pages have ?limit= results (up to RESULTS_MAX_PAGE_SIZE), the next one is requested
+        with ?cursor=<next> from the response until next is null.
+    """
+    user = get_user_from_request(request)
+    params = request.query_parameters
+
+    user_id = params.get('user', [user.id])[0]
+    if user_id != user.id and user.role != Roles.ADMIN:
+        raise HTTPError(Status.FORBIDDEN, message='Results of other users are not available')
+    try:
+        query = {'user': ObjectId(user_id)}
+    except (InvalidId, TypeError):
+        raise HTTPError(Status.BAD_REQUEST, message='Invalid user')
+
+    if 'test' in params:
+        query['test'] = params['test'][0]
+    if 'state' in params:
+        query['state'] = params['state'][0]
+
+    fields = [f for f in _result_view_fields if f != 'data']
+    if 'fields' in params:
+        fields = [f.strip() for f in params['fields'][0].split(',') if f.strip()]
+        unknown = [f for f in fields if f not in _result_view_fields]
+        if unknown:
+            raise HTTPError(Status.BAD_REQUEST, message='Unknown fields: {0}'.format(', '.join(unknown)))
+    projection = set(fields) | {'created'}
+
+    max_limit = int(config.RESULTS_MAX_PAGE_SIZE)
+    try:
+        limit = min(int(params.get('limit', [config.RESULTS_PAGE_SIZE])[0]), max_limit)
+    except ValueError:
+        raise HTTPError(Status.BAD_REQUEST, message='Invalid limit')
+    if limit <= 0:
+        raise HTTPError(Status.BAD_REQUEST, message='Invalid limit')
+
+    if 'cursor' in params:
+        query.update(__decode_cursor(params['cursor'][0]))
+
+    # Keyset pagination: the (user[, test], created, _id) indexes are read from the cursor position on,
+    # one more result tells whether there is a next page
+    results = list(results_db.find(query, projection=list(projection))
+                   .sort([('created', -1), ('_id', -1)])
+                   .limit(limit + 1))
+    next_cursor = __encode_cursor(results[limit - 1]) if len(results) > limit else None
+
+    items = []
+    for result in results[:limit]:
+        item = _result_to_view(result)
+        items.append({k: v for k, v in item.items() if k in fields or k in ('id', 'created')})
+    return JsonResponse({'results': items, 'next': next_cursor}, headers={'Cache-Control': 'no-cache'})
+
+
+def __result_events(result: dict):
+    """ Server-sent events with the result on every state change until processing is over """
+    deadline = time.monotonic() + float(config.RESULTS_WAIT_STREAM_SECONDS)
+    timeout = float(config.RESULTS_WAIT_TIMEOUT_SECONDS)
+    while True:
+        yield 'event: result\ndata: {0}\n\n'.format(json.dumps(_result_to_view(result))).encode('utf-8')
+        state = result.get('state')
+        while __is_active(state):
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return
+            changed = result_watcher.wait(result['_id'], state, min(timeout, left))
+            if changed is not None:
+                result = changed
+                break
+            # Keeps proxies from closing an idle connection
+            yield b': keep-alive\n\n'
+        else:
+            return
+
+
+@allow_cors()
+@allow_methods('GET')
+def test_results_wait(request: Request, id: str):
+    """ Result as soon as its state differs from ?state=<known state> (current state by default).
+        Long-poll: responds when the state changes or after ?timeout=<seconds>
+        (up to RESULTS_WAIT_TIMEOUT_SECONDS) with the current result either way.
+        With Accept: text/event-stream the result is streamed on every state change until processing is over.
+        When too many requests are waiting the current result is returned right away (client falls back to polling).
+    """
+    result_id = ObjectId(id)
+    result = results_db.find_one({'_id': result_id}, projection=_result_view_fields)
+    if not result:
+        raise HTTPError(Status.NOT_FOUND)
+
+    if 'text/event-stream' in request.get_header_value('accept', ''):
+        events = __result_events(result)
+        if __is_active(result.get('state')):
+            if not long_requests.acquire():
+                return JsonResponse(_result_to_view(result), headers={'Cache-Control': 'no-cache'})
+            events = long_requests.hold(events)
+        return IterableResponse(events,
+                                content_type='text/event-stream',
+                                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    state = request.query_parameters.get('state', [result.get('state')])[0]
+    max_timeout = float(config.RESULTS_WAIT_TIMEOUT_SECONDS)
+    try:
+        timeout = min(float(request.query_parameters.get('timeout', [max_timeout])[0]), max_timeout)
+    except ValueError:
+        raise HTTPError(Status.BAD_REQUEST, message='Invalid timeout')
+
+    # Too many requests are waiting already: the client falls back to polling
+    if result.get('state') == state and __is_active(state) and timeout > 0 and long_requests.acquire():
+        try:
+            result = result_watcher.wait(result_id, state, timeout) or result
+        finally:
+            long_requests.release()
+    return JsonResponse(_result_to_view(result), headers={'Cache-Control': 'no-cache'})
+
+
+def __is_active(state: str) -> bool:
+    return state in (States.RAW, States.PROCESSING)
+
+
+def __read_log(log_file: str, offset: int) -> bytes:
+    if not os.path.exists(log_file):
+        return b''
+    with open(log_file, 'rb') as f:
+        f.seek(offset)
+        return f.read()
+
+
+def __follow_log(result_id: ObjectId, log_file: str, offset: int, poll_seconds: float=0.5):
+    """ Yields new log data until processing is over (or PROCESSING_LOG_FOLLOW_SECONDS pass) """
+    deadline = time.monotonic() + float(config.PROCESSING_LOG_FOLLOW_SECONDS)
+    active = True
+    while True:
+        data = __read_log(log_file, offset)
+        if data:
+            offset += len(data)
+            yield data
+        if not active or time.monotonic() > deadline:
+            return
+        time.sleep(poll_seconds)
+        result = results_db.find_one({'_id': result_id}, projection={'state': True})
+        # One more read after processing is over to get the tail of the log
+        active = result is not None and __is_active(result.get('state'))
+
+
+def __log_response(request: Request, id: str, log_name: str):
+    """ Processing log of a result.
+        ?offset=<bytes> returns the log from offset with X-Log-Offset (offset to request next)
+        and X-Log-Complete (whether processing is over) headers, ?follow=1 streams the log
+        while processing is running (503 when too many requests are waiting, ?offset= polling still works).
+    """
     result_id = ObjectId(id)
     result = results_db.find_one({'_id': result_id})
     if not result:
         raise HTTPError(Status.NOT_FOUND)
     directory = result.get('directory', os.path.join(config.TESTS_RESULTS_DIR, result.get('test'), str(result_id)))
-    log_file = os.path.join(directory, config.TESTS_PROCESSING_LOG)
-    if not os.path.exists(log_file):
+    log_file = os.path.join(directory, log_name)
+    active = __is_active(result.get('state'))
+
+    offset = request.query_parameters.get('offset', None)
+    follow = request.query_parameters.get('follow', None)
+    if offset is None and not follow:
+        if not os.path.exists(log_file):
+            raise HTTPError(Status.NOT_FOUND)
+        return FileResponse(log_file)
+
+    if not active and not os.path.exists(log_file):
         raise HTTPError(Status.NOT_FOUND)
-    return FileResponse(log_file)
+    try:
+        offset = max(0, int(offset[0])) if offset else 0
+    except ValueError:
+        raise HTTPError(Status.BAD_REQUEST, message='Invalid offset')
+
+    if follow and follow[0] not in ('0', 'false'):
+        chunks = __follow_log(result_id, log_file, offset)
+        if active:
+            # Followers hold a server thread like the other waiting requests
+            if not long_requests.acquire():
+                raise HTTPError(Status.SERVICE_UNAVAILABLE, message='Too many requests are waiting, poll with ?offset=',
+                                headers={'Retry-After': str(int(config.PROCESSING_RETRY_AFTER_SECONDS))})
+            chunks = long_requests.hold(chunks)
+        return IterableResponse(chunks,
+                                content_type='text/plain; charset=utf-8',
+                                headers={'Cache-Control': 'no-cache'})
+
+    data = __read_log(log_file, offset)
+    return Response(data=data, content_type='text/plain; charset=utf-8', headers={
+        'X-Log-Offset': str(offset + len(data)),
+        'X-Log-Complete': 'false' if active else 'true',
+        'Access-Control-Expose-Headers': 'X-Log-Offset, X-Log-Complete',
+        'Cache-Control': 'no-cache',
+    })
+
+
+@allow_cors()
+@allow_methods('GET')
+@requires_auth(allowed_roles=[Roles.ADMIN])
+def test_results_log(request: Request, id: str):
+    return __log_response(request, id, config.TESTS_PROCESSING_LOG)
 
 
 @allow_cors()
 @allow_methods('GET')
 @requires_auth(allowed_roles=[Roles.ADMIN])
 def test_results_error_log(request: Request, id: str):
+    return __log_response(request, id, config.TESTS_PROCESSING_ERROR_LOG)
+
+
+@allow_cors()
+@allow_methods('POST')
+@requires_auth(allowed_roles=[Roles.ADMIN])
+def test_results_cancel(request: Request, id: str):
+    """ Cancels processing of a result (ADMIN only).
+        Waiting result is killed right away, running processing is killed by its worker shortly.
+    """
     result_id = ObjectId(id)
-    result = results_db.find_one({'_id': result_id})
-    if not result:
-        raise HTTPError(Status.NOT_FOUND)
-    directory = result.get('directory', os.path.join(config.TESTS_RESULTS_DIR, result.get('test'), str(result_id)))
-    log_file = os.path.join(directory, config.TESTS_PROCESSING_ERROR_LOG)
-    if not os.path.exists(log_file):
-        raise HTTPError(Status.NOT_FOUND)
-    return FileResponse(log_file)
+    state = dispatcher.cancel(result_id)
+    if state is None:
+        if not results_db.find_one({'_id': result_id}, projection={'_id': True}):
+            raise HTTPError(Status.NOT_FOUND)
+        raise HTTPError(Status.CONFLICT, message='Processing is already finished')
+    status_code = Status.OK if state == States.KILLED else Status.ACCEPTED
+    return JsonResponse({'id': id, 'state': state}, status_code=status_code)
 
 
 @allow_cors()
@@ -238,7 +437,7 @@ def test_results_submission(request: Request, uri: str):
     if not user or not user.id or user.role == Roles.UNAUTHORIZED:
         raise HTTPError(Status.UNAUTHORIZED)
 
-    test = tests.get(uri, None)
+    test = get_test(uri)
     if not test:
         raise HTTPError(Status.NOT_FOUND)
 
@@ -246,12 +445,13 @@ def test_results_submission(request: Request, uri: str):
     if not inputs:
         raise HTTPError(Status.INTERNAL_SERVER_ERROR, message='Test is improperly configured')
 
-    # Check inputs
-    for name, input_desc in inputs.items():
-        # if the field is required and not present - raise an error
-        if input_desc.get('required', True) and name not in request.data:
-            raise HTTPError(Status.INTERNAL_SERVER_ERROR,
-                            message='{0} field required but there is none'.format(name))
+    # Reject early (before anything is stored) if processing can't keep up
+    retry_after = int(config.PROCESSING_RETRY_AFTER_SECONDS)
+    if dispatcher.is_running and dispatcher.scheduler.is_full:
+        raise QueueFullError(retry_after=retry_after)
+    backlog_limit = int(config.PROCESSING_BACKLOG_LIMIT)
+    if backlog_limit and dispatcher.queue.backlog(limit=backlog_limit) >= backlog_limit:
+        raise QueueFullError(retry_after=retry_after)
 
     # Create new results entry
     results_id = ObjectId()
@@ -259,6 +459,38 @@ def test_results_submission(request: Request, uri: str):
     # Location to store results: RESULTS_PATH/<test_id>/<results_id>
     results_dir = os.path.join(config.TESTS_RESULTS_DIR, test.get('id'), str(results_id))
     os.makedirs(results_dir)
+    # Finished resumable uploads: (session, path in results_dir)
+    uploads = []
+    try:
+        response = __store_submission(request, test, user, results_id, results_dir, uploads)
+    except BaseException:
+        # Uploads are moved back and can be submitted again
+        for session, path in uploads:
+            upload_sessions.release(session, path)
+        shutil.rmtree(results_dir, ignore_errors=True)
+        raise
+    # The result is stored, the upload sessions are not needed anymore
+    for session, _ in uploads:
+        upload_sessions.complete(session)
+    return response
+
+
+def __store_submission(request: Request, test: dict, user: User, results_id: ObjectId, results_dir: str,
+                       uploads: list):
+    inputs = test.get('inputs')
+
+    # Uploads are spooled right into the results directory while the body is read,
+    # so storing them is a rename
+    max_sizes = {name: int(input_desc['max_size']) for name, input_desc in inputs.items()
+                 if input_desc.get('type') == 'file' and input_desc.get('max_size', None)}
+    request.configure_uploads(directory=results_dir, max_sizes=max_sizes)
+
+    # Check inputs
+    for name, input_desc in inputs.items():
+        # if the field is required and not present - raise an error
+        if input_desc.get('required', True) and name not in request.data:
+            raise HTTPError(Status.INTERNAL_SERVER_ERROR,
+                            message='{0} field required but there is none'.format(name))
 
     # Save json object to RESULTS_RAW_FILE
     inputs_obj = {
@@ -269,13 +501,34 @@ def test_results_submission(request: Request, uri: str):
         '_created': datetime.datetime.utcnow().isoformat(),
         '_results': config.TESTS_RESULTS_FILE
     }
+    files = {}
     for name, input_desc in inputs.items():
         value = request.data.get(name, None)
         if not value:
             continue
         if input_desc.get('type') == 'file':
-            # TODO: save file from request
-            inputs_obj[name] = input_desc.get('filename', name + '.dat')
+            filename = input_desc.get('filename', name + '.dat')
+            if isinstance(value, str) and value.startswith(UPLOAD_REFERENCE_PREFIX):
+                # Finished resumable upload
+                upload_id = value[len(UPLOAD_REFERENCE_PREFIX):]
+                if not ObjectId.is_valid(upload_id):
+                    raise HTTPError(Status.BAD_REQUEST, message='Unknown upload for {0}'.format(name))
+                session = upload_sessions.claim(ObjectId(upload_id), user.id, test.get('id'), name)
+                path = os.path.join(results_dir, filename)
+                uploads.append((session, path))
+                files[name] = upload_sessions.finish(session, path)
+            elif isinstance(value, UploadedFile):
+                value.save(os.path.join(results_dir, filename))
+                files[name] = {
+                    'original_filename': value.filename,
+                    'content_type': value.content_type,
+                    'size': value.size,
+                    'sha256': value.sha256,
+                }
+            else:
+                raise HTTPError(Status.BAD_REQUEST, message='{0} field should be a single file'.format(name))
+            files[name]['filename'] = filename
+            inputs_obj[name] = filename
         else:
             inputs_obj[name] = value
 
@@ -294,83 +547,49 @@ def test_results_submission(request: Request, uri: str):
                         user=ObjectId(user.id),
                         directory=results_dir,
                         test=test.get('id'),
+                        files=files or None,
                         raw_file=config.TESTS_RESULTS_RAW_FILE,
                         output_file=config.TESTS_RESULTS_FILE)
     result.save()
 
-    # Initiate processing of raw results
-    __process_and_save_async(result_id=results_id,
-                             test=test,
-                             result_dir=result.directory,
-                             raw_file_name=result.raw_file,
-                             output_file_name=result.output_file)
+    # Initiate processing of raw results.
+    # If the scheduler is busy (or processing runs in standalone workers)
+    # the result stays queued in the database and is picked up later
+    if dispatcher.is_running:
+        dispatcher.notify(results_id, test.get('id'))
 
     # Return valid result id
     return JsonResponse({'results_id': str(results_id)}, status_code=Status.ACCEPTED)
 
 
-def __fail(result_id: ObjectId, reason: str = None):
-    logger.error('Failed processing: {0} {1}'.format(result_id, reason))
-    results_db.update_one({'_id': result_id}, update={'$set': {'state': 'fail'}})
+@requires_auth(allowed_roles=[Roles.ADMIN])
+@allow_methods('GET')
+def processing_stats_view(request: Request):
+    """ Processing queue depth, wait and run times (ADMIN only) """
+    stats = dispatcher.scheduler.stats() if dispatcher.is_running else {}
+    stats['backlog'] = dispatcher.queue.backlog()
+    stats['cache'] = result_cache.stats()
+    stats['waiting'] = result_watcher.waiting
+    stats['long_requests'] = long_requests.stats()
+    stats['compression'] = compression_cache.stats()
+    stats['static_files'] = static_files.stats()
+    stats['auth'] = {
+        'logins': login_timings.as_dict(),
+        'passwords': password_hasher.stats(),
+        'tokens': token_cache.stats(),
+        'revoked': revoked_tokens.stats(),
+    }
+    return JsonResponse(stats)
 
 
-def __process_and_save(result_id: ObjectId,
-                       cmd: list,
-                       input_path: str,
-                       output_path: str,
-                       work_dir: str,
-                       output_spec: dict):
-    try:
-        data = run(cmd, input_path, output_path, work_dir)
-    except Exception as err:
-        __fail(result_id)
-        return
-
-    if not data:
-        __fail(result_id)
-        return
-
-    # Filter outputs according to test configuration
-    # TODO: verify type
-    filtered_data = {k: data.get(k, None) for k in output_spec}
-
-    # Update database row
-    results_db.update_one({'_id': result_id}, update={'$set': {
-        'state': 'processed',
-        'processed': datetime.datetime.utcnow(),
-        'data': filtered_data
-    }})
-
-
-def __process_and_save_async(result_id: ObjectId, test: dict, result_dir: str, raw_file_name: str, output_file_name: str):
-    processing_desc = test.get('processing', None)
-    if not processing_desc:
-        __fail(result_id)
-        return
-
-    cmd = processing_desc.get('call', None)
-    if isinstance(cmd, str):
-        cmd = [cmd]
-    if not cmd:
-        __fail(result_id)
-        return
-
-    cwd = test.get('processing_workdir', test.get('dir', result_dir))
-    if not cwd:
-        __fail(result_id)
-        return
-
-    thread = threading.Thread(None, __process_and_save, kwargs={
-        'result_id': result_id,
-        'cmd': cmd,
-        'input_path': os.path.join(result_dir, raw_file_name),
-        'output_path': os.path.join(result_dir, output_file_name),
-        'work_dir': cwd,
-        'output_spec': test.get('outputs', {})
-    }, daemon=True)
-    thread.start()
+def start_background():
+    """ Background work of the API (see manage.startup): reloading changed tests, processing (PROCESSING_IN_API) """
+    if config.TESTS_WATCH:
+        tests_watcher.start()
+    if config.PROCESSING_IN_API:
+        dispatcher.start()
 
 
 """ If tests are not set - load them"""
 if not tests:
-    load_tests()
+    init_tests()
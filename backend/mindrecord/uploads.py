@@ -0,0 +1,373 @@
+""" Resumable uploads of large file inputs.
+
+    1. POST /api/tests/<uri>/uploads (input, filename, size, content_type) creates an upload session
+    2. PUT /api/uploads/<id>?offset=<bytes> appends the request body at offset.
+       A failed request keeps what was received, GET /api/uploads/<id> returns the offset to resume from
+    3. POST /api/tests/<uri>/results with the file input set to "upload:<id>" submits the upload
+       like a regular file input (the file is moved into the results directory)
+
+    Sessions not updated for UPLOAD_SESSION_TTL_SECONDS are removed with their files.
+"""
+import datetime
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Optional
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReturnDocument
+from pymongo.collection import Collection
+
+from mindrecord.utils import Request, JsonResponse, Status, HTTPError, allow_methods, allow_cors
+from mindrecord.app import config, db
+from mindrecord.auth import get_user_from_request, requires_auth
+from mindrecord.registry import tests, get_test
+
+
+__all__ = ['UploadSessions', 'upload_sessions', 'UPLOAD_REFERENCE_PREFIX',
+           'upload_create_view', 'upload_view']
+
+logger = logging.getLogger(__name__)
+
+# File input value referencing a finished upload session
+UPLOAD_REFERENCE_PREFIX = 'upload:'
+
+CHUNK_SIZE = 64 * 1024
+
+
+class UploadSessions(object):
+    """ Upload sessions stored in the database, data is appended to a file per session.
+
+        Only one request writes to a session at a time (a short write lease in the session,
+        renewed while a chunk is received and identified by a writer token, so a request which
+        lost its lease can't overwrite what the next one stored),
+        a chunk is accepted only at the current offset of the session. The file is truncated
+        to the offset before writing, so a partially written chunk is simply overwritten.
+    """
+    def __init__(self, collection: Collection, root_dir: str, ttl_seconds: int=24 * 60 * 60,
+                 write_lease_seconds: int=60, gc_interval_seconds: int=10 * 60):
+        self.collection = collection
+        self.root_dir = root_dir
+        self.ttl_seconds = ttl_seconds
+        self.write_lease_seconds = write_lease_seconds
+        self.gc_interval_seconds = gc_interval_seconds
+
+        self._lock = threading.Lock()
+        self._last_gc = 0.0
+
+    def _expires(self, now: datetime.datetime) -> datetime.datetime:
+        return now + datetime.timedelta(seconds=self.ttl_seconds)
+
+    def upload_dir(self, test_id: str) -> str:
+        # Next to the results of the test, so finishing an upload is a rename
+        return os.path.join(self.root_dir, test_id, '_uploads')
+
+    def create(self, user_id: str, test_id: str, input_name: str, filename: str,
+               content_type: str=None, size: int=None, max_size: int=None) -> dict:
+        self.collect_garbage()
+        upload_id = ObjectId()
+        directory = self.upload_dir(test_id)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, str(upload_id))
+        open(path, 'wb').close()
+
+        now = datetime.datetime.utcnow()
+        session = {
+            '_id': upload_id,
+            'user': user_id,
+            'test': test_id,
+            'input': input_name,
+            'filename': filename,
+            'content_type': content_type,
+            'size': size,
+            'max_size': max_size,
+            'offset': 0,
+            'path': path,
+            'created': now,
+            'updated': now,
+            'expires': self._expires(now),
+        }
+        self.collection.insert_one(session)
+        return session
+
+    def get(self, upload_id: ObjectId, user_id: str) -> Optional[dict]:
+        return self.collection.find_one({'_id': upload_id, 'user': user_id})
+
+    def _acquire(self, query: dict) -> Optional[dict]:
+        """ Takes the write lease of the session matching query if no one holds it (or it expired),
+            the returned session has the token of the lease as 'writer'
+        """
+        now = datetime.datetime.utcnow()
+        query = dict(query)
+        query['$or'] = [{'writer_expires': None}, {'writer_expires': {'$lt': now}}]
+        return self.collection.find_one_and_update(
+            query,
+            {'$set': {'writer': ObjectId(),
+                      'writer_expires': now + datetime.timedelta(seconds=self.write_lease_seconds)}},
+            return_document=ReturnDocument.AFTER)
+
+    def _renew(self, session: dict) -> bool:
+        """ Extends the write lease of session, False if it expired and another request took it """
+        now = datetime.datetime.utcnow()
+        renewed = self.collection.update_one(
+            {'_id': session['_id'], 'writer': session['writer']},
+            {'$set': {'writer_expires': now + datetime.timedelta(seconds=self.write_lease_seconds)}})
+        return renewed.matched_count > 0
+
+    def _keep_lease(self, session: dict, renewed: float) -> float:
+        """ Renews the lease once a third of it has passed since renewed (monotonic time),
+            so it is valid whenever the file is touched. Raises 409 if the lease was lost.
+        """
+        if time.monotonic() - renewed < self.write_lease_seconds / 3:
+            return renewed
+        if not self._renew(session):
+            raise HTTPError(Status.CONFLICT, message='Upload is being written by another request')
+        return time.monotonic()
+
+    def write(self, session: dict, offset: int, stream, length: int) -> dict:
+        """ Writes length bytes of stream at offset, returns the updated session.
+            Bytes received before a failure are kept.
+        """
+        locked = self._acquire({'_id': session['_id'], 'offset': offset})
+        if locked is None:
+            current = self.collection.find_one({'_id': session['_id']}, projection={'offset': True})
+            if current is None:
+                raise HTTPError(Status.NOT_FOUND)
+            raise HTTPError(Status.CONFLICT, message='Upload offset is {0}'.format(current['offset']),
+                            headers={'X-Upload-Offset': str(current['offset'])})
+
+        written = 0
+        renewed = time.monotonic()
+        try:
+            with open(locked['path'], 'r+b') as f:
+                f.seek(offset)
+                f.truncate()
+                while written < length:
+                    data = stream.read(min(CHUNK_SIZE, length - written))
+                    if not data:
+                        break
+                    # A slow client may outlast the lease, nothing is written once another request took it
+                    renewed = self._keep_lease(locked, renewed)
+                    f.write(data)
+                    written += len(data)
+        finally:
+            # Only by the lease holder: a request which lost the lease must not move the offset
+            now = datetime.datetime.utcnow()
+            session = self.collection.find_one_and_update(
+                {'_id': locked['_id'], 'writer': locked['writer']},
+                {
+                    '$set': {'offset': offset + written, 'updated': now, 'expires': self._expires(now)},
+                    '$unset': {'writer': '', 'writer_expires': ''},
+                },
+                return_document=ReturnDocument.AFTER)
+        if session is None:
+            raise HTTPError(Status.CONFLICT, message='Upload is being written by another request')
+        if written < length:
+            raise HTTPError(Status.BAD_REQUEST, message='Incomplete chunk, upload offset is {0}'.format(offset + written),
+                            headers={'X-Upload-Offset': str(offset + written)})
+        return session
+
+    def claim(self, upload_id: ObjectId, user_id: str, test_id: str, input_name: str) -> dict:
+        """ Takes the write lease of a complete upload for finish(), the session stays until complete() """
+        query = {'_id': upload_id, 'user': user_id, 'test': test_id, 'input': input_name}
+        session = self.collection.find_one(query)
+        if session is None:
+            raise HTTPError(Status.BAD_REQUEST, message='Unknown upload for {0}'.format(input_name))
+        size = session.get('size', None)
+        if size is not None and session['offset'] != size:
+            raise HTTPError(Status.BAD_REQUEST, message='Upload for {0} is incomplete: {1} of {2} bytes'.format(
+                input_name, session['offset'], size))
+        # Nothing is being written (or the writer is gone) and no chunk was added since the check
+        session = self._acquire(dict(query, offset=session['offset']))
+        if session is None:
+            raise HTTPError(Status.CONFLICT, message='Upload for {0} is still being written'.format(input_name))
+        return session
+
+    def finish(self, session: dict, path: str) -> dict:
+        """ Moves the file of a claimed upload to path, returns file info ({filename, size, sha256, ...}) """
+        # Single sequential read, chunks are not hashed on the way since a session spans processes
+        sha256 = hashlib.sha256()
+        renewed = time.monotonic()
+        with open(session['path'], 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(chunk)
+                renewed = self._keep_lease(session, renewed)
+        os.replace(session['path'], path)
+        return {
+            'original_filename': session.get('filename'),
+            'content_type': session.get('content_type'),
+            'size': session['offset'],
+            'sha256': sha256.hexdigest(),
+        }
+
+    def complete(self, session: dict):
+        """ Removes the session of a finished upload once its file is stored with the result """
+        self.collection.delete_one({'_id': session['_id']})
+
+    def release(self, session: dict, path: str=None):
+        """ Moves the file of a claimed upload back from path (if it was finished) and releases the lease,
+            so the upload can be submitted again
+        """
+        if path is not None and os.path.isfile(path):
+            try:
+                os.replace(path, session['path'])
+            except OSError as err:
+                logger.error('Unable to restore upload {0}: {1}'.format(session['_id'], err))
+        self.collection.update_one({'_id': session['_id'], 'writer': session['writer']},
+                                   {'$unset': {'writer': '', 'writer_expires': ''}})
+
+    def abort(self, upload_id: ObjectId, user_id: str) -> bool:
+        session = self.collection.find_one_and_delete({'_id': upload_id, 'user': user_id})
+        if session is None:
+            return False
+        _remove(session.get('path'))
+        return True
+
+    def collect_garbage(self, force=False) -> int:
+        """ Removes expired sessions and their files (at most once in gc_interval_seconds) """
+        with self._lock:
+            if not force and time.monotonic() - self._last_gc < self.gc_interval_seconds:
+                return 0
+            self._last_gc = time.monotonic()
+
+        now = datetime.datetime.utcnow()
+        removed = 0
+        for session in self.collection.find({'expires': {'$lt': now}}, projection={'path': True}):
+            if self.collection.delete_one({'_id': session['_id'], 'expires': {'$lt': now}}).deleted_count:
+                _remove(session.get('path'))
+                removed += 1
+
+        # Files left by sessions removed from the database by other means
+        deadline = time.time() - self.ttl_seconds
+        for test_id in tests:
+            directory = self.upload_dir(test_id)
+            if not os.path.isdir(directory):
+                continue
+            for entry in os.scandir(directory):
+                if entry.is_file() and entry.stat().st_mtime < deadline:
+                    _remove(entry.path)
+                    removed += 1
+        if removed:
+            logger.info('Removed {0} abandoned uploads'.format(removed))
+        return removed
+
+
+def _remove(path: str):
+    try:
+        if path:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+upload_sessions = UploadSessions(db['upload_sessions'],
+                                 root_dir=config.TESTS_RESULTS_DIR,
+                                 ttl_seconds=int(config.UPLOAD_SESSION_TTL_SECONDS),
+                                 gc_interval_seconds=int(config.UPLOAD_GC_INTERVAL_SECONDS))
+
+
+def _session_to_view(session: dict) -> dict:
+    return {
+        'upload_id': str(session['_id']),
+        'reference': UPLOAD_REFERENCE_PREFIX + str(session['_id']),
+        'input': session.get('input'),
+        'filename': session.get('filename'),
+        'size': session.get('size'),
+        'offset': session.get('offset'),
+        'expires': session['expires'].isoformat(),
+    }
+
+
+def _offset_headers(session: dict) -> dict:
+    return {
+        'X-Upload-Offset': str(session.get('offset')),
+        'Access-Control-Expose-Headers': 'X-Upload-Offset',
+        'Cache-Control': 'no-cache',
+    }
+
+
+def _parse_int(value, name: str) -> Optional[int]:
+    if value is None or value == '':
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise HTTPError(Status.BAD_REQUEST, message='Invalid {0}'.format(name))
+    if value < 0:
+        raise HTTPError(Status.BAD_REQUEST, message='Invalid {0}'.format(name))
+    return value
+
+
+@allow_cors()
+@allow_methods('POST')
+@requires_auth()
+def upload_create_view(request: Request, uri: str):
+    """ Creates an upload session for a file input of a test """
+    user = get_user_from_request(request)
+    test = get_test(uri)
+    if not test:
+        raise HTTPError(Status.NOT_FOUND)
+
+    input_name = request.data.get('input', None)
+    input_desc = (test.get('inputs', None) or {}).get(input_name, None) if isinstance(input_name, str) else None
+    if not input_desc or input_desc.get('type') != 'file':
+        raise HTTPError(Status.BAD_REQUEST, message='Unknown file input')
+
+    size = _parse_int(request.data.get('size', None), 'size')
+    max_size = int(input_desc.get('max_size', None) or config.UPLOAD_MAX_BYTES)
+    if size is not None and size > max_size:
+        raise HTTPError(Status.PAYLOAD_TOO_LARGE, message='File {0} exceeds {1} bytes'.format(input_name, max_size))
+
+    session = upload_sessions.create(user_id=user.id,
+                                     test_id=test.get('id'),
+                                     input_name=input_name,
+                                     filename=request.data.get('filename', None),
+                                     content_type=request.data.get('content_type', None),
+                                     size=size,
+                                     max_size=max_size)
+    return JsonResponse(_session_to_view(session), status_code=Status.CREATED, headers=_offset_headers(session))
+
+
+@allow_cors(methods=('GET', 'PUT', 'DELETE', 'OPTIONS'))
+@allow_methods('GET', 'PUT', 'DELETE')
+@requires_auth()
+def upload_view(request: Request, id: str):
+    """ GET: upload state with the offset to continue from,
+        PUT ?offset=<bytes>: appends the body (up to UPLOAD_CHUNK_MAX_BYTES) at offset,
+        DELETE: aborts the upload
+    """
+    user = get_user_from_request(request)
+    try:
+        upload_id = ObjectId(id)
+    except InvalidId:
+        raise HTTPError(Status.NOT_FOUND)
+
+    if request.method == 'DELETE':
+        if not upload_sessions.abort(upload_id, user.id):
+            raise HTTPError(Status.NOT_FOUND)
+        return JsonResponse({'upload_id': id})
+
+    session = upload_sessions.get(upload_id, user.id)
+    if session is None:
+        raise HTTPError(Status.NOT_FOUND)
+
+    if request.method == 'PUT':
+        offset = _parse_int(request.query_parameters.get('offset', [None])[0], 'offset')
+        if offset is None:
+            offset = session['offset']
+        length = request.content_length
+        if length is None:
+            raise HTTPError(Status.LENGTH_REQUIRED)
+        if length > int(config.UPLOAD_CHUNK_MAX_BYTES):
+            raise HTTPError(Status.PAYLOAD_TOO_LARGE,
+                            message='Chunk exceeds {0} bytes'.format(config.UPLOAD_CHUNK_MAX_BYTES))
+        limit = session.get('size', None)
+        if limit is None:
+            limit = session.get('max_size', None)
+        if limit is not None and offset + length > limit:
+            raise HTTPError(Status.PAYLOAD_TOO_LARGE, message='Upload exceeds {0} bytes'.format(limit))
+        session = upload_sessions.write(session, offset, request.stream, length)
+
+    return JsonResponse(_session_to_view(session), headers=_offset_headers(session))
@@ -4,6 +4,7 @@ import mindrecord.views as views
 import mindrecord.auth as auth
 import mindrecord.debug_views as debug_views
 import mindrecord.test_views as test_views
+import mindrecord.uploads as uploads
 
 router = Router()
 router.add_route('^/api/$', views.home_view)
@@ -16,12 +17,18 @@ router.add_route('^/api/tests/(?P<uri>[0-9a-z_\-]+)$', test_views.test_details_v
 router.add_route('^/api/tests/(?P<uri>[0-9a-z_\-]+)/web/(?P<path>.*)$', test_views.web_resource_view)
 router.add_route('^/api/tests/(?P<uri>[0-9a-z_\-]+)/cover$', test_views.cover_view)
 router.add_route('^/api/tests/(?P<uri>[0-9a-z_\-]+)/results$', test_views.test_results_submission)
+router.add_route('^/api/tests/(?P<uri>[0-9a-z_\-]+)/uploads$', uploads.upload_create_view)
+router.add_route('^/api/uploads/(?P<id>[0-9a-z]+)$', uploads.upload_view)
 
+router.add_route('^/api/results$', test_views.results_list_view)
 router.add_route('^/api/results/(?P<id>[0-9a-z_\-]+)$', test_views.test_results)
 router.add_route('^/api/results/(?P<id>[0-9a-z_\-]+)/log$', test_views.test_results_log)
 router.add_route('^/api/results/(?P<id>[0-9a-z_\-]+)/error_log$', test_views.test_results_error_log)
+router.add_route('^/api/results/(?P<id>[0-9a-z_\-]+)/cancel$', test_views.test_results_cancel)
+router.add_route('^/api/results/(?P<id>[0-9a-z_\-]+)/wait$', test_views.test_results_wait)
 
 router.add_route('^/api/load-tests', test_views.load_tests_view)
+router.add_route('^/api/processing/stats$', test_views.processing_stats_view)
 
 
 if config.DEBUG:
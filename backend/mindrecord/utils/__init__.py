@@ -1,6 +1,12 @@
 from mindrecord.utils.request import *
+from mindrecord.utils.multipart import *
 from mindrecord.utils.response import *
+from mindrecord.utils.compression import *
+from mindrecord.utils.filecache import *
+from mindrecord.utils.manifest import *
+from mindrecord.utils.bloom import *
 from mindrecord.utils.errors import *
 from mindrecord.utils.routing import *
 from mindrecord.utils.baseconfig import *
 from mindrecord.utils.misc import *
+from mindrecord.utils.metrics import *
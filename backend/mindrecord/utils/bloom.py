@@ -0,0 +1,48 @@
+import hashlib
+import math
+import threading
+
+
+__all__ = ['BloomFilter']
+
+
+class BloomFilter(object):
+    """ Set membership with false positives but no false negatives.
+
+        Sized for `capacity` keys with the given false positive rate,
+        more keys than that raise the rate (see is_full). Keys can't be removed.
+    """
+    def __init__(self, capacity: int=100000, error_rate: float=0.001):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(-self.capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hashes = max(1, int(round(self.size / self.capacity * math.log(2))))
+
+        self._lock = threading.Lock()
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        # Double hashing: k positions out of two 64-bit hashes
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        positions = self._positions(key)
+        with self._lock:
+            for position in positions:
+                self._bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def is_full(self) -> bool:
+        return self.count > self.capacity
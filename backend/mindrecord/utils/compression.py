@@ -0,0 +1,159 @@
+import collections
+import gzip
+import threading
+from typing import Optional
+
+try:
+    import brotli
+except ImportError:
+    # Optional, responses are compressed with gzip only
+    brotli = None
+
+
+__all__ = ['CompressionCache', 'ENCODINGS', 'negotiate_encoding', 'is_compressible', 'compress_data',
+           'precompressed_path']
+
+# Supported content codings, preferred first
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+# Precompressed files are stored next to the original: app.js.br, app.js.gz
+_EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+
+_COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/manifest+json',
+    'application/wasm',
+    'application/xml',
+    'application/vnd.ms-fontobject',
+    'font/otf',
+    'font/ttf',
+    'image/svg+xml',
+    'image/x-icon',
+}
+
+
+def is_compressible(content_type: str) -> bool:
+    """ Text-like types. Images, media, archives and woff fonts are compressed already """
+    if not content_type:
+        return False
+    mime_type = content_type.split(';', 1)[0].strip().lower()
+    return (mime_type.startswith('text/') or mime_type in _COMPRESSIBLE_TYPES
+            or mime_type.endswith('+json') or mime_type.endswith('+xml'))
+
+
+def negotiate_encoding(accept_encoding: str, available: tuple=ENCODINGS) -> Optional[str]:
+    """ Content coding from Accept-Encoding ('br;q=1.0, gzip;q=0.8, *;q=0'), None for identity """
+    if not accept_encoding:
+        return None
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding] = quality
+
+    best, best_quality = None, 0.0
+    for coding in available:
+        quality = qualities.get(coding, qualities.get('*', 0.0))
+        # Ties are resolved by the order of available
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def compress_data(data: bytes, encoding: str, level: int=None) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(data, quality=5 if level is None else level)
+    if encoding == 'gzip':
+        # Fixed mtime keeps the output (and its hash) stable
+        return gzip.compress(data, compresslevel=6 if level is None else level, mtime=0)
+    raise ValueError('Unsupported encoding: {0}'.format(encoding))
+
+
+def precompressed_path(path: str, encoding: str) -> str:
+    return path + _EXTENSIONS[encoding]
+
+
+class CompressionCache(object):
+    """ Compressed bodies kept in memory (LRU, bounded by the total size of the entries).
+
+        Bodies of min_size..max_size bytes are compressed once per key and encoding,
+        the key must change with the contents (path and modification time, hash of the body).
+        Bodies which do not get smaller are remembered too and sent as is.
+    """
+    def __init__(self, max_bytes: int=64 * 1024 * 1024, max_entries: int=10000,
+                 min_size: int=1024, max_size: int=8 * 1024 * 1024, levels: dict=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.min_size = min_size
+        self.max_size = max_size
+        self.levels = levels or {}
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def accepts(self, size: int) -> bool:
+        return self.min_size <= size <= self.max_size
+
+    def get(self, key, encoding: str, load: callable, load_compressed: callable=None) -> Optional[bytes]:
+        """ Compressed body (None if compression does not pay off), load() returns the original body.
+            load_compressed() may return a body compressed in advance (None if there is none)
+        """
+        cache_key = (key, encoding)
+        with self._lock:
+            if cache_key in self._entries:
+                self._entries.move_to_end(cache_key)
+                self.hits += 1
+                return self._entries[cache_key]
+            self.misses += 1
+
+        compressed = load_compressed() if load_compressed is not None else None
+        if compressed is None:
+            data = load()
+            compressed = compress_data(data, encoding, self.levels.get(encoding, None))
+            if len(compressed) >= len(data):
+                compressed = None
+        self._put(cache_key, compressed)
+        return compressed
+
+    def _put(self, cache_key, compressed: Optional[bytes]):
+        size = len(compressed) if compressed is not None else 0
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(cache_key, None)
+            if previous is not None:
+                self._bytes -= len(previous)
+            self._entries[cache_key] = compressed
+            self._bytes += size
+            while self._bytes > self.max_bytes or len(self._entries) > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                if evicted is not None:
+                    self._bytes -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'encodings': list(ENCODINGS),
+            }
@@ -5,9 +5,10 @@ __all__ = ['HTTPError', 'Status']
 
 
 class HTTPError(RuntimeError):
-    def __init__(self, status_code: int, status_message: str=None, message: str=None):
+    def __init__(self, status_code: int, status_message: str=None, message: str=None, headers: dict=None):
         super().__init__(message)
         self.status_code = status_code
+        self.headers = headers or {}
         if not status_message:
             self.status_message = responses.get(status_code, '')
         else:
@@ -0,0 +1,129 @@
+import collections
+import os
+import stat as stat_module
+import threading
+import time
+from typing import Optional
+
+from mindrecord.utils.response import FileResponse, BufferedFileResponse, file_headers
+
+
+__all__ = ['FileCache']
+
+
+class _Entry(object):
+    def __init__(self, path: str, data: bytes, stat: os.stat_result, checked: float, headers: dict=None):
+        self.path = path
+        self.data = data
+        self.mtime = stat.st_mtime
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.headers = headers or file_headers(path, stat)
+        self.checked = checked
+
+
+class FileCache(object):
+    """ Small static files kept in memory with prebuilt headers (LRU, bounded by the total size).
+
+        A cached file is served from a single buffer without touching the filesystem,
+        its size and modification time are checked again after revalidate_seconds.
+        Files larger than max_file_size are sent from disk.
+    """
+    def __init__(self, max_bytes: int=32 * 1024 * 1024, max_file_size: int=256 * 1024,
+                 revalidate_seconds: float=2.0):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.revalidate_seconds = revalidate_seconds
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def response(self, path: str, stat: os.stat_result=None, stat_headers: dict=None) -> Optional[FileResponse]:
+        """ Response with the contents of the file at path, None if it is not a file.
+            With the stat of the file (and its file_headers() as stat_headers) known by the caller,
+            e.g. from an AssetManifest, the file is not stat'ed again: a cached file is served if it matches.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(path, None)
+            if entry is not None:
+                self._entries.move_to_end(path)
+                if stat is None and now - entry.checked < self.revalidate_seconds:
+                    self.hits += 1
+                    return self._response(entry)
+
+        if stat is None:
+            stat_headers = None
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            if stat is None or not stat_module.S_ISREG(stat.st_mode):
+                self.invalidate(path)
+                return None
+
+        if entry is not None and entry.mtime_ns == stat.st_mtime_ns and entry.size == stat.st_size:
+            entry.checked = now
+            with self._lock:
+                self.hits += 1
+            return self._response(entry)
+
+        if stat.st_size > self.max_file_size:
+            self.invalidate(path)
+            return FileResponse(path, stat=stat, stat_headers=stat_headers)
+
+        try:
+            with open(path, 'rb') as f:
+                opened = os.fstat(f.fileno())
+                data = f.read()
+        except OSError:
+            self.invalidate(path)
+            return None
+        if len(data) != opened.st_size:
+            # Changed while reading, try again next time
+            return FileResponse(path)
+        if opened.st_mtime_ns != stat.st_mtime_ns or opened.st_size != stat.st_size:
+            stat, stat_headers = opened, None
+
+        entry = _Entry(path, data, stat, now, stat_headers)
+        self._put(entry)
+        return self._response(entry)
+
+    @staticmethod
+    def _response(entry: _Entry) -> BufferedFileResponse:
+        return BufferedFileResponse(entry.path, entry.data, entry.mtime, entry.headers)
+
+    def _put(self, entry: _Entry):
+        with self._lock:
+            self.misses += 1
+            previous = self._entries.pop(entry.path, None)
+            if previous is not None:
+                self._bytes -= previous.size
+            self._entries[entry.path] = entry
+            self._bytes += entry.size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+
+    def invalidate(self, path: str=None):
+        """ Removes the file at path (everything if path is None) """
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                self._bytes = 0
+                return
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                self._bytes -= entry.size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,130 @@
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+from mindrecord.utils.response import file_headers
+
+
+__all__ = ['Asset', 'AssetManifest', 'normalize_asset_path']
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_asset_path(path: str) -> Optional[str]:
+    """ 'js\\app.js', '/./js//app.js' -> 'js/app.js', None for paths going up ('..') """
+    parts = []
+    for part in path.replace('\\', '/').split('/'):
+        if not part or part == '.':
+            continue
+        if part == '..':
+            return None
+        parts.append(part)
+    key = '/'.join(parts)
+    if os.name == 'nt':
+        # Case-insensitive filesystem
+        key = key.lower()
+    return key
+
+
+class Asset(object):
+    def __init__(self, path: str, stat: os.stat_result):
+        self.path = path
+        self.stat = stat
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        # Content-Type, ETag, Last-Modified: responses are built from these without another stat
+        self.headers = file_headers(path, stat)
+
+    @property
+    def content_type(self) -> str:
+        return self.headers['Content-Type']
+
+    @property
+    def etag(self) -> str:
+        return self.headers['ETag']
+
+
+class AssetManifest(object):
+    """ Files under a directory by relative path ('js/app.js').
+
+        Lookups are dict lookups: they never touch the disk and can't escape the directory.
+        refresh() lists again only the directories whose modification time changed
+        and keeps the entries of files whose size and modification time are the same,
+        it is called from a background thread (see registry.TestsWatcher), never by lookups.
+    """
+    def __init__(self, root: str, max_files: int=20000):
+        self.root = os.path.abspath(root)
+        self.max_files = max_files
+
+        self._lock = threading.Lock()
+        # Replaced as a whole, readers never see a partial refresh
+        self._assets = {}
+        # Relative directory -> (mtime_ns, file names, subdirectory names)
+        self._dirs = {}
+        self.refreshed = 0.0
+        self.refresh()
+
+    def __len__(self):
+        return len(self._assets)
+
+    def __contains__(self, path: str):
+        return self.get(path) is not None
+
+    def get(self, path: str) -> Optional[Asset]:
+        key = normalize_asset_path(path)
+        if key is None:
+            return None
+        return self._assets.get(key, None)
+
+    def refresh(self):
+        with self._lock:
+            self._refresh()
+
+    def _list(self, directory: str, relative: str) -> tuple:
+        stat = os.stat(directory)
+        listed = self._dirs.get(relative, None)
+        if listed is not None and listed[0] == stat.st_mtime_ns:
+            return listed
+        files, subdirs = [], []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.is_file():
+                    files.append(entry.name)
+        return stat.st_mtime_ns, files, subdirs
+
+    def _refresh(self):
+        assets = {}
+        dirs = {}
+        pending = ['']
+        while pending and len(assets) < self.max_files:
+            relative = pending.pop()
+            directory = os.path.join(self.root, relative)
+            try:
+                dirs[relative] = listed = self._list(directory, relative)
+            except OSError:
+                continue
+            _, files, subdirs = listed
+            for name in files:
+                if len(assets) >= self.max_files:
+                    break
+                key = normalize_asset_path(relative + '/' + name)
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                asset = self._assets.get(key, None)
+                if asset is None or asset.mtime_ns != stat.st_mtime_ns or asset.size != stat.st_size:
+                    asset = Asset(path, stat)
+                assets[key] = asset
+            pending.extend(relative + '/' + name if relative else name for name in subdirs)
+
+        if len(assets) >= self.max_files:
+            logger.warning('More than {0} files in {1}, the rest is not served'.format(self.max_files, self.root))
+        self._assets = assets
+        self._dirs = dirs
+        self.refreshed = time.monotonic()
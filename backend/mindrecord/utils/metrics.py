@@ -0,0 +1,49 @@
+import collections
+import threading
+
+
+__all__ = ['Timings']
+
+
+class Timings(object):
+    """ Thread-safe accumulator of durations (in seconds).
+        Keeps totals for the whole lifetime and a sliding window of recent values for percentiles.
+    """
+    def __init__(self, window: int=1000):
+        self._lock = threading.Lock()
+        self._recent = collections.deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value: float):
+        with self._lock:
+            self._recent.append(value)
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, p: float) -> float:
+        with self._lock:
+            values = sorted(self._recent)
+        if not values:
+            return 0.0
+        index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+        return values[index]
+
+    @property
+    def mean(self) -> float:
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def as_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
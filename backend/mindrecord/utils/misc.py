@@ -1,8 +1,17 @@
-from typing import List
-from mindrecord.utils import Request, Status, HTTPError, Response
+import hashlib
+import os
+import threading
+from email.utils import parsedate_to_datetime
+from typing import List, Optional
+from mindrecord.utils import Request, Status, HTTPError, Response, FileResponse, \
+    CompressionCache, negotiate_encoding, is_compressible, precompressed_path
 
 
-__all__ = ['allow_methods', 'allow_cors', 'cache_control']
+__all__ = ['allow_methods', 'allow_cors', 'cache_control', 'accept_ranges', 'parse_range', 'conditional', 'not_modified',
+           'compress', 'Slots']
+
+# Headers a 304 Not Modified response repeats from the full response
+_NOT_MODIFIED_HEADERS = ('ETag', 'Last-Modified', 'Cache-Control', 'Expires', 'Vary', 'Content-Location')
 
 
 def allow_methods(*methods: List[str]):
@@ -22,7 +31,7 @@ def allow_cors(origin='*',
     def decorator(fn):
         def wrapper(request: Request, *args, **kwargs):
             if request.method == 'OPTIONS':
-                response = Response(data='',
+                response = Response(data=b'',
                                     status_code=Status.OK,
                                     content_type='text/plain',
                                     content_len=0,
@@ -51,3 +60,271 @@ def cache_control(control: str='public', max_age: int=86400):
             return response
         return wrapper
     return decorator
+
+
+def parse_range(header: str, size: int) -> Optional[tuple]:
+    """ (start, end) of a single-range 'bytes=' Range header, None if the header should be ignored.
+        Raises 416 if the range is outside of the content.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        # Multiple ranges are not supported, the whole content is sent instead
+        return None
+    start, sep, end = spec.strip().partition('-')
+    if not sep or not (start or end) or (start and not start.isdigit()) or (end and not end.isdigit()):
+        return None
+    unsatisfiable = HTTPError(Status.REQUESTED_RANGE_NOT_SATISFIABLE,
+                              headers={'Content-Range': 'bytes */{0}'.format(size)})
+    if not start:
+        # Suffix: last <end> bytes
+        length = int(end)
+        if length == 0 or size == 0:
+            raise unsatisfiable
+        return max(size - length, 0), size - 1
+    start = int(start)
+    if end and int(end) < start:
+        return None
+    if start >= size:
+        raise unsatisfiable
+    end = int(end) if end else size - 1
+    return start, min(end, size - 1)
+
+
+def _if_range_matches(if_range: str, response: Response) -> bool:
+    # Strong comparison: either the exact (strong) ETag or the exact Last-Modified date
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == response.headers.get('ETag', None)
+    return if_range == response.headers.get('Last-Modified', None)
+
+
+def accept_ranges():
+    """ Serves Range requests of file responses with 206 Partial Content """
+    def decorator(fn):
+        def wrapper(request: Request, *args, **kwargs):
+            response = fn(request, *args, **kwargs)
+            if request.method != 'GET' or not isinstance(response, FileResponse) or response.status != Status.OK:
+                return response
+            # The file has changed since the part the client has: send it whole
+            if_range = request.get_header_value('if-range')
+            if if_range and not _if_range_matches(if_range.strip(), response):
+                return response
+            byte_range = parse_range(request.get_header_value('range'), response.size)
+            if byte_range is not None:
+                response.set_range(*byte_range)
+            return response
+        return wrapper
+    return decorator
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """ Weak comparison of If-None-Match with an ETag """
+    if if_none_match.strip() == '*':
+        return True
+    opaque_tag = etag[2:] if etag.startswith('W/') else etag
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == opaque_tag:
+            return True
+    return False
+
+
+def _modified_since(if_modified_since: str, last_modified: str) -> bool:
+    if not if_modified_since or not last_modified:
+        return True
+    try:
+        return parsedate_to_datetime(last_modified) > parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return True
+
+
+def conditional():
+    """ Adds an ETag to successful GET responses (a hash of the body unless the response has one)
+        and answers If-None-Match / If-Modified-Since with 304 Not Modified.
+        File responses are validated by their stats, views knowing them in advance answer with not_modified()
+        before the file is read.
+    """
+    def decorator(fn):
+        def wrapper(request: Request, *args, **kwargs):
+            response = fn(request, *args, **kwargs)
+            if request.method not in ('GET', 'HEAD') or not response or response.status != Status.OK:
+                return response
+
+            etag = response.headers.get('ETag', None)
+            if etag is None and isinstance(response.body, bytes):
+                etag = '"{0}"'.format(hashlib.sha1(response.body).hexdigest())
+                response.headers['ETag'] = etag
+            return not_modified(request, response.headers) or response
+        return wrapper
+    return decorator
+
+
+def not_modified(request: Request, headers: dict) -> Optional[Response]:
+    """ 304 Not Modified if the validators in headers (ETag, Last-Modified) satisfy the conditional request.
+        Views which know the validators in advance call it before building the response.
+    """
+    # If-Modified-Since is ignored when If-None-Match is present
+    etag = headers.get('ETag', None)
+    if_none_match = request.get_header_value('if-none-match')
+    if if_none_match is not None:
+        modified = etag is None or not _etag_matches(if_none_match, etag)
+    else:
+        modified = _modified_since(request.get_header_value('if-modified-since'), headers.get('Last-Modified', None))
+    if modified:
+        return None
+
+    response = Response(data=b'', status_code=Status.NOT_MODIFIED, content_type=None, headers={
+        k: v for k, v in headers.items() if k in _NOT_MODIFIED_HEADERS
+    })
+    response.headers.pop('Content-Length', None)
+    return response
+
+
+def _add_vary(response: Response, header: str):
+    vary = response.headers.get('Vary', None)
+    if not vary:
+        response.headers['Vary'] = header
+    elif header.lower() not in [v.strip().lower() for v in vary.split(',')]:
+        response.headers['Vary'] = '{0}, {1}'.format(vary, header)
+
+
+def _encoded_response(response: Response, encoded: Response, encoding: str) -> Response:
+    # Same representation metadata, the validator is weak since the bytes differ
+    encoded.headers = dict(response.headers, **{'Content-Length': encoded.content_len})
+    encoded.headers['Content-Encoding'] = encoding
+    encoded.headers.pop('Accept-Ranges', None)
+    etag = encoded.headers.get('ETag', None)
+    if etag and not etag.startswith('W/'):
+        encoded.headers['ETag'] = 'W/' + etag
+    return encoded
+
+
+def _precompressed(response: FileResponse, encoding: str) -> Optional[str]:
+    # Sibling file compressed in advance, unless it is older than the file
+    path = precompressed_path(response.path, encoding)
+    try:
+        if os.stat(path).st_mtime >= response.mtime:
+            return path
+    except OSError:
+        pass
+    return None
+
+
+def _read_precompressed(response: FileResponse, encoding: str) -> Optional[bytes]:
+    path = _precompressed(response, encoding)
+    if path is None:
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def compress(cache: CompressionCache):
+    """ Accept-Encoding negotiation for 200 responses of compressible types.
+        Files come from precompressed .br/.gz siblings when they are up to date, otherwise bodies are compressed.
+        Bodies within the cache size bounds are compressed (or read) once and cached,
+        larger files are compressed only if they have a sibling.
+        Range requests get the identity encoding.
+    """
+    def decorator(fn):
+        def wrapper(request: Request, *args, **kwargs):
+            response = fn(request, *args, **kwargs)
+            if response and response.status == Status.NOT_MODIFIED:
+                # Revalidated a compressed variant: repeat its (weak) validator
+                etag = response.headers.get('ETag', None)
+                if etag and not etag.startswith('W/') and \
+                        'W/' + etag in request.get_header_value('if-none-match', ''):
+                    response.headers['ETag'] = 'W/' + etag
+                    _add_vary(response, 'Accept-Encoding')
+                return response
+            if not response or response.status != Status.OK or 'Content-Encoding' in response.headers:
+                return response
+            if not is_compressible(response.headers.get('Content-Type', None)):
+                return response
+            _add_vary(response, 'Accept-Encoding')
+            if request.get_header_value('range') is not None:
+                return response
+            encoding = negotiate_encoding(request.get_header_value('accept-encoding', ''))
+            if encoding is None:
+                return response
+
+            if isinstance(response, FileResponse):
+                if not cache.accepts(response.size):
+                    sibling = _precompressed(response, encoding)
+                    if sibling is None:
+                        return response
+                    return _encoded_response(response, FileResponse(sibling), encoding)
+                # Cached bodies (also the ones read from siblings) are sent without touching the filesystem
+                key = (response.path, response.headers.get('ETag', None))
+                data = cache.get(key, encoding, response.read, lambda: _read_precompressed(response, encoding))
+            elif isinstance(response.body, bytes):
+                if not cache.accepts(len(response.body)):
+                    return response
+                key = response.headers.get('ETag', None) or hashlib.sha1(response.body).hexdigest()
+                data = cache.get(key, encoding, lambda: response.body)
+            else:
+                return response
+
+            if data is None:
+                return response
+            return _encoded_response(response, Response(data=data, content_type=None), encoding)
+        return wrapper
+    return decorator
+
+
+class Slots(object):
+    """ Bounded number of requests holding a server thread for long (long-polls, event streams, followed logs).
+        Requests which don't get a slot should be answered right away, so they can't take every server thread.
+    """
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.rejected = 0
+
+    def acquire(self) -> bool:
+        """ Takes a slot, False if all of them are taken """
+        with self._lock:
+            if self.in_use >= self.limit:
+                self.rejected += 1
+                return False
+            self.in_use += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_use -= 1
+
+    def hold(self, iterable):
+        """ Response body which releases an acquired slot once it is sent, closed or dropped """
+        return _HeldIterable(iterable, self.release)
+
+    def stats(self) -> dict:
+        return {'limit': self.limit, 'in_use': self.in_use, 'rejected': self.rejected}
+
+
+class _HeldIterable(object):
+    def __init__(self, iterable, release: callable):
+        self._iterable = iterable
+        self._release = release
+
+    def __iter__(self):
+        try:
+            yield from self._iterable
+        finally:
+            self.close()
+
+    def close(self):
+        release, self._release = self._release, None
+        if release is None:
+            return
+        close = getattr(self._iterable, 'close', None)
+        if close is not None:
+            close()
+        release()
+
+    def __del__(self):
+        # Responses the server never started sending
+        self.close()
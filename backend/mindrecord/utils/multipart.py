@@ -0,0 +1,335 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+from typing import Optional
+from urllib.parse import parse_qs, unquote
+
+from mindrecord.utils.errors import HTTPError, Status
+
+
+__all__ = ['BodyLimits', 'UploadedFile', 'parse_options_header', 'parse_body', 'copy_file']
+
+_option = re.compile(r';\s*([^=\s;]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+
+CHUNK_SIZE = 64 * 1024
+MAX_HEADERS_SIZE = 16 * 1024
+
+
+class BodyLimits(object):
+    """ Limits of a parsed request body (bytes), a violation is rejected with 413 """
+    def __init__(self,
+                 max_body_size: int=64 * 1024 * 1024,
+                 max_fields: int=1000,
+                 max_file_size: int=32 * 1024 * 1024,
+                 max_field_size: int=1024 * 1024,
+                 spool_dir: str=None):
+        self.max_body_size = max_body_size
+        self.max_fields = max_fields
+        self.max_file_size = max_file_size
+        self.max_field_size = max_field_size
+        # Uploaded files are spooled here (system temp dir by default)
+        self.spool_dir = spool_dir
+
+
+def _too_large(message: str):
+    return HTTPError(Status.PAYLOAD_TOO_LARGE, message=message)
+
+
+def copy_file(src_path: str, dst_path: str):
+    """ Copies a file in the kernel (copy_file_range or sendfile) where available """
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        size = os.fstat(src.fileno()).st_size
+        offset = 0
+        for copy in ('copy_file_range', 'sendfile'):
+            if not hasattr(os, copy):
+                continue
+            try:
+                while offset < size:
+                    if copy == 'copy_file_range':
+                        copied = os.copy_file_range(src.fileno(), dst.fileno(), size - offset, offset, offset)
+                    else:
+                        copied = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+                    if not copied:
+                        break
+                    offset += copied
+            except OSError:
+                # Not supported for these filesystems, continue from where it stopped
+                pass
+            if offset >= size:
+                return
+        src.seek(offset)
+        dst.seek(offset)
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+
+def parse_options_header(value: str) -> tuple:
+    """ 'form-data; name="a"; filename="b.txt"' -> ('form-data', {'name': 'a', 'filename': 'b.txt'}) """
+    if not value:
+        return '', {}
+    main, _, rest = value.partition(';')
+    options = {}
+    for match in _option.finditer(';' + rest):
+        key, val = match.group(1).lower(), match.group(2).strip()
+        if len(val) >= 2 and val[0] == val[-1] == '"':
+            val = re.sub(r'\\(.)', r'\1', val[1:-1])
+        if key.endswith('*'):
+            # RFC 5987: charset'language'percent-encoded
+            charset, _, encoded = val.partition("'")
+            _, _, encoded = encoded.partition("'")
+            key, val = key[:-1], unquote(encoded, encoding=charset or 'utf-8', errors='replace')
+        options[key] = val
+    return main.strip().lower(), options
+
+
+class UploadedFile(object):
+    """ File part of a multipart body, spooled to disk while the body is read.
+        The file is opened lazily on access, `save` moves it without copying when possible.
+        Spooled file is removed with `close` unless it was saved.
+    """
+    def __init__(self, name: str, filename: str, content_type: str=None, spool_dir: str=None):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.size = 0
+        self._hash = hashlib.sha256()
+        fd, self.path = tempfile.mkstemp(prefix='upload-', dir=spool_dir)
+        self._writer = os.fdopen(fd, 'wb')
+        self._file = None
+        self._saved = False
+
+    def _write(self, data: bytes):
+        self._writer.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+
+    def _finish(self):
+        self._writer.close()
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+    @property
+    def file(self):
+        """ Binary file handle for reading the contents """
+        if self._file is None:
+            self._file = open(self.path, 'rb')
+        return self._file
+
+    def read(self, size: int=-1) -> bytes:
+        return self.file.read(size)
+
+    def save(self, path: str) -> str:
+        """ Moves the upload to path (renamed when spooled on the same filesystem), returns the path """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        try:
+            os.replace(self.path, path)
+        except OSError:
+            # Different filesystem
+            copy_file(self.path, path)
+            os.remove(self.path)
+        self.path = path
+        self._saved = True
+        return path
+
+    def close(self):
+        if not self._writer.closed:
+            self._writer.close()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if not self._saved and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __repr__(self):
+        return 'UploadedFile({0!r}, {1!r}, {2} bytes)'.format(self.name, self.filename, self.size)
+
+
+class _BodyReader(object):
+    """ Reads up to content length (or EOF) in chunks, enforces the body size limit """
+    def __init__(self, stream, content_length: Optional[int], max_size: int):
+        if content_length is not None and max_size and content_length > max_size:
+            raise _too_large('Request body exceeds {0} bytes'.format(max_size))
+        self.stream = stream
+        self.left = content_length
+        self.max_size = max_size
+        self.read_bytes = 0
+
+    def read(self, size: int=CHUNK_SIZE) -> bytes:
+        if self.left is not None:
+            size = min(size, self.left)
+            if size <= 0:
+                return b''
+        data = self.stream.read(size)
+        self.read_bytes += len(data)
+        if self.left is not None:
+            self.left -= len(data)
+        if self.max_size and self.read_bytes > self.max_size:
+            raise _too_large('Request body exceeds {0} bytes'.format(self.max_size))
+        return data
+
+    def read_all(self) -> bytes:
+        chunks = []
+        while True:
+            chunk = self.read()
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+
+def _parse_multipart(reader: _BodyReader, boundary: str, limits: BodyLimits, files: list,
+                     spool_dir: str=None, file_limits: dict=None) -> dict:
+    """ Streaming multipart/form-data parser. Created UploadedFiles are added to files (for cleanup) """
+    spool_dir = spool_dir or limits.spool_dir
+    file_limits = file_limits or {}
+    if not boundary:
+        raise HTTPError(Status.BAD_REQUEST, message='Multipart boundary is missing')
+    delimiter = b'--' + boundary.encode('latin-1')
+    # Part data ends right before the CRLF preceding the next delimiter
+    separator = b'\r\n' + delimiter
+
+    fields = {}
+    count = 0
+    buffer = b''
+    eof = False
+
+    def fill() -> bool:
+        nonlocal buffer, eof
+        chunk = reader.read()
+        if not chunk:
+            eof = True
+            return False
+        buffer += chunk
+        return True
+
+    # Preamble
+    while True:
+        position = buffer.find(delimiter)
+        if position >= 0:
+            buffer = buffer[position + len(delimiter):]
+            break
+        buffer = buffer[-len(delimiter):]
+        if not fill():
+            raise HTTPError(Status.BAD_REQUEST, message='Malformed multipart body')
+
+    while True:
+        # After a delimiter: "--" closes the body, CRLF starts a part
+        while len(buffer) < 2 and fill():
+            pass
+        if buffer.startswith(b'--'):
+            break
+        if not buffer.startswith(b'\r\n'):
+            raise HTTPError(Status.BAD_REQUEST, message='Malformed multipart body')
+        buffer = buffer[2:]
+
+        # Part headers
+        while True:
+            position = buffer.find(b'\r\n\r\n')
+            if position >= 0:
+                break
+            if len(buffer) > MAX_HEADERS_SIZE:
+                raise HTTPError(Status.REQUEST_HEADER_FIELDS_TOO_LARGE, message='Multipart headers are too large')
+            if not fill():
+                raise HTTPError(Status.BAD_REQUEST, message='Malformed multipart body')
+        headers = {}
+        for line in buffer[:position].decode('utf-8', errors='replace').split('\r\n'):
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        buffer = buffer[position + 4:]
+
+        disposition, options = parse_options_header(headers.get('content-disposition', ''))
+        name = options.get('name', None)
+        if disposition != 'form-data' or name is None:
+            raise HTTPError(Status.BAD_REQUEST, message='Malformed multipart body')
+        count += 1
+        if limits.max_fields and count > limits.max_fields:
+            raise _too_large('Request has more than {0} fields'.format(limits.max_fields))
+
+        upload = None
+        value = bytearray()
+        if 'filename' in options:
+            # Browsers may send a full client path
+            filename = os.path.basename(options['filename'].replace('\\', '/'))
+            upload = UploadedFile(name, filename, headers.get('content-type', None), spool_dir=spool_dir)
+            files.append(upload)
+        max_file_size = file_limits.get(name, limits.max_file_size)
+
+        def emit(data: bytes):
+            if upload is not None:
+                if max_file_size and upload.size + len(data) > max_file_size:
+                    raise _too_large('File {0} exceeds {1} bytes'.format(name, max_file_size))
+                upload._write(data)
+            else:
+                if limits.max_field_size and len(value) + len(data) > limits.max_field_size:
+                    raise _too_large('Field {0} exceeds {1} bytes'.format(name, limits.max_field_size))
+                value.extend(data)
+
+        # Part data
+        while True:
+            position = buffer.find(separator)
+            if position >= 0:
+                emit(buffer[:position])
+                buffer = buffer[position + len(separator):]
+                break
+            # Keep a tail which may be the beginning of the separator
+            keep = len(separator) - 1
+            if len(buffer) > keep:
+                emit(buffer[:-keep])
+                buffer = buffer[-keep:]
+            if not fill():
+                raise HTTPError(Status.BAD_REQUEST, message='Malformed multipart body')
+
+        if upload is not None:
+            upload._finish()
+            fields.setdefault(name, []).append(upload)
+        else:
+            fields.setdefault(name, []).append(value.decode('utf-8', errors='replace'))
+
+    # Drain the epilogue so the connection can be reused
+    while not eof:
+        fill()
+        buffer = b''
+    return fields
+
+
+def parse_body(stream, content_type: str, content_length: Optional[int], limits: BodyLimits, files: list,
+               spool_dir: str=None, file_limits: dict=None) -> dict:
+    """ Fields of a multipart/form-data, application/x-www-form-urlencoded or application/json body
+        as {name: [values]}. File parts are UploadedFile values (also added to files) spooled
+        to spool_dir (limits.spool_dir by default), file_limits overrides max file size per field.
+        Bodies of other content types are not read.
+    """
+    mime_type, options = parse_options_header(content_type)
+    reader = _BodyReader(stream, content_length, limits.max_body_size)
+
+    if mime_type == 'multipart/form-data':
+        return _parse_multipart(reader, options.get('boundary', None), limits, files,
+                                spool_dir=spool_dir, file_limits=file_limits)
+
+    if mime_type == 'application/x-www-form-urlencoded':
+        body = reader.read_all().decode(options.get('charset', 'utf-8'), errors='replace')
+        try:
+            return parse_qs(body, max_num_fields=limits.max_fields or None)
+        except ValueError:
+            raise _too_large('Request has more than {0} fields'.format(limits.max_fields))
+
+    if mime_type == 'application/json':
+        body = reader.read_all()
+        if not body:
+            return {}
+        try:
+            data = json.loads(body.decode(options.get('charset', 'utf-8')))
+        except ValueError:
+            raise HTTPError(Status.BAD_REQUEST, message='Invalid JSON body')
+        if not isinstance(data, dict):
+            raise HTTPError(Status.BAD_REQUEST, message='JSON body should be an object')
+        if limits.max_fields and len(data) > limits.max_fields:
+            raise _too_large('Request has more than {0} fields'.format(limits.max_fields))
+        return {k: [v] for k, v in data.items()}
+
+    return {}
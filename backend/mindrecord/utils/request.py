@@ -1,7 +1,7 @@
 from urllib.parse import parse_qs
-import cgi
 
 from mindrecord.utils.errors import HTTPError, Status
+from mindrecord.utils.multipart import BodyLimits, parse_body
 
 
 __all__ = ['Request']
@@ -10,8 +10,15 @@ __all__ = ['Request']
 class Request(object):
     _headers = {}
 
-    def __init__(self, wsgi_env: dict):
+    def __init__(self, wsgi_env: dict, limits: BodyLimits=None):
         self._wsgi_env = wsgi_env
+        self._limits = limits or BodyLimits()
+        # Uploaded files spooled while parsing the body, removed on close()
+        self._files = []
+        self._upload_dir = None
+        self._upload_limits = None
+        # Authenticated user, memoized by mindrecord.auth.get_user_from_request
+        self.user = None
 
         self._path = wsgi_env.get('PATH_INFO')
         self._uri = wsgi_env.get('REQUEST_URI')
@@ -25,7 +32,7 @@ class Request(object):
 
         # Parse WSGI HTTP headers
         # All HTTP headers starts with HTTP_ (5 symbols) in WSGI env
-        self._headers = {k[5:].lower(): wsgi_env[k] for k in wsgi_env if k.startswith('HTTP_')}
+        self._headers = {k[5:].lower().replace('_', '-'): wsgi_env[k] for k in wsgi_env if k.startswith('HTTP_')}
         if self._content_len_header is not None:
             self._headers['content-length'] = self._content_len_header
         if self._content_type_header is not None:
@@ -49,30 +56,51 @@ class Request(object):
             self._parsed_qs = parse_qs(self._query_string)
         return self._parsed_qs
 
+    @property
+    def stream(self):
+        """ Raw body stream (for bodies which are not parsed into data) """
+        return self._wsgi_env.get('wsgi.input')
+
+    @property
+    def content_length(self):
+        try:
+            return int(self._content_len_header) if self._content_len_header else None
+        except ValueError:
+            raise HTTPError(Status.BAD_REQUEST, message='Invalid Content-Length')
+
+    def configure_uploads(self, directory: str=None, max_sizes: dict=None):
+        """ Spools uploaded files to directory (so saving them there is a rename) and limits
+            file sizes per field ({field: bytes}). Should be called before data is accessed.
+        """
+        assert self._parsed_data is None, 'Request body is already parsed'
+        self._upload_dir = directory
+        self._upload_limits = max_sizes
+
     @property
     def data(self):
+        """ Query parameters and fields of the body (multipart, urlencoded or JSON).
+            Uploaded files are UploadedFile values.
+        """
         if self._parsed_data is None:
             # Parse query parameters first
-            self._parsed_data = self.query_parameters
+            self._parsed_data = {k: list(v) for k, v in self.query_parameters.items()}
 
-            if self.method in ['POST', 'PUT']:
+            if self.method in ['POST', 'PUT', 'DELETE']:
                 if self._content_type_header is not None:
                     try:
-                        headers = cgi.Message()
-                        headers.set_type(self._content_type_header)
-                        headers['Content-Length'] = self._content_len_header
-                        fields = cgi.FieldStorage(self._wsgi_env.get('wsgi.input'),
-                                                  headers=headers,
-                                                  encoding='utf-8',
-                                                  errors='replace',
-                                                  environ={'REQUEST_METHOD': 'POST'})
-                        for key in fields:
-                            if key in self._parsed_data:
-                                self._parsed_data[key] += _get_post_values(fields, key)
-                            else:
-                                self._parsed_data[key] = _get_post_values(fields, key)
+                        fields = parse_body(self._wsgi_env.get('wsgi.input'),
+                                            content_type=self._content_type_header,
+                                            content_length=self.content_length,
+                                            limits=self._limits,
+                                            files=self._files,
+                                            spool_dir=self._upload_dir,
+                                            file_limits=self._upload_limits)
+                    except HTTPError:
+                        raise
                     except Exception:
                         raise HTTPError(Status.BAD_REQUEST)
+                    for key, values in fields.items():
+                        self._parsed_data.setdefault(key, []).extend(values)
             for key in self._parsed_data:
                 val = self._parsed_data[key]
                 if isinstance(val, list) and len(val) == 1:
@@ -80,21 +108,10 @@ class Request(object):
         return self._parsed_data
 
     def get_header_value(self, header_name: str, default=None) -> str:
-        return self._headers.get(header_name.lower(), default)
-
-
-def _get_post_values(fields: cgi.FieldStorage, key):
-    def _get_value(f: cgi.FieldStorage):
-        if f.filename is not None:
-            return f
-        return f.value
-
-    """ Return list of received values."""
-    if key in fields:
-        value = fields[key]
-        if isinstance(value, list):
-            return [_get_value(x) for x in value]
-        else:
-            return [_get_value(value)]
-    else:
-        return []
+        return self._headers.get(header_name.lower().replace('_', '-'), default)
+
+    def close(self):
+        """ Removes uploaded files which were not saved """
+        for uploaded_file in self._files:
+            uploaded_file.close()
+        self._files = []
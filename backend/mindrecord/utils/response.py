@@ -1,11 +1,13 @@
 import json
 import os
 import mimetypes
+from email.utils import formatdate
 from io import RawIOBase
 from http.client import responses
 
 
-__all__ = ['Response', 'JsonResponse', 'FileResponse', 'StreamedResponse', 'FileResponse']
+__all__ = ['Response', 'JsonResponse', 'FileResponse', 'StreamedResponse', 'FileResponse', 'IterableResponse',
+           'BufferedFileResponse', 'file_headers']
 
 ENCODING = 'utf-8'
 JSON_CONTENT_TYPE = 'application/json; charset={}'.format(ENCODING)
@@ -60,6 +62,10 @@ class Response(object):
     def __iter__(self):
         yield self.body
 
+    def as_wsgi(self, env: dict):
+        """ Iterable to return from the WSGI application """
+        return iter(self)
+
 
 class JsonResponse(Response):
     def __init__(self, data,
@@ -99,11 +105,133 @@ class StreamedResponse(Response):
         return data
 
 
-class FileResponse(StreamedResponse):
-    def __init__(self, path: str, *args, **kwargs):
-        stream = open(path, 'rb')
-        mime_type = mimetypes.guess_type(path)[0]
-        if mime_type is None:
-            mime_type = 'application/octet-stream'
+class IterableResponse(Response):
+    """ Response of unknown length produced by an iterable of byte chunks """
+    def __init__(self, iterable, *args, **kwargs):
+        super().__init__(iterable, content_len=0, *args, **kwargs)
+        del self.headers[CONTENT_LENGTH]
+
+    def __iter__(self):
+        return iter(self.body)
+
+
+def file_headers(path: str, stat: os.stat_result) -> dict:
+    """ Content type and validators (ETag from size and modification time, Last-Modified) of a file """
+    mime_type = mimetypes.guess_type(path)[0]
+    if mime_type is None:
+        mime_type = 'application/octet-stream'
+    return {
+        CONTENT_TYPE: mime_type,
+        'Accept-Ranges': 'bytes',
+        'ETag': '"{0:x}-{1:x}"'.format(stat.st_size, stat.st_mtime_ns),
+        'Last-Modified': formatdate(stat.st_mtime, usegmt=True),
+    }
+
+
+class FileResponse(Response):
+    """ File contents, the file is opened only when the response is sent.
+        Whole files are sent with the server's wsgi.file_wrapper (sendfile where supported),
+        otherwise in chunks sized by the file size. set_range() turns it into 206 Partial Content.
+        ETag (size and modification time) and Last-Modified validators are set from the file stats.
+        Callers which know them already (see AssetManifest) pass stat and stat_headers (file_headers()).
+    """
+    MIN_CHUNK_SIZE = 64 * 1024
+    MAX_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, path: str, chunk_size: int=None, *args,
+                 stat: os.stat_result=None, stat_headers: dict=None, **kwargs):
+        self.path = path
+        if stat is None:
+            stat = os.stat(path)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.mtime_ns = stat.st_mtime_ns
+        self.range = None
+        self.chunk_size = chunk_size or min(max(self.size // 16, self.MIN_CHUNK_SIZE), self.MAX_CHUNK_SIZE)
+
+        super().__init__(None, content_len=self.size, content_type=None, *args, **kwargs)
+        for k, v in (stat_headers or file_headers(path, stat)).items():
+            self.headers.setdefault(k, v)
+
+    def set_range(self, start: int, end: int):
+        """ Sends bytes start..end (inclusive) of the file only """
+        self.range = (start, end)
+        self.status = 206
+        self.status_message = responses.get(206)
+        self.headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, end, self.size)
+        self.content_len = end - start + 1
+
+    def _read(self, f, offset: int, length: int):
+        try:
+            f.seek(offset)
+            while length > 0:
+                data = f.read(min(self.chunk_size, length))
+                if not data:
+                    break
+                length -= len(data)
+                yield data
+        finally:
+            f.close()
+
+    def read(self) -> bytes:
+        """ Whole contents of the file """
+        with open(self.path, 'rb') as f:
+            return f.read()
 
-        super().__init__(stream, content_type=mime_type, *args, **kwargs)
+    def __iter__(self):
+        return self.as_wsgi({})
+
+    def _restat(self, stat: os.stat_result):
+        """ The file has changed since the response was made (stats passed by the caller are not fresh):
+            the whole new file is sent with its own length and validators
+        """
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.mtime_ns = stat.st_mtime_ns
+        self.range = None
+        self.status = 200
+        self.status_message = responses.get(200)
+        self.headers.pop('Content-Range', None)
+        self.content_len = self.size
+        validators = file_headers(self.path, stat)
+        weak = self.headers.get('ETag', '').startswith('W/')
+        self.headers['ETag'] = 'W/' + validators['ETag'] if weak else validators['ETag']
+        self.headers['Last-Modified'] = validators['Last-Modified']
+
+    def as_wsgi(self, env: dict):
+        f = open(self.path, 'rb')
+        try:
+            stat = os.fstat(f.fileno())
+        except OSError:
+            f.close()
+            raise
+        # Headers are sent after this, they describe what is actually read
+        if stat.st_size != self.size or stat.st_mtime_ns != self.mtime_ns:
+            self._restat(stat)
+        file_wrapper = env.get('wsgi.file_wrapper', None)
+        if self.range is None and file_wrapper is not None:
+            return file_wrapper(f, self.chunk_size)
+        offset, end = self.range or (0, self.size - 1)
+        return self._read(f, offset, end - offset + 1)
+
+
+class BufferedFileResponse(FileResponse):
+    """ File response sent from memory: contents and headers are prepared in advance (see FileCache) """
+    def __init__(self, path: str, data: bytes, mtime: float, headers: dict, *args, **kwargs):
+        self.path = path
+        self.data = data
+        self.size = len(data)
+        self.mtime = mtime
+        self.range = None
+        self.chunk_size = self.size
+        Response.__init__(self, data, content_len=self.size, content_type=None, headers=dict(headers),
+                          *args, **kwargs)
+
+    def read(self) -> bytes:
+        return self.data
+
+    def as_wsgi(self, env: dict):
+        if self.range is None:
+            return [self.data]
+        start, end = self.range
+        return [self.data[start:end + 1]]
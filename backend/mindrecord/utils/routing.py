@@ -5,24 +5,68 @@ from mindrecord.utils.errors import HTTPError, Status
 
 __all__ = ['Router']
 
+_group_name = re.compile(r'\(\?P<([A-Za-z_][A-Za-z0-9_]*)>')
+_group_reference = re.compile(r'\(\?P=([A-Za-z_][A-Za-z0-9_]*)\)')
+
 
 class Router(object):
-    routes = []
+    """ Routes are matched in the order they were added.
+
+        All route patterns are compiled into one alternation regex, so a request
+        (matched or not) costs a single regex match instead of a scan over every route.
+        Named groups of each route are prefixed with the route index to stay unique,
+        the matched route is found by the name of its outer group.
+        A pattern can be added several times with different methods, requests with
+        other methods are rejected with 405.
+    """
+    def __init__(self):
+        # pattern -> route index, handlers of a route by index: {method or None: handler}
+        self._indexes = {}
+        self._tables = []
+        self._compiled = None
 
-    def add_route(self, route_pattern: str, handler: callable):
+    def add_route(self, route_pattern: str, handler: callable, methods: list=None):
         assert handler is not None, 'Handler should not be None'
-        compiled_pattern = re.compile(route_pattern)
-        self.routes.append((route_pattern, compiled_pattern, handler))
+        index = self._indexes.get(route_pattern, None)
+        if index is None:
+            index = len(self._tables)
+            self._indexes[route_pattern] = index
+            self._tables.append({})
+        table = self._tables[index]
+        for method in methods or [None]:
+            assert method not in table, 'Route {0} {1} is already defined'.format(method or '*', route_pattern)
+            table[method] = handler
+        self._compiled = None
+
+    def _compile(self):
+        alternatives = []
+        groups = []
+        for index, pattern in enumerate(self._indexes):
+            prefix = 'r{0}_'.format(index)
+            # Router matches from the start of the path anyway
+            body = pattern[1:] if pattern.startswith('^') else pattern
+            body = _group_name.sub(lambda m: '(?P<{0}{1}>'.format(prefix, m.group(1)), body)
+            body = _group_reference.sub(lambda m: '(?P={0}{1})'.format(prefix, m.group(1)), body)
+            alternatives.append('(?P<_r{0}>{1})'.format(index, body))
+            groups.append({prefix + name: name for name in re.compile(pattern).groupindex})
+        self._compiled = re.compile('|'.join(alternatives)), groups
 
     def dispatch(self, request):
-        request_path = request.path
-        for pattern, compiled_pattern, handler in self.routes:
-            match = compiled_pattern.match(request_path)
-            if not match:
-                continue
+        if self._compiled is None:
+            self._compile()
+        compiled, groups = self._compiled
+
+        match = compiled.match(request.path)
+        if not match:
+            # No route found
+            raise HTTPError(Status.NOT_FOUND)
 
-            kwargs = match.groupdict()  # type: dict
-            return handler(request, **kwargs)
+        # The outer group of a route closes last
+        index = int(match.lastgroup[2:])
+        kwargs = {name: match.group(group) for group, name in groups[index].items()}
 
-        # No route found
-        raise HTTPError(Status.NOT_FOUND)
+        table = self._tables[index]
+        handler = table.get(request.method, None) or table.get(None, None)
+        if handler is None:
+            raise HTTPError(Status.METHOD_NOT_ALLOWED, headers={'Allow': ', '.join(sorted(table))})
+        return handler(request, **kwargs)
@@ -0,0 +1,92 @@
+""" Standalone processing worker.
+
+    Pulls raw results from the database and runs test processing, so the number of
+    processing workers can be sized independently from the API processes:
+
+        python -m mindrecord.worker --workers 8 --per-test-limit 4
+"""
+import argparse
+import logging
+import signal
+import threading
+
+from mindrecord.app import config, db
+from mindrecord import registry
+from mindrecord.indexes import ensure_indexes_on_startup
+from mindrecord.jobs import JobQueue, Dispatcher
+from mindrecord.processing import process_result, process_batch
+from mindrecord.scheduler import Scheduler
+
+
+__all__ = ['create_dispatcher', 'main']
+
+logger = logging.getLogger(__name__)
+
+
+def create_dispatcher(workers: int=None,
+                      queue_size: int=None,
+                      per_test_limit: int=None,
+                      poll_seconds: float=None,
+                      tests: list=None,
+                      reload_missing=False) -> Dispatcher:
+    """ Processing dispatcher configured from config, arguments override config values """
+    scheduler = Scheduler(workers=int(workers or config.PROCESSING_WORKERS),
+                          queue_size=int(queue_size or config.PROCESSING_QUEUE_SIZE),
+                          per_key_limit=int(per_test_limit or config.PROCESSING_PER_TEST_LIMIT),
+                          retry_after=int(config.PROCESSING_RETRY_AFTER_SECONDS),
+                          name='processing')
+    queue = JobQueue(db['results'],
+                     lease_seconds=int(config.PROCESSING_LEASE_SECONDS),
+                     max_attempts=int(config.PROCESSING_MAX_ATTEMPTS),
+                     backoff_seconds=int(config.PROCESSING_RETRY_BACKOFF_SECONDS))
+    return Dispatcher(queue, scheduler,
+                      get_test=lambda test_id: registry.get_test(test_id, reload_missing=reload_missing),
+                      handler=process_result,
+                      batch_handler=process_batch,
+                      poll_seconds=float(poll_seconds or config.PROCESSING_POLL_SECONDS),
+                      tests=tests)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MindRecord processing worker')
+    parser.add_argument('--workers', type=int, default=None, help='Max concurrent processing jobs')
+    parser.add_argument('--queue-size', type=int, default=None, help='Max jobs buffered in memory')
+    parser.add_argument('--per-test-limit', type=int, default=None, help='Max concurrent jobs of one test')
+    parser.add_argument('--poll', type=float, default=None, help='Database poll interval (seconds)')
+    parser.add_argument('--tests', type=str, default=None, help='Comma-separated test ids to process (default: all)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if config.DEBUG else logging.INFO)
+    ensure_indexes_on_startup()
+
+    # Tests published by another process are not read from the configs again
+    if not registry.tests:
+        registry.init_tests()
+    if config.TESTS_WATCH:
+        registry.tests_watcher.start()
+    tests = [t.strip() for t in args.tests.split(',') if t.strip()] if args.tests else None
+    dispatcher = create_dispatcher(workers=args.workers,
+                                   queue_size=args.queue_size,
+                                   per_test_limit=args.per_test_limit,
+                                   poll_seconds=args.poll,
+                                   tests=tests,
+                                   reload_missing=True)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+
+    logger.info('Starting processing worker {0} with {1} workers'.format(
+        dispatcher.queue.owner, dispatcher.scheduler.workers))
+    dispatcher.start()
+    while not stop.wait(1):
+        pass
+
+    # Running jobs are finished, results still buffered in memory are raw in the database
+    logger.info('Stopping processing worker {0}'.format(dispatcher.queue.owner))
+    dispatcher.stop(wait=True)
+    registry.tests_watcher.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Tests import the backend package without installing it
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,35 @@
+from mindrecord.utils.bloom import BloomFilter
+
+
+def test_no_false_negatives():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    keys = ['token-{0}'.format(i) for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+    assert len(bloom) == 1000
+    assert not bloom.is_full
+
+
+def test_false_positive_rate():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    for i in range(1000):
+        bloom.add('token-{0}'.format(i))
+    false_positives = sum('other-{0}'.format(i) in bloom for i in range(10000))
+    # Expected about 100, with a wide margin
+    assert false_positives < 300
+
+
+def test_is_full():
+    bloom = BloomFilter(capacity=2)
+    assert 'a' not in bloom
+    for key in ('a', 'b', 'c'):
+        bloom.add(key)
+    assert bloom.is_full
+
+
+def test_sizing():
+    bloom = BloomFilter(capacity=0, error_rate=0.5)
+    assert bloom.capacity == 1
+    assert bloom.size >= 8
+    assert bloom.hashes >= 1
@@ -0,0 +1,47 @@
+import gzip
+import pytest
+
+from mindrecord.utils.compression import negotiate_encoding, is_compressible, compress_data
+
+
+@pytest.mark.parametrize('accept_encoding, expected', [
+    (None, None),
+    ('', None),
+    ('gzip', 'gzip'),
+    ('GZIP, deflate', 'gzip'),
+    ('br, gzip', 'br'),
+    ('br;q=0.5, gzip;q=0.8', 'gzip'),
+    ('gzip;q=0', None),
+    ('*', 'br'),
+    ('*;q=0.1, br;q=0', 'gzip'),
+    ('identity', None),
+    ('gzip;q=x', None),
+])
+def test_negotiate_encoding(accept_encoding, expected):
+    assert negotiate_encoding(accept_encoding, available=('br', 'gzip')) == expected
+
+
+def test_negotiate_encoding_available():
+    assert negotiate_encoding('br, gzip;q=0.5', available=('gzip',)) == 'gzip'
+    assert negotiate_encoding('br', available=('gzip',)) is None
+
+
+@pytest.mark.parametrize('content_type, expected', [
+    ('text/html; charset=utf-8', True),
+    ('application/json', True),
+    ('application/ld+json', True),
+    ('image/svg+xml', True),
+    ('image/png', False),
+    ('font/woff2', False),
+    ('application/octet-stream', False),
+    (None, False),
+])
+def test_is_compressible(content_type, expected):
+    assert is_compressible(content_type) is expected
+
+
+def test_gzip_is_stable():
+    data = b'{"score": 1}' * 100
+    compressed = compress_data(data, 'gzip')
+    assert gzip.decompress(compressed) == data
+    assert compress_data(data, 'gzip') == compressed
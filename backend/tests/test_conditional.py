@@ -0,0 +1,59 @@
+import pytest
+
+from mindrecord.utils.errors import Status
+from mindrecord.utils.misc import not_modified, _etag_matches, _modified_since
+
+
+@pytest.mark.parametrize('if_none_match, etag, expected', [
+    ('"a"', '"a"', True),
+    ('"b", "a"', '"a"', True),
+    ('W/"a"', '"a"', True),
+    ('"a"', 'W/"a"', True),
+    ('*', '"a"', True),
+    ('"b"', '"a"', False),
+    ('"ab"', '"a"', False),
+    ('a', '"a"', False),
+])
+def test_etag_matches(if_none_match, etag, expected):
+    assert _etag_matches(if_none_match, etag) is expected
+
+
+def test_modified_since():
+    last_modified = 'Sun, 18 Oct 2026 12:00:00 GMT'
+    assert not _modified_since('Sun, 18 Oct 2026 12:00:00 GMT', last_modified)
+    assert not _modified_since('Mon, 19 Oct 2026 12:00:00 GMT', last_modified)
+    assert _modified_since('Sat, 17 Oct 2026 12:00:00 GMT', last_modified)
+    assert _modified_since('not a date', last_modified)
+    assert _modified_since(None, last_modified)
+
+
+class _Request(object):
+    def __init__(self, **headers):
+        self.headers = {k.replace('_', '-'): v for k, v in headers.items()}
+
+    def get_header_value(self, name: str):
+        return self.headers.get(name, None)
+
+
+HEADERS = {
+    'ETag': '"a"',
+    'Last-Modified': 'Sun, 18 Oct 2026 12:00:00 GMT',
+    'Content-Type': 'text/javascript',
+    'Content-Length': 10,
+    'Cache-Control': 'public',
+}
+
+
+def test_not_modified():
+    response = not_modified(_Request(if_none_match='"a"'), HEADERS)
+    assert response.status == Status.NOT_MODIFIED
+    assert response.headers == {'ETag': '"a"', 'Last-Modified': HEADERS['Last-Modified'], 'Cache-Control': 'public'}
+    assert not_modified(_Request(if_modified_since=HEADERS['Last-Modified']), HEADERS) is not None
+
+
+def test_modified():
+    assert not_modified(_Request(), HEADERS) is None
+    assert not_modified(_Request(if_none_match='"b"'), HEADERS) is None
+    # If-Modified-Since is ignored when If-None-Match is present
+    assert not_modified(_Request(if_none_match='"b"', if_modified_since=HEADERS['Last-Modified']), HEADERS) is None
+    assert not_modified(_Request(if_none_match='"a"'), {}) is None
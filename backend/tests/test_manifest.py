@@ -0,0 +1,49 @@
+import os
+import pytest
+
+from mindrecord.utils.manifest import AssetManifest, normalize_asset_path
+
+
+@pytest.mark.parametrize('path, expected', [
+    ('js/app.js', 'js/app.js'),
+    ('/./js//app.js', 'js/app.js'),
+    ('js\\app.js', 'js/app.js'),
+    ('js/./app.js/', 'js/app.js'),
+    ('', ''),
+    ('../secret', None),
+    ('js/../../secret', None),
+    ('js/..', None),
+    ('..\\secret', None),
+])
+def test_normalize_asset_path(path, expected):
+    assert normalize_asset_path(path) == expected
+
+
+def test_manifest(tmpdir):
+    tmpdir.join('index.html').write('<html>')
+    tmpdir.mkdir('js').join('app.js').write('x' * 10)
+    manifest = AssetManifest(str(tmpdir))
+    assert len(manifest) == 2
+    asset = manifest.get('/js/app.js')
+    assert asset.path == os.path.join(str(tmpdir), 'js', 'app.js')
+    assert asset.size == 10
+    assert asset.content_type in ('application/javascript', 'text/javascript')
+    assert 'js/app.js' in manifest
+    assert manifest.get('../index.html') is None
+
+    # Lookups don't touch the disk, refresh() picks the changes
+    tmpdir.join('js', 'app.js').write('y' * 20)
+    tmpdir.join('new.css').write('')
+    assert manifest.get('js/app.js') is asset
+    assert 'new.css' not in manifest
+    manifest.refresh()
+    assert manifest.get('js/app.js').size == 20
+    assert manifest.get('js/app.js').etag != asset.etag
+    assert manifest.get('index.html') is not None
+    assert 'new.css' in manifest
+
+
+def test_manifest_max_files(tmpdir):
+    for i in range(5):
+        tmpdir.join('{0}.txt'.format(i)).write('')
+    assert len(AssetManifest(str(tmpdir), max_files=3)) == 3
@@ -0,0 +1,122 @@
+import io
+import os
+import pytest
+
+from mindrecord.utils.errors import HTTPError, Status
+from mindrecord.utils.multipart import BodyLimits, parse_body, parse_options_header
+
+
+BOUNDARY = 'xYzZY'
+
+
+class _SlowStream(object):
+    """ Returns at most `step` bytes per read, so delimiters are split between reads """
+    def __init__(self, data: bytes, step: int):
+        self._stream = io.BytesIO(data)
+        self.step = step
+
+    def read(self, size: int=-1) -> bytes:
+        return self._stream.read(min(size, self.step) if size >= 0 else self.step)
+
+
+def _multipart(*parts) -> bytes:
+    body = b'preamble\r\n'
+    for headers, data in parts:
+        body += b'--' + BOUNDARY.encode() + b'\r\n' + headers + b'\r\n\r\n' + data + b'\r\n'
+    return body + b'--' + BOUNDARY.encode() + b'--\r\nepilogue'
+
+
+def _parse(body: bytes, limits: BodyLimits=None, step: int=None, files: list=None, **kwargs) -> dict:
+    stream = _SlowStream(body, step) if step else io.BytesIO(body)
+    return parse_body(stream, 'multipart/form-data; boundary=' + BOUNDARY, len(body), limits or BodyLimits(),
+                      files if files is not None else [], **kwargs)
+
+
+BODY = _multipart(
+    (b'Content-Disposition: form-data; name="a"', b'first'),
+    (b'Content-Disposition: form-data; name="a"', b'second\r\n--not-a-delimiter'),
+    (b'Content-Disposition: form-data; name="f"; filename="C:\\\\dir\\\\rec.bin"\r\nContent-Type: application/x-rec',
+     bytes(range(256)) * 10),
+)
+
+
+@pytest.mark.parametrize('step', [None, 1, 7, len(BOUNDARY) + 3])
+def test_fields_and_files(step, tmpdir):
+    files = []
+    fields = _parse(BODY, step=step, files=files, spool_dir=str(tmpdir))
+    try:
+        assert fields['a'] == ['first', 'second\r\n--not-a-delimiter']
+        upload, = fields['f']
+        assert files == [upload]
+        assert upload.filename == 'rec.bin'
+        assert upload.content_type == 'application/x-rec'
+        assert upload.size == 2560
+        assert upload.read() == bytes(range(256)) * 10
+        assert os.path.dirname(upload.path) == str(tmpdir)
+    finally:
+        for upload in files:
+            upload.close()
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_saved_upload_is_kept(tmpdir):
+    files = []
+    fields = _parse(BODY, files=files, spool_dir=str(tmpdir))
+    target = os.path.join(str(tmpdir), 'saved.bin')
+    fields['f'][0].save(target)
+    for upload in files:
+        upload.close()
+    assert os.listdir(str(tmpdir)) == ['saved.bin']
+
+
+def test_file_limits():
+    with pytest.raises(HTTPError) as error:
+        _parse(BODY, limits=BodyLimits(max_file_size=100))
+    assert error.value.status_code == Status.PAYLOAD_TOO_LARGE
+
+    files = []
+    fields = _parse(BODY, limits=BodyLimits(max_file_size=100), files=files, file_limits={'f': 10000})
+    assert fields['f'][0].size == 2560
+    for upload in files:
+        upload.close()
+
+
+def test_field_limits():
+    with pytest.raises(HTTPError) as error:
+        _parse(BODY, limits=BodyLimits(max_field_size=5))
+    assert error.value.status_code == Status.PAYLOAD_TOO_LARGE
+    with pytest.raises(HTTPError) as error:
+        _parse(BODY, limits=BodyLimits(max_fields=2))
+    assert error.value.status_code == Status.PAYLOAD_TOO_LARGE
+    with pytest.raises(HTTPError) as error:
+        _parse(BODY, limits=BodyLimits(max_body_size=100))
+    assert error.value.status_code == Status.PAYLOAD_TOO_LARGE
+
+
+@pytest.mark.parametrize('body', [
+    b'no delimiter at all',
+    _multipart((b'Content-Disposition: form-data; name="a"', b'x'))[:-20],
+    _multipart((b'Content-Disposition: attachment; name="a"', b'x')),
+    _multipart((b'Content-Disposition: form-data', b'x')),
+])
+def test_malformed(body):
+    with pytest.raises(HTTPError) as error:
+        _parse(body)
+    assert error.value.status_code == Status.BAD_REQUEST
+
+
+def test_urlencoded_and_json():
+    body = b'a=1&a=2&b=%20x'
+    assert parse_body(io.BytesIO(body), 'application/x-www-form-urlencoded', len(body), BodyLimits(), []) == \
+        {'a': ['1', '2'], 'b': [' x']}
+    body = b'{"a": 1, "b": [2]}'
+    assert parse_body(io.BytesIO(body), 'application/json; charset=utf-8', len(body), BodyLimits(), []) == \
+        {'a': [1], 'b': [[2]]}
+    with pytest.raises(HTTPError):
+        parse_body(io.BytesIO(b'[1]'), 'application/json', 3, BodyLimits(), [])
+    assert parse_body(io.BytesIO(b'data'), 'text/plain', 4, BodyLimits(), []) == {}
+
+
+def test_parse_options_header():
+    assert parse_options_header('form-data; name="a;b"; filename=x.bin') == \
+        ('form-data', {'name': 'a;b', 'filename': 'x.bin'})
@@ -0,0 +1,37 @@
+import pytest
+
+from mindrecord.utils.errors import HTTPError, Status
+from mindrecord.utils.misc import parse_range
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-9', (0, 9)),
+    ('bytes=10-', (10, 99)),
+    ('bytes=90-200', (90, 99)),
+    ('bytes=-10', (90, 99)),
+    ('bytes=-1000', (0, 99)),
+    (' Bytes = 5-5', (5, 5)),
+    # Ignored: the whole content is sent
+    (None, None),
+    ('', None),
+    ('items=0-9', None),
+    ('bytes=0-9,20-29', None),
+    ('bytes=9-0', None),
+    ('bytes=-', None),
+    ('bytes=a-9', None),
+    ('bytes=5', None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 100) == expected
+
+
+@pytest.mark.parametrize('header, size', [
+    ('bytes=100-', 100),
+    ('bytes=-0', 100),
+    ('bytes=-5', 0),
+])
+def test_parse_range_unsatisfiable(header, size):
+    with pytest.raises(HTTPError) as error:
+        parse_range(header, size)
+    assert error.value.status_code == Status.REQUESTED_RANGE_NOT_SATISFIABLE
+    assert error.value.headers['Content-Range'] == 'bytes */{0}'.format(size)
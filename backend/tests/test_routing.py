@@ -0,0 +1,79 @@
+import pytest
+
+from mindrecord.utils.errors import HTTPError, Status
+from mindrecord.utils.routing import Router
+
+
+class _Request(object):
+    def __init__(self, path: str, method: str='GET'):
+        self.path = path
+        self.method = method
+
+
+def _handler(name: str):
+    return lambda request, **kwargs: (name, kwargs)
+
+
+@pytest.fixture
+def router():
+    router = Router()
+    router.add_route('^/api/$', _handler('home'))
+    router.add_route('^/api/tests$', _handler('tests'))
+    router.add_route('^/api/tests/(?P<uri>[0-9a-z_\\-]+)$', _handler('test'))
+    router.add_route('^/api/tests/(?P<uri>[0-9a-z_\\-]+)/web/(?P<path>.*)$', _handler('web'))
+    router.add_route('^/api/results/(?P<id>[0-9a-f]+)$', _handler('result'))
+    router.add_route('^/api/results/(?P<id>[0-9a-f]+)/log$', _handler('log'), methods=['GET'])
+    router.add_route('^/api/results/(?P<id>[0-9a-f]+)/log$', _handler('log-delete'), methods=['DELETE'])
+    router.add_route('^/api/pairs/(?P<a>\\w+)-(?P=a)$', _handler('pair'))
+    router.add_route('^/api/user', _handler('user'))
+    return router
+
+
+@pytest.mark.parametrize('path, expected', [
+    ('/api/', ('home', {})),
+    ('/api/tests', ('tests', {})),
+    ('/api/tests/memory-span', ('test', {'uri': 'memory-span'})),
+    ('/api/tests/memory-span/web/js/app.js', ('web', {'uri': 'memory-span', 'path': 'js/app.js'})),
+    ('/api/tests/memory-span/web/', ('web', {'uri': 'memory-span', 'path': ''})),
+    ('/api/results/5b1f', ('result', {'id': '5b1f'})),
+    ('/api/results/5b1f/log', ('log', {'id': '5b1f'})),
+    ('/api/pairs/ab-ab', ('pair', {'a': 'ab'})),
+    # Patterns without $ match prefixes
+    ('/api/user/settings', ('user', {})),
+])
+def test_dispatch(router, path, expected):
+    assert router.dispatch(_Request(path)) == expected
+
+
+@pytest.mark.parametrize('path', ['/api', '/api/tests/', '/api/tests/UPPER', '/api/results/xyz', '/api/pairs/ab-cd',
+                                  '/other/api/'])
+def test_not_found(router, path):
+    with pytest.raises(HTTPError) as error:
+        router.dispatch(_Request(path))
+    assert error.value.status_code == Status.NOT_FOUND
+
+
+def test_methods(router):
+    assert router.dispatch(_Request('/api/results/5b1f/log', 'DELETE')) == ('log-delete', {'id': '5b1f'})
+    with pytest.raises(HTTPError) as error:
+        router.dispatch(_Request('/api/results/5b1f/log', 'POST'))
+    assert error.value.status_code == Status.METHOD_NOT_ALLOWED
+    assert error.value.headers['Allow'] == 'DELETE, GET'
+
+
+def test_first_added_route_wins():
+    router = Router()
+    router.add_route('^/api/tests/(?P<uri>[a-z]+)$', _handler('first'))
+    router.add_route('^/api/tests/special$', _handler('second'))
+    assert router.dispatch(_Request('/api/tests/special')) == ('first', {'uri': 'special'})
+
+
+def test_routes_added_after_dispatch(router):
+    router.dispatch(_Request('/api/'))
+    router.add_route('^/api/new$', _handler('new'))
+    assert router.dispatch(_Request('/api/new')) == ('new', {})
+
+
+def test_duplicate_route(router):
+    with pytest.raises(AssertionError):
+        router.add_route('^/api/tests$', _handler('again'))
@@ -115,6 +115,45 @@ class API {
     return this.request(`/results/${resultId}`);
   }
 
+  waitResults(resultId, onUpdate=null, timeout=30, retries=5){
+    // Long-polls the results until processing is over, onUpdate is called on every state change.
+    // Busy answers (429, 503) and network failures are retried with a backoff, other errors reject
+    let poll = (query, failures) => {
+      return fetch(`${this.apiPath}/results/${resultId}/wait?${query}`)
+        .then((response) => response.json().then((body) => {
+          if (response.ok)
+            return body;
+          let error = Error(body.message || response.statusText);
+          error.status = response.status;
+          error.retryAfter = parseInt(response.headers.get('Retry-After'));
+          throw error;
+        }))
+        .catch((error) => {
+          let busy = error.status === 429 || error.status === 503;
+          if ((error.status !== undefined && !busy) || failures >= retries)
+            throw error;
+          this.log('Waiting for results failed, retrying', error);
+          let delay = error.retryAfter > 0 ? error.retryAfter * 1000 : 1000 * 2 ** failures;
+          return new Promise(resolve => setTimeout(resolve, delay)).then(() => poll(query, failures + 1));
+        });
+    };
+    let wait = (state) => {
+      let query = state ? `state=${state}&timeout=${timeout}` : `timeout=${timeout}`;
+      let started = Date.now();
+      return poll(query, 0)
+        .then((results) => {
+          if (results.state !== state && onUpdate)
+            onUpdate(results);
+          if (results.state !== 'raw' && results.state !== 'processing')
+            return results;
+          // Busy server answers right away without waiting, don't hammer it
+          let delay = results.state === state ? Math.max(0, 1000 - (Date.now() - started)) : 0;
+          return new Promise(resolve => setTimeout(resolve, delay)).then(() => wait(results.state));
+        });
+    };
+    return wait(null);
+  }
+
   getResultsLog(resultId){
     return this.request(`/results/${resultId}/log`, 'GET', true, null, false);
   }
@@ -132,6 +171,45 @@ class API {
     return this.request(`/tests/${testId}/results`, 'POST', true, formData);
   }
 
+  uploadFile(testId, input, file, onProgress=null, chunkSize=8 * 1024 * 1024, retries=5){
+    // Resumable upload of a file input, resolves to the reference to submit as the input value
+    let session = new FormData();
+    session.append('input', input);
+    session.append('filename', file.name);
+    session.append('size', file.size);
+    session.append('content_type', file.type);
+
+    let send = (upload, offset, failures) => {
+      if (onProgress)
+        onProgress(offset, file.size);
+      if (offset >= file.size)
+        return Promise.resolve(upload.reference);
+      let chunk = file.slice(offset, offset + chunkSize);
+      return this.request(`/uploads/${upload.upload_id}?offset=${offset}`, 'PUT', true, chunk)
+        .then((state) => {
+          if (state.offset === undefined)
+            throw Error(state.message);
+          return send(upload, state.offset, 0);
+        })
+        .catch((error) => {
+          if (failures >= retries)
+            throw error;
+          this.log('Upload failed, resuming', error);
+          // Continue from what the server has received
+          return new Promise(resolve => setTimeout(resolve, 1000 * (failures + 1)))
+            .then(() => this.request(`/uploads/${upload.upload_id}`, 'GET', true))
+            .then((state) => send(upload, state.offset, failures + 1));
+        });
+    };
+
+    return this.request(`/tests/${testId}/uploads`, 'POST', true, session)
+      .then((upload) => {
+        if (!upload.upload_id)
+          throw Error(upload.message);
+        return send(upload, 0, 0);
+      });
+  }
+
   log() {
     console.log('[API]', ...arguments);
   }